@@ -12,26 +12,43 @@
 from __future__ import division, print_function
 
 import datetime
-import itertools
+import functools
 import logging
 import os
 import sys
-from multiprocessing import Pool, Process
+import zlib
+from multiprocessing import Pool
 
 import astropy.io.fits as pyfits
 import numpy as np
 from astropy.modeling import models, fitting
 from scipy import ndimage, signal, stats
 
+from . import phmap
+from .tools import batchfit, chunks, periodic, snr, speccache, voronoi, \
+    ztools
+from .tools.progress import Progress
+
+_fitter = None
+
 
 def signal_handler(s, frame):
     sys.exit()
 
-def perform_2dmap_extraction(_input_filename, log, n=4, algorithm='direct'):
+def perform_2dmap_extraction(_input_filename, log, n=4, algorithm='direct',
+                             phase_map=None, fsr=None, chunk_size=None,
+                             mask=None, bins=None, warm_start=False,
+                             return_n_iter=False, pyramid=None,
+                             checkpoint=None, cache=False, roi=None):
     """
     Perform the 2D-Map extraction using `multiprocessing` and
     `astropy.modeling`.
 
+    If a phase-map is given, the data-cube is considered as not
+    phase-corrected and the line center measured in each pixel is corrected
+    after the extraction. This avoids re-sampling the whole cube with
+    `phmapply` when only the 2D maps are needed.
+
     Parameters
     ----------
         _input_filename : str
@@ -42,18 +59,62 @@ def perform_2dmap_extraction(_input_filename, log, n=4, algorithm='direct'):
             The number of simultaneous processes that will be executed.
         gaussian : bool
             Perform Gaussian fit instead of Lorentzian fit?
+        phase_map : str or samfp.phmap.PhaseMap or None
+            A phase-map filename (image or header-only fit) or object.
+        fsr : float or None
+            The free-spectral-range in the units of the cube Z axis. See
+            `correct_phase_map`.
+        chunk_size : int or None
+            Number of pixels sent to each process at once. Defaults to one
+            row of the cube.
+        mask : numpy.ndarray or None
+            A (Y x X) boolean image (see `build_mask`). Only the pixels where
+            it is True are fitted and the others are filled with NaN.
+        bins : numpy.ndarray or None
+            A (Y x X) integer image with the bin of each pixel (see
+            `build_bins`). The average spectrum of each bin is fitted once and
+            the results are copied to all its pixels. Pixels labelled -1 are
+            filled with NaN. `mask` is ignored when bins are given.
+        warm_start : bool
+            Fit the tiles row by row, starting each fit from the solutions of
+            its converged neighbours in the previous row (see
+            `MyFitter.fit_tile_warm`). Only for the 'gaussian', 'lorentzian',
+            'gaussian-lm' and 'lorentzian-lm' algorithms.
+        return_n_iter : bool
+            Also return a (Y x X) image with the number of iterations used
+            in each pixel. Same algorithms as `warm_start`.
+        pyramid : list or None
+            Block-averaging factors, e.g. [8, 4, 2], for a coarse-to-fine
+            extraction (see `fit_pyramid`). The full resolution fits start
+            from the solutions of the finest level. Same algorithms as
+            `warm_start`, which is ignored when a pyramid is given.
+        checkpoint : str or None
+            A FITS file where completed tiles are stored as they are fitted
+            (see `MapCheckpoint`). If it already exists, the extraction
+            resumes from it, as long as it was created with the same
+            parameters. Not used with `bins`.
+        cache : bool
+            Read the spectra from the spectral cache of the cube, building it
+            if needed (see `samfp.tools.speccache`).
+        roi : tuple or None
+            A (x_start, x_end, y_start, y_end) region of interest (see
+            `samfp.tools.chunks.region`). Only the spectra inside it are read
+            and the maps have its size. `mask` and `bins` are still given for
+            the whole cube.
     Returns
     -------
         results : numpy.ndarray
-            A (X x Y x 3) array containining:
+            A (4 x Y x X) array containining:
              - m0: the Lorentzian amplitude,
              - m1: the Lorentzian center.
              - m2: the Lorentzian width.
+             - m3: the continuum.
             or
-            A (X x Y x 3) array containining:
+            A (4 x Y x X) array containining:
              - m0: the Gaussian amplitude,
              - m1: the Gaussian center.
              - m2: the Gaussian width.
+             - m3: the continuum.
     """
 
     if not isinstance(_input_filename, str):
@@ -75,11 +136,333 @@ def perform_2dmap_extraction(_input_filename, log, n=4, algorithm='direct'):
     # Load data ---
     log.info(' Loading data from: {0:s}'.format(_input_filename))
     header = pyfits.getheader(_input_filename)
-    x = np.arange(header['NAXIS1'], dtype=int)
-    y = np.arange(header['NAXIS2'], dtype=int)
+    width = header['NAXIS1']
+    height = header['NAXIS2']
+
+    if roi is not None:
+        roi = chunks.region(height, width, roi)
+        width, height = roi[1] - roi[0], roi[3] - roi[2]
+        log.info(' Region of interest: x = [{:d}:{:d}], '
+                 'y = [{:d}:{:d}]'.format(*roi))
+
+    fitter = get_fitter(_input_filename, algorithm, fsr=fsr)
+    fitter.roi = roi
+
+    if cache:
+        log.info(' Using spectral cache: {:s}'.format(
+            speccache.open_cube(_input_filename, cache=True).filename))
+        fitter.cache = True
+
+    iterations = warm_start or return_n_iter or bool(pyramid)
+    if iterations and not fitter.iterative:
+        raise IOError('Algorithm {:s} does not support warm starts, '
+                      'pyramids or iteration counts.'.format(algorithm))
+
+    if chunk_size is None:
+        chunk_size = fitter.chunk_size if fitter.vectorised else width
+
+        # Bands of rows so each row can start from the previous one ---
+        if iterations and not fitter.vectorised:
+            chunk_size = width * max(1, height // (4 * n))
+
+    if bins is not None:
+        bins = _crop(np.array(bins, dtype=int), roi)
+
+        # Bins outside the region are not fitted ---
+        if roi is not None:
+            good = bins >= 0
+            bins[good] = np.unique(bins[good], return_inverse=True)[1]
+
+        results = _fit_bins(fitter, bins, log, n, algorithm, chunk_size)
+
+        if phase_map is not None and results is not None:
+            log.info(' Correcting line centers using the phase-map.')
+            results[1] = correct_phase_map(results[1], header, phase_map,
+                                           fsr=fsr, roi=roi)
+
+        if return_n_iter:
+            return results, None
+
+        return results
+
+    if mask is not None:
+        mask = _crop(np.asarray(mask, dtype=bool), roi)
+        log.info(' Fitting {:d} of {:d} pixels.'.format(
+            int(mask.sum()), mask.size))
+
+    log.info(' Extracting 2D Maps using: {:s}'.format(algorithm))
+
+    # None means a plain `fit_tile` ---
+    warm = warm_start if iterations else None
+
+    results = np.full((4, height, width), np.nan)
+    n_iter = np.zeros((height, width), dtype=int)
+
+    ckpt = None
+    if checkpoint is not None:
+        if pyramid:
+            mode = 'pyramid ' + ' '.join(str(f) for f in pyramid)
+        else:
+            mode = {None: 'plain', True: 'warm', False: 'cold'}[warm]
+
+        ckpt = MapCheckpoint(checkpoint, _input_filename, (height, width),
+                             algorithm, chunk_size, mode, mask=mask, roi=roi)
+
+        done = ckpt.done
+        results[:, done] = ckpt.data[:4, done]
+        n_iter[done] = ckpt.data[4, done]
+        log.info(' Checkpoint {:s}: {:d} of {:d} pixels done.'.format(
+            checkpoint, int(done.sum()), done.size))
+
+    tiles = []
+    for tile in chunks.iter_tiles(height, width, chunk_size):
+        y0, y1, x0, x1 = tile
+        m = None if mask is None else mask[y0:y1, x0:x1]
+
+        # Tiles without any pixel to be fitted are not even read ---
+        if m is not None and not m.any():
+            continue
+
+        if ckpt is not None and ckpt.is_done(tile):
+            continue
+
+        tiles.append((tile, m))
+
+    guesses = None
+    if pyramid and tiles:
+        guesses = fit_pyramid(fitter, pyramid, log, n=n, mask=mask,
+                              chunk_size=chunk_size)
+        if guesses is None:
+            if ckpt is not None:
+                ckpt.close()
+            return (None, None) if return_n_iter else None
+
+    tasks = []
+    for (y0, y1, x0, x1), m in tiles:
+        if guesses is not None:
+            tasks.append(((y0, y1, x0, x1), m, guesses[:, y0:y1, x0:x1]))
+        else:
+            tasks.append(((y0, y1, x0, x1), m, warm))
+
+    t0 = datetime.datetime.now()
+
+    n_pixels = [(t[1] - t[0]) * (t[3] - t[2]) if m is None else int(m.sum())
+                for t, m, _ in tasks]
+    progress = Progress(sum(n_pixels), log, name='Fitting', unit='spectra')
+    n_pixels = dict(zip([task[0] for task in tasks], n_pixels))
+
+    def collect(tile, result, it):
+        y0, y1, x0, x1 = tile
+        results[:, y0:y1, x0:x1] = result
+        if it is not None:
+            n_iter[y0:y1, x0:x1] = it
+        if ckpt is not None:
+            ckpt.save(tile, result, it)
+        progress.update(n_pixels[tile])
+
+    # Vectorised algorithms are faster in a single process ---
+    if fitter.vectorised:
+        try:
+            for task in tasks:
+                collect(*_run_task(fitter, task))
+        except KeyboardInterrupt:
+            log.info('\n\nYou pressed Ctrl+C!')
+            log.info('Leaving now. Bye!\n')
+            results = None
+
+    else:
+        p = Pool(n, initializer=_init_worker, initargs=(fitter,))
+
+        try:
+            for tile, result, it in p.imap_unordered(_fit_tile, tasks):
+                collect(tile, result, it)
+        except KeyboardInterrupt:
+            log.info('\n\nYou pressed Ctrl+C!')
+            log.info('Leaving now. Bye!\n')
+            p.terminate()
+            results = None
+        p.close()
+        p.join()
+
+    if results is not None:
+        progress.finish()
+
+    if ckpt is not None:
+        if results is None:
+            log.info(' Completed tiles saved to {:s}. Run again with the '
+                     'same parameters to resume.'.format(checkpoint))
+        ckpt.close()
+
+    if iterations and results is not None:
+        fitted = n_iter > 0
+        log.info(' Iterations per pixel: {:.1f}'.format(
+            np.mean(n_iter[fitted]) if fitted.any() else 0))
+        log.info(' Failed fits: {:d} of {:d}'.format(
+            int(np.sum(np.isnan(results[1]) & fitted)), int(fitted.sum())))
+
+    if pyramid and results is not None:
+        _log_level_cost(log, 1, int(np.sum(n_iter > 0)), int(n_iter.sum()),
+                        datetime.datetime.now() - t0)
+
+    if phase_map is not None and results is not None:
+        log.info(' Correcting line centers using the phase-map.')
+        results[1] = correct_phase_map(results[1], header, phase_map, fsr=fsr,
+                                       roi=roi)
+
+    if return_n_iter:
+        return results, n_iter
+
+    return results
+
+
+class MapCheckpoint:
+    """
+    Completed tiles of a map extraction stored in a FITS file. The file
+    holds a (6 x Y x X) cube updated through a memory-map: the four maps,
+    the number of iterations and a completion flag. The extraction
+    parameters and the `samfp.tools.speccache.cube_key` of the cube are
+    stored in the header so a checkpoint is only resumed by an identical
+    extraction of the same, unmodified cube.
+
+    Parameters
+    ----------
+        filename : str
+            The checkpoint filename. It is created if it does not exist.
+        cube : str
+            The data-cube being extracted.
+        shape : tuple
+            The (height, width) of the maps.
+        algorithm : str
+        chunk_size : int
+        mode : str
+            How each tile is fitted (e.g. 'plain' or 'warm').
+        mask : numpy.ndarray or None
+            Pixels outside the mask are considered done from the start.
+        roi : tuple or None
+            The (x_start, x_end, y_start, y_end) region of interest.
+    """
+
+    def __init__(self, filename, cube, shape, algorithm, chunk_size, mode,
+                 mask=None, roi=None):
+
+        parameters = [
+            ('CK_CUBE', os.path.basename(cube), 'Data-cube'),
+            ('CK_KEY', speccache.cube_key(cube), 'Data-cube header, size '
+             'and mtime hash'),
+            ('CK_ALGO', algorithm, 'Algorithm'),
+            ('CK_CHUNK', int(chunk_size), 'Pixels per tile'),
+            ('CK_MODE', mode, 'First guesses'),
+            ('CK_MASK', 0 if mask is None else
+             zlib.crc32(np.packbits(mask).tobytes()), 'Mask checksum'),
+            ('CK_ROI', 'full' if roi is None else
+             ' '.join(str(r) for r in roi), 'Region of interest'),
+        ]
+
+        if os.path.exists(filename):
+            h = pyfits.getheader(filename)
+            for key, value, _ in parameters:
+                if h.get(key) != value:
+                    raise IOError('Checkpoint {:s} was created with a '
+                                  'different {:s} ({} instead of {}). Remove '
+                                  'it to start again.'.format(
+                                      filename, key, h.get(key), value))
+            self._hdul = pyfits.open(filename, mode='update', memmap=True)
+
+        else:
+            h = pyfits.Header()
+            for key, value, comment in parameters:
+                h.set(key, value, comment)
+
+            chunks.create_cube(filename, h, (6,) + tuple(shape),
+                               dtype=np.float64)
+
+            self._hdul = pyfits.open(filename, mode='update', memmap=True)
+            if mask is not None:
+                self.data[:4, ~mask] = np.nan
+                self.data[5, ~mask] = 1
+
+        self.filename = filename
+
+    @property
+    def data(self):
+        return self._hdul[0].data
+
+    @property
+    def done(self):
+        """(Y x X) boolean image with the pixels already fitted."""
+        return self.data[5] > 0
+
+    def is_done(self, tile):
+        y0, y1, x0, x1 = tile
+        return bool(np.all(self.data[5, y0:y1, x0:x1] > 0))
+
+    def save(self, tile, results, n_iter=None):
+        """
+        Store the results of a tile and flush them to disk. The completion
+        flag is written last.
+        """
+        y0, y1, x0, x1 = tile
+        self.data[:4, y0:y1, x0:x1] = results
+        self.data[4, y0:y1, x0:x1] = 0 if n_iter is None else n_iter
+        self.data[5, y0:y1, x0:x1] = 1
+        self._hdul.flush()
+
+    def close(self):
+        self._hdul.close()
+
+
+def load_checkpoint(filename):
+    """
+    Load the partial products stored by `MapCheckpoint`.
+
+    Returns
+    -------
+        results : numpy.ndarray
+            A (4 x Y x X) array. Pixels not fitted yet are filled with NaN.
+        done : numpy.ndarray
+            A (Y x X) boolean image with the pixels already fitted.
+    """
+    data = pyfits.getdata(filename)
+
+    done = data[5] > 0
+    results = np.where(done, data[:4], np.nan)
+
+    return results, done
+
+
+def get_fitter(_input_filename, algorithm, fsr=None):
+    """
+    Return the fitter used by `algorithm`.
+
+    Parameters
+    ----------
+        _input_filename : str
+            Input filename containing the data-cube.
+        algorithm : str
+            One of the algorithms accepted by `perform_2dmap_extraction`.
+        fsr : float or None
+            The free-spectral-range used by the periodic algorithms.
 
+    Returns
+    -------
+        fitter : MyFitter
+    """
     # Using astropy fitter and model ---
-    if algorithm in 'direct':
+    if algorithm == 'direct-vec':
+        fitter = DirectMoments(_input_filename)
+    elif algorithm == 'gaussian-lm':
+        fitter = BatchFitGaussian(_input_filename)
+    elif algorithm == 'lorentzian-lm':
+        fitter = BatchFitLorentzian(_input_filename)
+    elif algorithm == 'gaussian-tpl':
+        fitter = TemplateFitGaussian(_input_filename)
+    elif algorithm == 'lorentzian-tpl':
+        fitter = TemplateFitLorentzian(_input_filename)
+    elif algorithm == 'airy-tpl':
+        fitter = TemplateFitAiry(_input_filename, fsr=fsr)
+    elif algorithm == 'fourier':
+        fitter = FourierMoments(_input_filename, fsr=fsr)
+    elif algorithm in 'direct':
         fitter = DirectMeasure(_input_filename)
     elif algorithm in 'lorentzian':
         fitter = FitLorentzian(_input_filename)
@@ -88,23 +471,520 @@ def perform_2dmap_extraction(_input_filename, log, n=4, algorithm='direct'):
     else:
         raise IOError('Wrong algorithm input: {:s}'.format(algorithm))
 
-    p = Pool(n)
-    results = None
+    return fitter
+
+
+def fit_pyramid(fitter, factors, log, n=4, mask=None, chunk_size=4096):
+    """
+    Fit block-averaged versions of the data-cube from the coarsest to the
+    finest level. The spectra of each level start from the solutions of the
+    previous one (see `MyFitter.warm_guess`) and the coarsest level starts
+    from the brightest channel of each spectrum. The number of spectra, of
+    iterations and the time spent in each level are logged.
+
+    Parameters
+    ----------
+        fitter : MyFitter
+            An iterative fitter (see `MyFitter.fit_from`).
+        factors : list
+            Block-averaging factors, e.g. [8, 4, 2].
+        log : logging.Logger
+        n : int
+            The number of simultaneous processes used by non-vectorised
+            fitters.
+        mask : numpy.ndarray or None
+            A (Y x X) boolean image with the pixels that are averaged.
+        chunk_size : int
+            Number of spectra fitted at once.
+
+    Returns
+    -------
+        guesses : numpy.ndarray
+            A (4 x Y x X) array with the solutions of the finest level
+            upsampled to full resolution, or None if interrupted.
+    """
+    if fitter._data is None:
+        fitter.load()
+
+    height, width = fitter._data.shape[1:]
+    factors = sorted(set(int(f) for f in factors if f > 1), reverse=True)
+
+    pool = None
+    if not fitter.vectorised:
+        pool = Pool(n, initializer=_init_worker, initargs=(fitter,))
+
+    previous = None
+    previous_factor = None
 
-    log.info(' Extracting 2D Maps using: {:s}'.format(algorithm))
-    loading = Process(target=stand_by, name="stand_by", args=[log.level])
-    loading.start()
     try:
-        results = p.map_async(fitter, itertools.product(x, y)).get(99999999)
+        for f in factors:
+
+            t0 = datetime.datetime.now()
+
+            # Block labels of this level ---
+            ny, nx = -(-height // f), -(-width // f)
+            y, x = np.mgrid[:height, :width]
+            labels = (y // f) * nx + x // f
+            if mask is not None:
+                labels[~mask] = -1
+
+            spectra = fitter.read_binned_spectra(labels, chunk_size=65536)
+            spectra = spectra[:ny * nx]
+            inside = np.all(np.isfinite(spectra), axis=1)
+
+            # Solutions of the previous level ---
+            p = np.full((ny * nx, 4), np.nan)
+            if previous is not None:
+                iy = (np.arange(ny) * f) // previous_factor
+                ix = (np.arange(nx) * f) // previous_factor
+                p = previous[:, iy][:, :, ix].reshape((4, -1)).T
+
+            p0 = fitter.warm_guess(spectra[inside], p[inside])
+
+            if pool is None:
+                parts = [fitter.fit_from(spectra[inside][i:i + chunk_size],
+                                         p0[i:i + chunk_size])
+                         for i in range(0, p0.shape[0], chunk_size)]
+            else:
+                parts = pool.map(_fit_from, zip(
+                    np.array_split(spectra[inside], 4 * n),
+                    np.array_split(p0, 4 * n)))
+
+            level = np.full((ny * nx, 4), np.nan)
+            level[inside] = np.concatenate(
+                [np.empty((0, 4))] + [part[0] for part in parts])
+            level_iter = sum(int(part[1].sum()) for part in parts)
+
+            _log_level_cost(log, f, int(inside.sum()), level_iter,
+                            datetime.datetime.now() - t0)
+
+            previous = level.T.reshape((4, ny, nx))
+            previous_factor = f
+
     except KeyboardInterrupt:
         log.info('\n\nYou pressed Ctrl+C!')
         log.info('Leaving now. Bye!\n')
-        pass
-    p.close()
-    p.join()
-    loading.terminate()
+        if pool is not None:
+            pool.terminate()
+        return None
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if previous is None:
+        return np.full((4, height, width), np.nan)
+
+    iy = np.arange(height) // previous_factor
+    ix = np.arange(width) // previous_factor
+
+    return previous[:, iy][:, :, ix]
+
+
+def _log_level_cost(log, factor, n_spectra, n_iter, delta_t):
+    """
+    Report the cost of one pyramid level.
+    """
+    log.info(' Level {:d}x: {:d} spectra, {:d} iterations ({:.1f} per '
+             'spectrum) in {:.1f} s'.format(
+                 factor, n_spectra, n_iter, n_iter / max(n_spectra, 1),
+                 delta_t.total_seconds()))
+
+
+def _fit_bins(fitter, bins, log, n, algorithm, chunk_size):
+    """
+    Fit the average spectrum of each bin and copy the results to its pixels.
+    """
+    spectra = fitter.read_binned_spectra(bins)
+    log.info(' Fitting {:d} bins instead of {:d} pixels.'.format(
+        spectra.shape[0], int(np.sum(bins >= 0))))
+
+    log.info(' Extracting 2D Maps using: {:s}'.format(algorithm))
+    if fitter.vectorised:
+        parts = range(0, spectra.shape[0], chunk_size)
+        p = np.concatenate([np.empty((0, 4))] + [
+            fitter.fit_spectra(spectra[i:i + chunk_size]) for i in parts])
+
+    else:
+        pool = Pool(n, initializer=_init_worker, initargs=(fitter,))
+        try:
+            p = np.concatenate([np.empty((0, 4))] + pool.map(
+                _fit_spectra, np.array_split(spectra, 4 * n)))
+        except KeyboardInterrupt:
+            log.info('\n\nYou pressed Ctrl+C!')
+            log.info('Leaving now. Bye!\n')
+            pool.terminate()
+            return None
+        finally:
+            pool.close()
+            pool.join()
+
+    results = np.full((4,) + bins.shape, np.nan)
+    inside = bins >= 0
+    results[:, inside] = p[bins[inside]].T
+
+    return results
+
+
+def uncertainty_maps(_input_filename, log, algorithm='direct-vec',
+                     n_realisations=100, fsr=None, read_noise=None, gain=1.,
+                     mask=None, chunk_size=None, seed=None, cache=False,
+                     roi=None):
+    """
+    Estimate the uncertainties of the maps with Monte-Carlo simulations. For
+    each tile, `n_realisations` copies of every spectrum are perturbed with
+    noise drawn from a noise model and all of them are measured at once by
+    a vectorised fitter (see `monte_carlo_errors`).
+
+    Parameters
+    ----------
+        _input_filename : str
+            Input filename containing the data-cube.
+        log : logging.Logger
+            A logger instance
+        algorithm : str
+            One of the vectorised algorithms, e.g. 'direct-vec',
+            'gaussian-lm' or 'fourier'.
+        n_realisations : int
+            Number of noise realisations of each spectrum.
+        fsr : float or None
+            The free-spectral-range used by the periodic algorithms.
+        read_noise : float or None
+            The read noise in electrons. If given, the noise of each channel
+            is the read noise plus the Poisson noise of the spectrum.
+            Otherwise, the noise of each spectrum is measured from its
+            scatter along Z (see `samfp.tools.snr.differential_noise`).
+        gain : float
+            The gain in electrons per ADU. Only used with `read_noise`.
+        mask : numpy.ndarray or None
+            A (Y x X) boolean image. Only the pixels where it is True are
+            simulated.
+        chunk_size : int or None
+            Number of pixels simulated at once. Defaults to the chunk size
+            of the fitter divided by `n_realisations`.
+        seed : int or None
+            Seed of the random number generator.
+        cache : bool
+            Read the spectra from the spectral cache of the cube.
+        roi : tuple or None
+            A (x_start, x_end, y_start, y_end) region of interest. See
+            `perform_2dmap_extraction`.
+
+    Returns
+    -------
+        errors : numpy.ndarray
+            A (4 x Y x X) array with the standard deviation of the peak/flux,
+            center, width and continuum over the realisations.
+    """
+    fitter = get_fitter(_input_filename, algorithm, fsr=fsr)
+    fitter.cache = cache
+
+    if not fitter.vectorised:
+        raise IOError('Algorithm {:s} is not vectorised and cannot be used '
+                      'for Monte-Carlo uncertainties.'.format(algorithm))
+
+    header = pyfits.getheader(_input_filename)
+    width = header['NAXIS1']
+    height = header['NAXIS2']
+
+    if roi is not None:
+        roi = chunks.region(height, width, roi)
+        width, height = roi[1] - roi[0], roi[3] - roi[2]
+        fitter.roi = roi
+
+    if mask is not None:
+        mask = _crop(np.asarray(mask, dtype=bool), roi)
+
+    if chunk_size is None:
+        chunk_size = max(1, fitter.chunk_size // n_realisations)
+
+    tasks = []
+    for tile in chunks.iter_tiles(height, width, chunk_size):
+        y0, y1, x0, x1 = tile
+        m = None if mask is None else mask[y0:y1, x0:x1]
+        if m is None or m.any():
+            tasks.append((tile, m))
+
+    log.info(' Estimating uncertainties using {:d} realisations with: '
+             '{:s}'.format(n_realisations, algorithm))
+
+    rng = np.random.default_rng(seed)
+    errors = np.full((4, height, width), np.nan)
+
+    n_pixels = [(t[1] - t[0]) * (t[3] - t[2]) if m is None else int(m.sum())
+                for t, m in tasks]
+    progress = Progress(sum(n_pixels), log, name='Simulating',
+                        unit='spectra')
+
+    for (tile, m), size in zip(tasks, n_pixels):
+
+        y0, y1, x0, x1 = tile
+        spectra = fitter.read_spectra(tile, m).astype(float)
+
+        if read_noise is None:
+            sigma = snr.differential_noise(spectra.T)[:, np.newaxis]
+        else:
+            sigma = np.sqrt((read_noise / gain) ** 2 +
+                            np.maximum(spectra, 0) / gain)
+
+        p = fitter.fit_spectra(spectra)
+        e = monte_carlo_errors(fitter, spectra, p, sigma, n_realisations,
+                               rng=rng)
+
+        errors[:, y0:y1, x0:x1] = fitter.scatter(e, tile, m)
+        progress.update(size)
+
+    progress.finish()
+
+    return errors
+
+
+def monte_carlo_errors(fitter, spectra, p, sigma, n_realisations, rng=None):
+    """
+    Perturb every spectrum `n_realisations` times with Gaussian noise and
+    measure all the realisations in a single call to the fitter. Iterative
+    fitters start from the solutions of the original spectra. The center
+    of periodic fitters is compared modulo their period.
+
+    Parameters
+    ----------
+        fitter : MyFitter
+            A vectorised fitter.
+        spectra : numpy.ndarray
+            A (N x Z) array with one spectrum per row.
+        p : numpy.ndarray
+            A (N x 4) array with the results of the original spectra.
+        sigma : numpy.ndarray
+            The noise of each channel, broadcastable to (N x Z).
+        n_realisations : int
+            Number of realisations of each spectrum.
+        rng : numpy.random.Generator or None
+            The random number generator.
+
+    Returns
+    -------
+        errors : numpy.ndarray
+            A (N x 4) array with the standard deviation of the results over
+            the realisations.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    n, depth = spectra.shape
+    noise = rng.standard_normal((n_realisations, n, depth)) * sigma
+    realisations = (spectra + noise).reshape((-1, depth))
+
+    if fitter.iterative:
+        q = fitter.fit_from(realisations, np.tile(p, (n_realisations, 1)))[0]
+    else:
+        q = fitter.fit_spectra(realisations)
 
-    return np.array(results)
+    deviation = q.reshape((n_realisations, n, 4)) - p
+
+    period = getattr(fitter, 'period', None)
+    if period is not None:
+        deviation[..., 1] = np.mod(deviation[..., 1] + period / 2., period) \
+            - period / 2.
+
+    # Pixels without any valid realisation are left as NaN ---
+    with np.errstate(all='ignore'):
+        valid = np.isfinite(deviation)
+        count = valid.sum(axis=0)
+        deviation = np.where(valid, deviation, 0)
+        mean = deviation.sum(axis=0) / count
+        variance = np.sum(np.where(valid, (deviation - mean) ** 2, 0),
+                          axis=0) / (count - 1)
+
+    return np.where(count > 1, np.sqrt(variance), np.nan)
+
+
+def build_bins(_input_filename, target_snr, mask=None, output=None,
+               log=None):
+    """
+    Adaptive binning of the data-cube pixels to a target signal-to-noise
+    using `samfp.tools.voronoi.voronoi_bins`. Pixels that already reach the
+    target keep their own bin.
+
+    The signal-to-noise of a bin is the one of its summed spectrum, as given
+    by `samfp.tools.snr.signal_to_noise`. The peak above the median is not
+    additive, so it cannot be added pixel by pixel. The spectra are read
+    once as a (Y x X x Z) array and each bin keeps its running summed
+    spectrum, so every candidate pixel only adds its own spectrum.
+
+    If no bin reaches 80% of the target, the pixels are fitted one by one.
+
+    Parameters
+    ----------
+        _input_filename : str
+            Input filename containing the data-cube.
+        target_snr : float
+            The signal-to-noise that each bin should reach.
+        mask : numpy.ndarray or None
+            A (Y x X) boolean image with the pixels that can be binned. It
+            avoids merging sky-only regions into the bins.
+        output : str or None
+            If given, the bins image is saved to this file so it can be used
+            again with `load_bins`.
+        log : logging.Logger or None
+
+    Returns
+    -------
+        bins : numpy.ndarray
+            A (Y x X) integer image with the bin of each pixel or -1.
+    """
+    log = logging.getLogger(__name__) if log is None else log
+
+    signal, noise = snr.snr_map(_input_filename, split=True)
+
+    data = pyfits.getdata(_input_filename, memmap=True)
+    depth, height, width = data.shape
+
+    spectra = np.empty((height, width, depth), dtype=np.float32)
+    for y0, y1, x0, x1 in chunks.iter_tiles(height, width, 65536):
+        spectra[y0:y1, x0:x1] = np.moveaxis(data[:, y0:y1, x0:x1], 0, -1)
+
+    del data
+
+    def sn_func(totals):
+        return snr.signal_to_noise(totals.T)
+
+    bins = voronoi.voronoi_bins(signal, noise, target_snr, mask=mask,
+                                spectra=spectra, sn_func=sn_func)
+    del spectra
+
+    # Without any accepted bin, the faint pixels are left out ---
+    unbinned = (bins < 0) & np.isfinite(signal) & np.isfinite(noise) & \
+        (noise > 0)
+    if mask is not None:
+        unbinned &= mask
+
+    if unbinned.any():
+        log.warning('No bin reached 80% of the target signal-to-noise '
+                    '({:.1f}). Fitting {:d} pixels one by one.'.format(
+                        0.8 * target_snr, int(unbinned.sum())))
+        bins[unbinned] = bins.max() + 1 + np.arange(unbinned.sum())
+
+    if output is not None:
+        h = pyfits.Header()
+        h.set('BIN_SNR', target_snr, 'Target signal-to-noise')
+        h.set('BIN_CUBE', os.path.basename(_input_filename), 'Data-cube')
+        h.set('BIN_N', int(bins.max() + 1), 'Number of bins')
+
+        pyfits.writeto(output, bins.astype(np.int32), h, overwrite=True)
+
+    return bins
+
+
+def load_bins(filename):
+    """
+    Load the bins saved by `build_bins`.
+
+    Returns
+    -------
+        bins : numpy.ndarray
+            A (Y x X) integer image.
+    """
+    return pyfits.getdata(filename).astype(int)
+
+
+def build_mask(_input_filename, threshold, output=None):
+    """
+    Find the pixels with emission using the signal-to-noise of each spectrum
+    (see `samfp.tools.snr.signal_to_noise`).
+
+    Parameters
+    ----------
+        _input_filename : str
+            Input filename containing the data-cube.
+        threshold : float
+            Minimum signal-to-noise of the pixels that will be fitted.
+        output : str or None
+            If given, the mask is saved to this file so it can be used again
+            with `load_mask`. The signal-to-noise image is saved in the 'SNR'
+            extension.
+
+    Returns
+    -------
+        mask : numpy.ndarray
+            A (Y x X) boolean image.
+    """
+    snr_image = snr.snr_map(_input_filename)
+    mask = snr_image >= threshold
+
+    if output is not None:
+        h = pyfits.Header()
+        h.set('SNR_THR', threshold, 'Signal-to-noise threshold')
+        h.set('SNR_CUBE', os.path.basename(_input_filename), 'Data-cube')
+
+        hdul = pyfits.HDUList([
+            pyfits.PrimaryHDU(data=mask.astype(np.uint8), header=h),
+            pyfits.ImageHDU(data=snr_image.astype(np.float32), name='SNR')])
+        hdul.writeto(output, overwrite=True)
+
+    return mask
+
+
+def load_mask(filename):
+    """
+    Load a mask saved by `build_mask`.
+
+    Returns
+    -------
+        mask : numpy.ndarray
+            A (Y x X) boolean image.
+    """
+    return pyfits.getdata(filename, 0).astype(bool)
+
+
+def correct_phase_map(center, header, phase_map, fsr=None, roi=None):
+    """
+    Correct the line centers measured on a data-cube that was not
+    phase-corrected. The phase-map displacement is subtracted from each center
+    and the result is wrapped within one free-spectral-range starting at the
+    beginning of the cube Z axis.
+
+    Parameters
+    ----------
+        center : numpy.ndarray
+            A (Y x X) map with the line centers in the units of the cube Z
+            axis.
+        header : astropy.io.fits.Header
+            The data-cube header.
+        phase_map : str or samfp.phmap.PhaseMap
+            A phase-map filename (image or header-only fit) or object.
+        fsr : float or None
+            The free-spectral-range in the units of the cube Z axis (e.g.
+            Angstrom). The phase-map is scaled from `PHM_FSR` to these units. If
+            None, the cube and the phase-map are considered to have the same
+            units and `PHM_FSR` is used.
+        roi : tuple or None
+            The (x_start, x_end, y_start, y_end) region of interest of the
+            cube covered by `center`.
+
+    Returns
+    -------
+        center : numpy.ndarray
+            The corrected line centers.
+    """
+    if not isinstance(phase_map, phmap.PhaseMap):
+        phase_map = phmap.load_phase_map(phase_map)
+
+    shape = center.shape if roi is None else \
+        (header['NAXIS2'], header['NAXIS1'])
+    dz = phase_map(shape, binning=phmap.get_binning(header), region=roi)
+
+    phm_fsr = float(phase_map.header['PHM_FSR'])
+    if fsr is None:
+        fsr = phm_fsr
+    else:
+        dz = dz * fsr / phm_fsr
+
+    z = (np.arange(header['NAXIS3']) - header['CRPIX3'] - 1) * \
+        header['CDELT3'] + header['CRVAL3']
+    z0 = z.min()
+
+    return z0 + np.mod(center - dz - z0, fsr)
 
 
 def clean_header(header):
@@ -182,6 +1062,16 @@ def parse_arguments():
             - pool_size (int)
             - quiet (bool)
             - output (str|None)
+            - phase_map (str|None)
+            - fsr (float|None)
+            - snr (float|None)
+            - mask (str|None)
+            - bin_snr (float|None)
+            - bins (str|None)
+            - warm_start (bool)
+            - pyramid (list|None)
+            - checkpoint (str|None)
+            - roi (list|None)
     """
     from argparse import ArgumentParser
 
@@ -192,8 +1082,35 @@ def parse_arguments():
     )
     parser.add_argument(
         '-a', '--algorithm', type=str, default='direct', nargs='?',
-        const='direct', help="Use [lorentzian|gaussian|direct] to find" +
-                             "the maps. 'direct' is the default"
+        const='direct', help="Use [lorentzian|gaussian|direct] to find the "
+                             "maps. 'direct' is the default. The vectorised "
+                             "variants 'direct-vec', 'gaussian-lm' and "
+                             "'lorentzian-lm' are much faster. "
+                             "'gaussian-tpl', 'lorentzian-tpl' and 'airy-tpl' "
+                             "match the spectra against a bank of templates. "
+                             "'fourier' measures periodic spectra from their "
+                             "first Fourier harmonics."
+    )
+    parser.add_argument(
+        '-b', '--bin_snr', type=float, default=None,
+        help="Group neighbouring pixels with Voronoi binning until they reach "
+             "this signal-to-noise and fit each bin only once. Combine with "
+             "--snr to leave the sky out of the bins."
+    )
+    parser.add_argument(
+        '-B', '--bins', type=str, default=None,
+        help="Bins file. It is created when --bin_snr is given. Otherwise, "
+             "existing bins are used."
+    )
+    parser.add_argument(
+        '-c', '--checkpoint', type=str, default=None,
+        help="Checkpoint file where completed tiles are saved. If it exists, "
+             "the extraction resumes from it."
+    )
+    parser.add_argument(
+        '-C', '--cache', action='store_true',
+        help="Read the spectra from a spectral cache of the cube, built on "
+             "the first use. Faster for cubes larger than the memory."
     )
     parser.add_argument(
         '-d', '--debug', action='store_true',
@@ -202,189 +1119,322 @@ def parse_arguments():
     parser.add_argument(
         'filename', type=str, help="Input data-cube name."
     )
+    parser.add_argument(
+        '-e', '--errors', type=int, default=None, nargs='?', const=100,
+        help="Estimate the uncertainties of the maps with this number of "
+             "Monte-Carlo realisations of each spectrum (100 by default). "
+             "Only for the vectorised algorithms."
+    )
+    parser.add_argument(
+        '-f', '--fsr', type=float, default=None,
+        help="Free-spectral-range in the units of the cube Z axis. Used with "
+             "--phase_map when the cube and the phase-map units differ."
+    )
+    parser.add_argument(
+        '-g', '--gain', type=float, default=1.,
+        help="Gain in electrons per ADU used with --read_noise."
+    )
+    parser.add_argument(
+        '-k', '--mask', type=str, default=None,
+        help="Mask file. It is created when --snr is given. Otherwise, an "
+             "existing mask is used to select the pixels that are fitted."
+    )
+    parser.add_argument(
+        '-m', '--phase_map', type=str, default=None,
+        help="Phase-map (image or header-only fit) used to correct the line "
+             "centers of a cube that was not phase-corrected."
+    )
     parser.add_argument(
         '-o', '--output', default=None, type=str,
-        help='Number of the output file. Each map is saved inside a different '
-             'extention. If not given, a new file is created for each 2d-map.'
+        help='Name of the output file. Each map is saved inside a different '
+             'extention. If not given, the input name is appended with the '
+             'algorithm prefix and \'maps\' (e.g. cube.Gmaps.fits).'
     )
     parser.add_argument(
         '-p', '--pool_size', default=4, type=int,
         help='Number of parallel processes (Default: 4)'
     )
+    parser.add_argument(
+        '-P', '--pyramid', type=int, nargs='+', default=None,
+        help="Block-averaging factors (e.g. 8 4 2) for a coarse-to-fine "
+             "extraction. Each level starts from the solutions of the "
+             "previous one. Only for the Gaussian and Lorentzian fits."
+    )
     parser.add_argument(
         '-q', '--quiet', action='store_true',
         help="Run program quietly. true/[FALSE]"
     )
+    parser.add_argument(
+        '-r', '--read_noise', type=float, default=None,
+        help="Read noise in electrons. If given, the Monte-Carlo "
+             "realisations use read plus Poisson noise. Otherwise, the noise "
+             "is measured along the spectra."
+    )
+    parser.add_argument(
+        '-R', '--roi', type=int, nargs=4, default=None,
+        metavar=('X_BEGIN', 'X_END', 'Y_BEGIN', 'Y_END'),
+        help="Extract the maps only inside this region of interest, in "
+             "pixels starting from 0 with the end column and row excluded. "
+             "Only the spectra inside it are read."
+    )
+    parser.add_argument(
+        '-s', '--snr', type=float, default=None,
+        help="Fit only the pixels whose peak over the robust noise along Z is "
+             "above this value. The others are filled with NaN."
+    )
+    parser.add_argument(
+        '-W', '--warm_start', action='store_true',
+        help="Start each fit from the solutions of its neighbours and save "
+             "the number of iterations of each pixel. Only for the "
+             "Gaussian and Lorentzian fits."
+    )
     parser.add_argument(
         '-w', '--wavelength', type=float, default=None,
         help="The rest wavelength if you want to get your maps in km/s instead."
     )
+    parser.add_argument(
+        '-z', '--compress', type=str, default=None, nargs='?',
+        const='GZIP_2', help="Tile-compress the output maps using this "
+                             "compression type. GZIP_2 (the default) is "
+                             "lossless. RICE_1 is smaller but quantizes the "
+                             "maps."
+    )
     args = parser.parse_args()
 
     return args
 
 
-def stand_by(level=logging.NOTSET):
-    """
-    A silly method that keeps the terminal alive so the user knows that
-    this programs is still running. :-)
-    """
-    from time import sleep
-
-    output = ['/', '-', '\\', '|']
-    i = 0
-
-    if level in [logging.NOTSET, logging.WARN, logging.ERROR]:
-        return
-
-    while True:
-        sys.stdout.write("\r [{:s}]".format(output[i]))
-        sys.stdout.flush()
-        sleep(0.5)
-        i += 1
-        i %= 4
-
-    return
-
-
 def write_results(_results, _input_file, _output_file, algorithm='direct',
-                  wavelength=None):
-
+                  wavelength=None, done=None, errors=None, mask=None,
+                  compress=None, roi=None):
     """
-    Write the results to one or more FITS file.
+    Write the maps into a single multi-extension FITS file. The primary HDU
+    holds the input header without data and each map, uncertainty map and
+    mask is saved in its own float32 (or uint8, for the masks) extension.
 
     _results : numpy.ndarray
-        A (X x Y x 3) numpy.ndarray that contains the results of the
-        Gaussian fitting process performed in every pixel.
+        A (4 x Y x X) numpy.ndarray that contains the peak/flux, center, width
+        and continuum measured in every pixel.
     _input_file : str
         The orginal input filename.
     _output_file : None or str
-        If _output_file is a string, then all the results are stored inside a
-        single FITS file with the name stored in it. Each result will be saved
-        in a different extention.
-
-        If _output_file is None, then the original name is appended with '.m*'
-        and a single file is used to store each results. '.m0' contains the
-        Gaussian peak value, '.m1' contains the Gaussian center and '.m2'
-        contains the Gaussian stddev.
-    Gaussian : bool
-        Use Gaussian instead of Lorentzian
+        The output filename. If _output_file is None, the original name is
+        appended with '.Dmaps', '.Gmaps', etc., depending on the algorithm.
+    algorithm : str
+        The algorithm used to measure the maps. It sets the names of the
+        extensions.
     wavelength : float / None
         If the wavelength is given, this method automatically convert the maps
         from Angstrom to km/s.
+    done : numpy.ndarray / None
+        A (Y x X) boolean completion mask of partial products (see
+        `load_checkpoint`). It is saved as a 'DONE' extension and the fraction
+        of completed pixels is stored in the MAPDONE card.
+    errors : numpy.ndarray / None
+        A (4 x Y x X) array with the uncertainties of the maps. They are saved
+        in the '*_ERR' extensions.
+    mask : numpy.ndarray / None
+        A (Y x X) boolean array with the pixels that were measured (see
+        `build_mask`). It is saved as a 'MASK' extension.
+    compress : str / None
+        Tile compression type (e.g. 'GZIP_2' or 'RICE_1'). GZIP keeps the
+        float maps lossless while the other types quantize them to 1/16 of
+        their noise.
+    roi : tuple / None
+        The (x_start, x_end, y_start, y_end) region of interest covered by
+        the maps. The spatial reference pixels of the header are moved to it.
     """
     from astropy import constants
 
-    header = pyfits.getheader(_input_file)
-    header = clean_header(header)
-    x = int(header['NAXIS1'])
-    y = int(header['NAXIS2'])
+    prefix, names = _map_names(algorithm)
 
-    m0 = _results[:, 0]  # Amplitude
-    m1 = _results[:, 1]  # Mean
-    m2 = _results[:, 2]  # STDDEV
-    m3 = _results[:, 3]  # CONT
-
-    m0 = m0.reshape((x, y)).T
-    m1 = m1.reshape((x, y)).T
-    m2 = m2.reshape((x, y)).T
-    m3 = m3.reshape((x, y)).T
+    if _output_file is None:
+        _output_file = _input_file.replace(
+            '.fits', '.{:s}maps.fits'.format(prefix))
 
-    m0 = np.array(m0, dtype=np.float32)
-    m1 = np.array(m1, dtype=np.float32)
-    m2 = np.array(m2, dtype=np.float32)
-    m3 = np.array(m3, dtype=np.float32)
+    header = pyfits.getheader(_input_file)
+    if roi is not None:
+        header = ztools.xy_crop_header(header, header['NAXIS1'],
+                                       header['NAXIS2'], roi)
 
-    h1 = header
-    h2 = header
+    header = clean_header(header)
+    if done is not None:
+        header.set('MAPDONE', float(np.mean(done)),
+                   'Fraction of completed pixels')
 
-    h1.append("M1_MEAN", np.mean(m1))
-    h1.append("M1_STDEV", np.std(m1))
+    units = 'Angstrom' if wavelength is None else 'km/s'
+    to_velocity = None if wavelength is None else \
+        constants.c.to('km/s').value / wavelength
 
-    h2.append("M2_MEAN", np.mean(m2))
-    h2.append("M2_STDEV", np.std(m2))
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=header)])
 
-    # Using astropy fitter and model ---
-    if algorithm in 'direct':
-        i = 'D'
-    elif algorithm in 'lorentzian':
-        i = 'L'
-    elif algorithm in 'gaussian':
-        i = 'G'
-    else:
-        raise IOError('Wrong algorithm input: {:s}'.format(algorithm))
+    planes = [(name, _results[k], k, False) for k, name in enumerate(names)]
+    if errors is not None:
+        planes += [(name + '_ERR', errors[k], k, True)
+                   for k, name in enumerate(names)]
 
-    if wavelength is not None:
+    for name, data, k, is_error in planes:
 
-        m1 = (m1 - wavelength) / wavelength * constants.c.to('km/s').value
-        m2 = m2 / wavelength * constants.c.to('km/s').value
+        data = np.array(data, dtype=np.float32)
+        h = header.copy()
 
-        h1.set('UNITS', 'km/s')
-        h2.set('UNITS', 'km/s')
+        # Center and width ---
+        if k in [1, 2]:
 
-    else:
+            if to_velocity is not None:
+                if k == 1 and not is_error:
+                    data -= wavelength
+                data *= to_velocity
 
-        h1.set('UNITS', 'Angstrom')
-        h2.set('UNITS', 'Angstrom')
+            h.set('UNITS', units)
+            if not is_error:
+                _set_statistics(h, 'M{:d}'.format(k), data)
 
-    if _output_file is None:
+        hdul.append(_image_hdu(data, h, name, compress))
 
-        pyfits.writeto(
-            _input_file.replace('.fits', '.{:s}m0.fits'.format(i)), data=m0,
-            header=header, clobber=True
-        )
-        pyfits.writeto(
-            _input_file.replace('.fits', '.{:s}m1.fits'.format(i)), data=m1,
-            header=h1, clobber=True
-        )
-        pyfits.writeto(
-            _input_file.replace('.fits', '.{:s}m2.fits'.format(i)), data=m2,
-            header=h2, clobber=True
-        )
-        pyfits.writeto(
-            _input_file.replace('.fits', '.{:s}m3.fits'.format(i)), data=m3,
-            header=header, clobber=True
-        )
+    for name, data in [('MASK', mask), ('DONE', done)]:
+        if data is not None:
+            hdul.append(_image_hdu(np.asarray(data, dtype=np.uint8), None,
+                                   name, compress))
 
-    else:
-        if algorithm in 'direct':
-            HDUl = pyfits.HDUList()
-            HDUl.append(pyfits.PrimaryHDU(header))
-            HDUl.append(pyfits.ImageHDU(data=m0, name='Direct_Peak'))
-            HDUl.append(pyfits.ImageHDU(data=m1, name='Center',
-                                        header=h1))
-            HDUl.append(pyfits.ImageHDU(data=m2, name='STDDEV',
-                                        header=h2))
-            HDUl.append(pyfits.ImageHDU(data=m3, name='CONT',
-                                        header=header))
-            HDUl.writeto(_output_file, clobber=True)
-
-        elif algorithm in 'lorentzian':
-            HDUl = pyfits.HDUList()
-            HDUl.append(pyfits.PrimaryHDU(header))
-            HDUl.append(pyfits.ImageHDU(data=m0, name='Lorentzian_Peak'))
-            HDUl.append(pyfits.ImageHDU(data=m1, name='Lorentzian_Center',
-                                        header=h1))
-            HDUl.append(pyfits.ImageHDU(data=m2, name='Lorentzian_STDDEV',
-                                        header=h2))
-            HDUl.append(pyfits.ImageHDU(data=m3, name='Lorentzian_CONT',
-                                        header=header))
-            HDUl.writeto(_output_file, clobber=True)
-
-        elif algorithm in 'gaussian':
-            HDUl = pyfits.HDUList()
-            HDUl.append(pyfits.PrimaryHDU(header))
-            HDUl.append(pyfits.ImageHDU(data=m0, name='Gaussian_Peak'))
-            HDUl.append(pyfits.ImageHDU(data=m1, name='Gaussian_Center',
-                                        header=h1))
-            HDUl.append(pyfits.ImageHDU(data=m2, name='Gaussian_STDDEV',
-                                        header=h2))
-            HDUl.append(pyfits.ImageHDU(data=m3, name='Gaussian_CONT',
-                                        header=header))
-            HDUl.writeto(_output_file, clobber=True)
+    hdul.writeto(_output_file, overwrite=True)
 
+    return _output_file
 
-class MyFitter:
+
+def _map_names(algorithm):
+    """
+    Return the filename prefix and the extension names of the maps measured
+    with `algorithm`.
+    """
+    # Vectorised variants (e.g. 'direct-vec') produce the same maps ---
+    algorithm = algorithm.split('-')[0]
+
+    if algorithm in 'direct':
+        return 'D', ['Direct_Peak', 'Center', 'STDDEV', 'CONT']
+    elif algorithm in 'lorentzian':
+        return 'L', ['Lorentzian_Peak', 'Lorentzian_Center',
+                     'Lorentzian_STDDEV', 'Lorentzian_CONT']
+    elif algorithm in 'gaussian':
+        return 'G', ['Gaussian_Peak', 'Gaussian_Center', 'Gaussian_STDDEV',
+                     'Gaussian_CONT']
+    elif algorithm == 'airy':
+        return 'A', ['Airy_Peak', 'Airy_Center', 'Airy_FWHM', 'Airy_CONT']
+    elif algorithm == 'fourier':
+        return 'F', ['Fourier_Peak', 'Fourier_Center', 'Fourier_FWHM',
+                     'Fourier_CONT']
+
+    raise IOError('Wrong algorithm input: {:s}'.format(algorithm))
+
+
+def _set_statistics(header, key, data):
+    """
+    Store the mean and the standard deviation of the valid pixels of a map.
+    """
+    data = data[np.isfinite(data)]
+    if data.size > 0:
+        header.set('{:s}_MEAN'.format(key), float(np.mean(data)))
+        header.set('{:s}_STDEV'.format(key), float(np.std(data)))
+
+
+def _image_hdu(data, header, name, compress=None):
+
+    if compress is None:
+        return pyfits.ImageHDU(data=data, header=header, name=name)
+
+    # Quantization of floats is lossy ---
+    quantize_level = 0. if compress.startswith('GZIP') else 16.
+
+    return pyfits.CompImageHDU(data=data, header=header, name=name,
+                               compression_type=compress,
+                               quantize_level=quantize_level)
+
+
+def _crop(image, roi):
+    """
+    Return the part of a (Y x X) image inside a normalised region of
+    interest.
+    """
+    if roi is None:
+        return image
+
+    x0, x1, y0, y1 = roi
+    return image[y0:y1, x0:x1]
+
+
+def _init_worker(fitter):
+    """
+    Load the data-cube once per worker process.
+    """
+    global _fitter
+    _fitter = fitter
+    _fitter.load()
+
+
+def _fit_tile(task):
+    """
+    Fit all the spectra inside a (y_start, y_end, x_start, x_end) tile. The
+    task is a (tile, mask, mode) tuple (see `_run_task`).
+    """
+    return _run_task(_fitter, task)
+
+
+def _run_task(fitter, task):
+    """
+    Fit a (tile, mask, mode) task. The mode is None for `fit_tile`, a
+    boolean `warm_start` for `fit_tile_warm` or an array of first guesses
+    for `fit_tile_from`.
+
+    Returns
+    -------
+        tile : tuple
+        results : numpy.ndarray
+        n_iter : numpy.ndarray or None
+    """
+    tile, mask, mode = task
+
+    if mode is None:
+        return tile, fitter.fit_tile(tile, mask=mask), None
+
+    if isinstance(mode, np.ndarray):
+        results, n_iter = fitter.fit_tile_from(tile, mode, mask=mask)
+    else:
+        results, n_iter = fitter.fit_tile_warm(tile, mask=mask,
+                                               warm_start=mode)
+
+    return tile, results, n_iter
+
+
+def _fit_spectra(spectra):
+    """
+    Fit a (N x Z) array of spectra.
+    """
+    return _fitter.fit_spectra(spectra)
+
+
+def _fit_from(args):
+    """
+    Fit a (N x Z) array of spectra starting from (N x 4) first guesses.
+    """
+    spectra, p0 = args
+    return _fitter.fit_from(spectra, p0)
+
+
+class MyFitter:
+
+    # Does `fit_tile` measure all the spectra at once?
+    vectorised = False
+    chunk_size = None
+
+    # Can the fit start from any first guess (see `fit_from`)?
+    iterative = False
+    width = None
+
+    # Read the spectra from the spectral cache of the cube?
+    cache = False
+
+    # Only read a (x_start, x_end, y_start, y_end) region of the cube?
+    roi = None
 
     def __init__(self, filename):
         """
@@ -396,6 +1446,8 @@ class MyFitter:
                 fitting.
         """
         self._filename = filename
+        self._data = None
+        self._z = None
 
         # Load the data and do some pre-processing ---
         data = pyfits.getdata(self._filename, memmap=True)
@@ -409,22 +1461,20 @@ class MyFitter:
         max_args = signal.argrelmax(s, order=3)[0]
 
         # Get the top of the top ---
+        if max_args.size == 0:
+            max_args = np.array([np.argmax(s)])
+
         max_s = s[max_args]
-        max_arg = np.argmax(max_s)
+        max_arg = max_args[np.argmax(max_s)]
         self._argmax = max_arg
         self._left = 0
         self._right = s.size - 1
 
-        # Find the safe window ---
-        if len(max_args) > 1:
-
-            max_differences = max_arg - max_args
-            print(max_differences)
-
-            max_left = max_differences[max_differences < 0]
-
-
-class FitGaussian(MyFitter):
+    def __getstate__(self):
+        # The memory-mapped data is loaded again by each process
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
 
     def __call__(self, indexes):
         """
@@ -437,117 +1487,430 @@ class FitGaussian(MyFitter):
         Returns
         -------
             results : list
-                A list containing the numerical values of the three gaussian
-                parameters met in the fitting processes `peak`, `mean` and
-                `stddev`.
+                A list containing the numerical values of the four parameters
+                met in the fitting processes.
         """
+        if self._data is None:
+            self.load()
+
         i, j = indexes
-        data = pyfits.getdata(self._filename, memmap=True)
-        s = data[self._left:self._right, j, i]
+        return self.fit(self._data[self._left:self._right, j, i])
+
+    def load(self):
+        """
+        Memory-map the data-cube, or its spectral cache, and calculate its Z
+        axis.
+        """
+        self._data = speccache.open_cube(self._filename, cache=self.cache,
+                                         roi=self.roi)
 
         h = pyfits.getheader(self._filename)
-        self._z = \
-            (np.arange(s.size) - h['CRPIX3'] - 1) * h['CDELT3'] + h['CRVAL3']
+        n = self._right - self._left
+        self._z = (np.arange(n) - h['CRPIX3'] - 1) * h['CDELT3'] + h['CRVAL3']
 
-        del data
-        del h
+    def fit(self, s):
+        """
+        Measure the line parameters in a single spectrum.
 
-        # Calculate the continuun --
-        cont = stats.mode(s)[0]
+        Parameter
+        ---------
+            s : numpy.ndarray
+                The spectrum within the [_left:_right] window.
+
+        Returns
+        -------
+            results : list
+                The peak/flux, center, width and continuum.
+        """
+        raise NotImplementedError
+
+    def fit_tile(self, tile, mask=None):
+        """
+        Parameter
+        ---------
+            tile : tuple
+                (y_start, y_end, x_start, x_end) using Python's slicing
+                convention.
+            mask : numpy.ndarray or None
+                A boolean image with the tile shape. Only the pixels where it
+                is True are fitted.
+        Returns
+        -------
+            results : numpy.ndarray
+                A (4 x Y x X) array with the results of `fit` for each pixel.
+                Pixels outside the mask are filled with NaN.
+        """
+        spectra = self.read_spectra(tile, mask)
+
+        return self.scatter(self.fit_spectra(spectra), tile, mask)
+
+    def fit_spectra(self, spectra):
+        """
+        Parameter
+        ---------
+            spectra : numpy.ndarray
+                A (N x Z) array with one spectrum, within the [_left:_right]
+                window, per row.
+        Returns
+        -------
+            results : numpy.ndarray
+                A (N x 4) array with the results of `fit` for each spectrum.
+        """
+        results = [np.hstack(self.fit(s)) for s in spectra]
+
+        return np.array(results, dtype=float).reshape((-1, 4))
 
-        arg_max = self._argmax
-        amp = s[arg_max]
-        avg = self._z[arg_max]
+    def first_guess(self, spectra):
+        """
+        The same first guesses for every spectrum: the amplitude and the
+        position of the brightest channel of the whole cube, a fixed width
+        and the mode as continuum.
 
-        fitter = fitting.LevMarLSQFitter()
-        g = models.Gaussian1D(amplitude=amp, mean=avg, stddev=2.0) + \
-            models.Const1D(amplitude=cont)
+        Returns
+        -------
+            p0 : numpy.ndarray
+                A (N x 4) array.
+        """
+        p0 = np.empty((spectra.shape[0], 4))
+        p0[:, 0] = spectra[:, self._argmax]
+        p0[:, 1] = self._z[self._argmax]
+        p0[:, 2] = self.width
+        p0[:, 3] = np.ravel(stats.mode(spectra, axis=1)[0])
 
-        g = fitter(g, self._z, s)
+        return p0
 
-        if  fitter.fit_info['ierr'] not in [1, 2, 3, 4]:
-            return [np.nan, np.nan, np.nan, np.nan]
+    def seed_guess(self, spectra, p):
+        """
+        First guesses that keep the center and the width of nearby solutions
+        `p`. The amplitude and the continuum are measured on the spectra.
 
-        return [g.amplitude_0.value, g.mean_0.value, g.stddev_0.value,
-                g.amplitude_1.value]
+        Returns
+        -------
+            p0 : numpy.ndarray
+                A (N x 4) array.
+        """
+        channel = np.argmin(np.abs(self._z - p[:, 1:2]), axis=1)
+        cont = np.ravel(stats.mode(spectra, axis=1)[0])
 
+        p0 = np.empty((spectra.shape[0], 4))
+        p0[:, 0] = spectra[np.arange(spectra.shape[0]), channel] - cont
+        p0[:, 1] = p[:, 1]
+        p0[:, 2] = p[:, 2]
+        p0[:, 3] = cont
 
-class FitLorentzian(MyFitter):
+        return p0
 
-    def __call__(self, indexes):
+    def good_solutions(self, p):
         """
         Parameter
         ---------
-            indexes : tuple
-                Contains two integers that correspond to the X and Y indexes
-                that will be used to extract the spectrum from the data-cube and
-                fits a gaussian to this extracted spectrum.
+            p : numpy.ndarray
+                A (4 x ...) array of solutions.
         Returns
         -------
-            results : list
-                A list containing the numerical values of the three gaussian
-                parameters met in the fitting processes `peak`, `mean` and
-                `stddev`.
+            good : numpy.ndarray
+                True where the amplitude and the width are positive and the
+                center is inside the spectral range.
         """
-        i, j = indexes
-        data = pyfits.getdata(self._filename, memmap=True)
-        s = data[self._left:self._right, j, i]
+        with np.errstate(invalid='ignore'):
+            return (p[0] > 0) & (p[2] > 0) & (p[1] >= self._z.min()) & \
+                (p[1] <= self._z.max())
 
-        h = pyfits.getheader(self._filename)
-        self._z = \
-            (np.arange(s.size) - h['CRPIX3'] - 1) * h['CDELT3'] + h['CRVAL3']
+    def warm_guess(self, spectra, p):
+        """
+        Same as `seed_guess`, but spectra whose solution in `p` is not good
+        (see `good_solutions`) start from their own brightest channel.
 
-        del data
-        del h
+        Returns
+        -------
+            p0 : numpy.ndarray
+                A (N x 4) array.
+        """
+        good = self.good_solutions(p.T)
 
-        # Calculate the continuun --
-        cont = stats.mode(s)[0]
+        q = np.zeros((spectra.shape[0], 4))
+        q[:, 1] = self._z[np.argmax(spectra, axis=1)]
+        q[:, 2] = self.width
+        q[good] = p[good]
 
-        # Get the first guess parameters --
-        arg_max = self._argmax
-        amplitude = s[arg_max]
-        x_0 = self._z[arg_max]
+        return self.seed_guess(spectra, q)
 
-        fitter = fitting.LevMarLSQFitter()
-        my_model = models.Lorentz1D(amplitude=amplitude, x_0=x_0, fwhm=5.0) + \
-                    models.Const1D(amplitude=cont)
+    def fit_tile_from(self, tile, guesses, mask=None):
+        """
+        Fit a tile starting from previous solutions (see `warm_guess`).
 
-        fitted = fitter(my_model, self._z, s)
+        Parameter
+        ---------
+            tile : tuple
+                (y_start, y_end, x_start, x_end) using Python's slicing
+                convention.
+            guesses : numpy.ndarray
+                A (4 x Y x X) array with previous solutions.
+            mask : numpy.ndarray or None
+                A boolean image with the tile shape. Only the pixels where it
+                is True are fitted.
+        Returns
+        -------
+            results : numpy.ndarray
+                A (4 x Y x X) array.
+            n_iter : numpy.ndarray
+                A (Y x X) array with the number of iterations of each fit.
+        """
+        y0, y1, x0, x1 = tile
+        spectra = self.read_spectra(tile, mask)
 
-        if  fitter.fit_info['ierr'] not in [1, 2, 3, 4]:
-            return [np.nan, np.nan, np.nan, np.nan]
+        p = guesses.reshape((4, -1)).T
+        if mask is not None:
+            p = p[np.ravel(mask)]
 
-        return [fitted.amplitude_0.value, fitted.x_0_0.value,
-                fitted.fwhm_0.value, fitted.amplitude_1.value]
+        p, n_iter = self.fit_from(spectra, self.warm_guess(spectra, p))
 
+        n = np.zeros((y1 - y0) * (x1 - x0), dtype=int)
+        n[slice(None) if mask is None else np.ravel(mask)] = n_iter
 
-class DirectMeasure(MyFitter):
+        return self.scatter(p, tile, mask), n.reshape((y1 - y0, x1 - x0))
 
-    def __call__(self, indexes):
+    def fit_from(self, spectra, p0):
         """
+        Fit the spectra starting from the given first guesses.
+
         Parameter
         ---------
-            indexes : tuple
-                Contains two integers that correspond to the X and Y indexes
-                that will be used to extract the spectrum from the data-cube and
-                fits a gaussian to this extracted spectrum.
+            spectra : numpy.ndarray
+                A (N x Z) array.
+            p0 : numpy.ndarray
+                A (N x 4) array with the first guesses.
         Returns
         -------
-            results : list
-                A list containing the numerical values of the three gaussian
-                parameters met in the fitting processes `peak`, `mean` and
-                `stddev`.
+            results : numpy.ndarray
+                A (N x 4) array. Failed fits are filled with NaN.
+            n_iter : numpy.ndarray
+                The number of iterations used by each fit.
         """
-        i, j = indexes
-        data = pyfits.getdata(self._filename, memmap=True)
-        s = data[self._left:self._right, j, i]
+        raise NotImplementedError
 
-        h = pyfits.getheader(self._filename)
-        self._z = \
-            (np.arange(s.size) - h['CRPIX3'] - 1) * h['CDELT3'] + h['CRVAL3']
+    def fit_tile_warm(self, tile, mask=None, warm_start=True):
+        """
+        Fit a tile one row at a time. Each spectrum starts from the average
+        solution of its good neighbours in the previous row (see
+        `seed_guess`). Spectra without good neighbours start from their own
+        brightest channel. Rows are fitted with a single `fit_from` call.
 
-        del data
-        del h
+        Parameter
+        ---------
+            tile : tuple
+                (y_start, y_end, x_start, x_end) using Python's slicing
+                convention.
+            mask : numpy.ndarray or None
+                A boolean image with the tile shape. Only the pixels where it
+                is True are fitted.
+            warm_start : bool
+                Use the neighbour solutions? If False, every fit starts from
+                `first_guess`, which is useful to compare iteration counts.
+        Returns
+        -------
+            results : numpy.ndarray
+                A (4 x Y x X) array.
+            n_iter : numpy.ndarray
+                A (Y x X) array with the number of iterations of each fit.
+        """
+        if self._data is None:
+            self.load()
+
+        y0, y1, x0, x1 = tile
+        height, width = y1 - y0, x1 - x0
+        block = np.asarray(self._data[self._left:self._right, y0:y1, x0:x1])
+
+        results = np.full((4, height, width), np.nan)
+        n_iter = np.zeros((height, width), dtype=int)
+
+        for j in range(height):
+
+            row = np.ones(width, dtype=bool) if mask is None else mask[j]
+            if not row.any():
+                continue
+
+            spectra = block[:, j, row].T
+
+            if not warm_start:
+                p0 = self.first_guess(spectra)
+
+            else:
+
+                p = np.full((spectra.shape[0], 4), np.nan)
+
+                if j > 0:
+
+                    # Average of the three neighbours in the previous row ---
+                    above = np.pad(results[:, j - 1], ((0, 0), (1, 1)),
+                                   constant_values=np.nan)
+                    above = np.stack([above[:, :-2], above[:, 1:-1],
+                                      above[:, 2:]])[:, :, row]
+
+                    good = self.good_solutions(above.transpose((1, 0, 2)))
+                    count = good.sum(axis=0)
+                    with np.errstate(all='ignore'):
+                        seeds = np.where(good[:, np.newaxis], above, 0)
+                        seeds = seeds.sum(axis=0) / count
+
+                    seeded = count > 0
+                    p[seeded] = seeds.T[seeded]
+
+                p0 = self.warm_guess(spectra, p)
+
+            p, n = self.fit_from(spectra, p0)
+            results[:, j, row] = p.T
+            n_iter[j, row] = n
+
+        return results, n_iter
+
+    def read_spectra(self, tile, mask=None):
+        """
+        Return the spectra inside a tile as a (N x Z) array, keeping only the
+        pixels where `mask` is True.
+        """
+        if self._data is None:
+            self.load()
+
+        y0, y1, x0, x1 = tile
+        block = np.asarray(self._data[self._left:self._right, y0:y1, x0:x1])
+        spectra = block.reshape((block.shape[0], -1)).T
+
+        if mask is not None:
+            spectra = spectra[np.ravel(mask)]
+
+        return spectra
+
+    @staticmethod
+    def scatter(p, tile, mask=None):
+        """
+        Place the (N x 4) results of the spectra returned by `read_spectra`
+        back into a (4 x Y x X) tile.
+        """
+        y0, y1, x0, x1 = tile
+
+        results = np.full((4, (y1 - y0) * (x1 - x0)), np.nan)
+        if mask is None:
+            results[:] = p.T
+        else:
+            results[:, np.ravel(mask)] = p.T
+
+        return results.reshape((4, y1 - y0, x1 - x0))
+
+    def read_binned_spectra(self, labels, chunk_size=65536):
+        """
+        Average the spectra inside each bin. The cube is read tile by tile.
+
+        Parameter
+        ---------
+            labels : numpy.ndarray
+                A (Y x X) integer image with the bin of each pixel (see
+                `build_bins`). Pixels labelled -1 are ignored.
+            chunk_size : int
+                Maximum number of spectra read at once.
+        Returns
+        -------
+            spectra : numpy.ndarray
+                A (bins x Z) array.
+        """
+        if self._data is None:
+            self.load()
+
+        height, width = labels.shape
+        n_bins = labels.max() + 1
+
+        total = np.zeros((n_bins, self._z.size))
+        counts = np.zeros(n_bins)
+
+        for y0, y1, x0, x1 in chunks.iter_tiles(height, width, chunk_size):
+            tile_labels = labels[y0:y1, x0:x1]
+            inside = tile_labels >= 0
+            if not inside.any():
+                continue
+
+            spectra = self.read_spectra((y0, y1, x0, x1), inside)
+            np.add.at(total, tile_labels[inside], spectra)
+            counts += np.bincount(tile_labels[inside], minlength=n_bins)
+
+        with np.errstate(all='ignore'):
+            return total / counts[:, np.newaxis]
+
+
+class ModelFitter(MyFitter):
+    """
+    Fits an `astropy.modeling` line profile plus a constant to each spectrum
+    using the Levenberg-Marquardt algorithm.
+    """
+    iterative = True
+
+    # First guess for the line width ---
+    width = None
+
+    def model(self, p):
+        """
+        Return the model initialized with the (amplitude, center, width,
+        continuum) first guesses.
+        """
+        raise NotImplementedError
+
+    def parameters(self, fitted):
+        """
+        Return the (amplitude, center, width, continuum) of a fitted model.
+        """
+        raise NotImplementedError
+
+    def fit(self, s):
+        return list(self.fit_spectra(s[np.newaxis])[0])
+
+    def fit_spectra(self, spectra):
+        return self.fit_from(spectra, self.first_guess(spectra))[0]
+
+    def fit_from(self, spectra, p0):
+
+        p = np.full((spectra.shape[0], 4), np.nan)
+        n_iter = np.zeros(spectra.shape[0], dtype=int)
+
+        for k in range(spectra.shape[0]):
+
+            fitter = fitting.LevMarLSQFitter()
+            fitted = fitter(self.model(p0[k]), self._z, spectra[k])
+            n_iter[k] = fitter.fit_info['nfev']
+
+            if fitter.fit_info['ierr'] in [1, 2, 3, 4]:
+                p[k] = self.parameters(fitted)
+
+        return p, n_iter
+
+
+class FitGaussian(ModelFitter):
+
+    width = 2.0
+
+    def model(self, p):
+        return models.Gaussian1D(amplitude=p[0], mean=p[1], stddev=p[2]) + \
+            models.Const1D(amplitude=p[3])
+
+    def parameters(self, fitted):
+        return [fitted.amplitude_0.value, fitted.mean_0.value,
+                fitted.stddev_0.value, fitted.amplitude_1.value]
+
+
+class FitLorentzian(ModelFitter):
+
+    width = 5.0
+
+    def model(self, p):
+        return models.Lorentz1D(amplitude=p[0], x_0=p[1], fwhm=p[2]) + \
+            models.Const1D(amplitude=p[3])
+
+    def parameters(self, fitted):
+        return [fitted.amplitude_0.value, fitted.x_0_0.value,
+                fitted.fwhm_0.value, fitted.amplitude_1.value]
+
+
+class DirectMeasure(MyFitter):
+
+    def fit(self, s):
 
         # Calculate center using barycenter ---
         p = s / s.sum()
@@ -570,5 +1933,220 @@ class DirectMeasure(MyFitter):
         return [flux, x_0, stddev, cont]
 
 
+class DirectMoments(DirectMeasure):
+    """
+    Same as `DirectMeasure` but measuring every spectrum inside a tile at once
+    using `direct_moments`.
+    """
+    vectorised = True
+    chunk_size = 65536
+
+    def fit_spectra(self, spectra):
+        return direct_moments(spectra.T, self._z).T
+
+
+class BatchFitter(MyFitter):
+    """
+    Fits a line profile plus a constant to all the spectra inside a tile at
+    once using `samfp.tools.batchfit.levenberg_marquardt`. The first guesses
+    are the same used by `FitGaussian` and `FitLorentzian` and the spectra
+    that do not converge are filled with NaN.
+    """
+    vectorised = True
+    chunk_size = 4096
+
+    # Line profile model and first guess for its width ---
+    model = None
+    width = None
+
+    iterative = True
+
+    def fit_spectra(self, spectra):
+        return self.fit_from(spectra, self.first_guess(spectra))[0]
+
+    def fit_from(self, spectra, p0):
+
+        p, converged, n_iter = batchfit.levenberg_marquardt(
+            self.model, self._z, spectra, p0)
+
+        # The models are symmetric on the width sign ---
+        p[:, 2] = np.abs(p[:, 2])
+
+        return p, n_iter
+
+
+class BatchFitGaussian(BatchFitter):
+    model = staticmethod(batchfit.gaussian)
+    width = 2.0
+
+
+class BatchFitLorentzian(BatchFitter):
+    model = staticmethod(batchfit.lorentzian)
+    width = 5.0
+
+
+class TemplateFitter(MyFitter):
+    """
+    Matches all the spectra inside a tile against a
+    `samfp.tools.batchfit.TemplateBank` of unit-amplitude profiles. The bank
+    covers the whole spectral axis with `oversample` centers per channel and
+    `n_widths` widths between half a channel and a quarter of the spectral
+    range. It is built once and reused for every tile.
+    """
+    vectorised = True
+    chunk_size = 2048
+
+    # Unit-amplitude line profile ---
+    profile = None
+    period = None
+
+    oversample = 4
+    n_widths = 24
+
+    def __init__(self, filename):
+        MyFitter.__init__(self, filename)
+        self._bank = None
+
+    def __getstate__(self):
+        state = MyFitter.__getstate__(self)
+        state['_bank'] = None
+        return state
+
+    def get_bank(self):
+        """
+        Returns
+        -------
+            bank : samfp.tools.batchfit.TemplateBank
+        """
+        if self._bank is not None:
+            return self._bank
+
+        if self._z is None:
+            self.load()
+
+        z = self._z
+        step = np.abs(z[1] - z[0]) if z.size > 1 else 1.
+        z0 = z.min()
+
+        if self.period is None:
+            centers = np.arange(z0, z.max() + step / 2., step / self.oversample)
+        else:
+            centers = np.arange(z0, z0 + self.period, step / self.oversample)
+
+        widths = np.geomspace(step / 2., max(np.ptp(z), step) / 4.,
+                              self.n_widths)
+
+        self._bank = batchfit.TemplateBank(z, self.profile, centers, widths,
+                                           period=self.period)
+
+        return self._bank
+
+    def fit_spectra(self, spectra):
+        return self.get_bank().fit(spectra)
+
+
+class TemplateFitGaussian(TemplateFitter):
+    profile = staticmethod(batchfit.unit_gaussian)
+
+
+class TemplateFitLorentzian(TemplateFitter):
+    profile = staticmethod(batchfit.unit_lorentzian)
+
+
+class TemplateFitAiry(TemplateFitter):
+    """
+    Template fitting using the Airy function, the Fabry-Perot instrumental
+    profile. Its period is the free-spectral-range which, for cubes corrected
+    by `phmapply`, is the whole spectral range.
+    """
+
+    def __init__(self, filename, fsr=None):
+        TemplateFitter.__init__(self, filename)
+
+        if fsr is None:
+            h = pyfits.getheader(filename)
+            fsr = h['NAXIS3'] * np.abs(h['CDELT3'])
+
+        self.period = fsr
+        self.profile = functools.partial(batchfit.unit_airy, fsr=fsr)
+
+
+class FourierMoments(MyFitter):
+    """
+    Measures periodic spectra from their first Fourier harmonics using
+    `samfp.tools.periodic.fourier_moments`. Unlike the barycenter used by
+    `DirectMeasure`, the center found from the phase of the first harmonic is
+    not biased when the line sits close to the edges of the cube. The whole
+    spectral axis is used, since it has to cover the free-spectral-range, and
+    the width is given as the FWHM of the equivalent Airy function.
+    """
+    vectorised = True
+    chunk_size = 65536
+
+    def __init__(self, filename, fsr=None):
+        MyFitter.__init__(self, filename)
+
+        h = pyfits.getheader(filename)
+        if fsr is None:
+            fsr = h['NAXIS3'] * np.abs(h['CDELT3'])
+
+        self._left = 0
+        self._right = h['NAXIS3']
+        self.period = fsr
+
+    def fit_spectra(self, spectra):
+
+        if self._z is None:
+            self.load()
+
+        step = self._z[1] - self._z[0]
+        n = int(round(self.period / np.abs(step)))
+
+        p = periodic.fourier_moments(spectra.T, period=n).T
+        p[:, 1] = self._z[0] + p[:, 1] * step
+        p[:, 2] *= np.abs(step)
+
+        return p
+
+
+def direct_moments(data, z):
+    """
+    Vectorised version of `DirectMeasure.fit`. It measures the flux within
+    +/- 1 sigma, the barycenter, the dispersion and the continuum (mode) of
+    all spectra at once using reductions along the first axis.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The spectra with the spectral axis first (e.g. a (Z x Y x X)
+            sub-cube).
+        z : numpy.ndarray
+            The spectral axis.
+
+    Returns
+    -------
+        results : numpy.ndarray
+            A (4 x ...) array with the flux, center, dispersion and continuum.
+    """
+    z = np.reshape(z, (-1,) + (1,) * (data.ndim - 1))
+
+    # Calculate center using barycenter ---
+    p = data / data.sum(axis=0)
+    x_0 = np.sum(z * p, axis=0)
+
+    # Calculate dispersion ---
+    p_min = np.abs(p.min(axis=0))
+    stddev = np.sqrt(np.sum((z - x_0) ** 2 * (p + p_min), axis=0))
+
+    # Calculate the amplitude ---
+    cond = np.abs(z - x_0) <= stddev
+    flux = np.sum(np.where(cond, data, 0), axis=0)
+
+    # Calculate the continuun --
+    cont = np.reshape(stats.mode(data, axis=0)[0], data.shape[1:])
+
+    return np.array([flux, x_0, stddev, cont])
+
+
 if __name__ == '__main__':
     main()
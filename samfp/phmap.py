@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Phase-Map Models
+
+    Phase-maps are read from disk either as a full image (e.g. the observed
+    phase-map produced by `phmxtractor`) or as the parabolic model fitted by
+    `phmfit`. The parabolic model is fully described by the `PHMFIT_A`,
+    `PHMFIT_B`, `PHMFIT_C`, `PHMREFX` and `PHMREFY` header cards, so it is
+    evaluated on demand for any cube shape, binning or region instead of being
+    stored as an image.
+"""
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from . import io
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['PhaseMap', 'ParabolicPhaseMap', 'ImagePhaseMap', 'get_binning',
+           'load_phase_map']
+
+_log = io.get_logger(__name__)
+
+
+def get_binning(header):
+    """
+    Read the binning stored in the `CCDSUM` card.
+
+    Parameters
+    ----------
+        header : astropy.io.fits.Header
+
+    Returns
+    -------
+        binning : tuple or None
+            The (x, y) binning or None if it could not be found.
+    """
+    try:
+        bx, by = [int(b) for b in str(header['CCDSUM']).split()]
+    except (KeyError, ValueError):
+        return None
+
+    return bx, by
+
+
+class PhaseMap:
+    """
+    Base class for phase-maps. A phase-map is evaluated by calling it with
+    the shape of the image (or cube) it will be applied to.
+
+    Parameters
+    ----------
+        header : astropy.io.fits.Header
+            The phase-map header. It must contain `PHMREFX` and `PHMREFY`.
+    """
+
+    def __init__(self, header):
+
+        self.header = header
+        self.ref_x = header['PHMREFX']
+        self.ref_y = header['PHMREFY']
+        self.binning = get_binning(header)
+        self._warned = False
+
+    def __call__(self, shape, binning=None, region=None):
+        """
+        Evaluate the phase-map.
+
+        Parameters
+        ----------
+            shape : tuple
+                The (height, width) of the image the phase-map will be applied
+                to. Cube shapes (depth, height, width) are also accepted.
+
+            binning : tuple or None
+                The (x, y) binning of the target image. If either this or the
+                phase-map binning is unknown, both are assumed to be the same
+                (with a warning if only one of them is known). Image
+                phase-maps infer it from their sizes instead.
+
+            region : tuple or None
+                A (x_start, x_end, y_start, y_end) region, in target pixels and
+                using Python's slicing convention. The whole image is used if
+                None.
+
+        Returns
+        -------
+            phase_map : numpy.ndarray
+                The phase-map displacement in `PHMUNIT` units, relative to the
+                reference pixel.
+        """
+        raise NotImplementedError
+
+    def _scale(self, binning, shape=None):
+        """
+        Ratio between the target binning and the phase-map binning. The
+        target `shape` is only used by phase-maps that can infer it.
+        """
+        if binning is None or self.binning is None:
+            if (binning is None) != (self.binning is None) and \
+                    not self._warned:
+                _log.warning("Only {:s} has a binning (CCDSUM). Assuming "
+                             "that both have the same binning.".format(
+                                 'the image' if self.binning is None
+                                 else 'the phase-map'))
+                self._warned = True
+            return 1., 1.
+
+        return binning[0] / self.binning[0], binning[1] / self.binning[1]
+
+    @staticmethod
+    def _region(shape, region):
+        height, width = shape[-2:]
+        if region is None:
+            return 0, width, 0, height
+
+        x0, x1, y0, y1 = region
+        x0, x1, _ = slice(x0, x1).indices(width)
+        y0, y1, _ = slice(y0, y1).indices(height)
+
+        return x0, x1, y0, y1
+
+    def _coordinates(self, shape, binning=None, region=None):
+        """
+        Return the X and Y distances, in phase-map pixels, from each target
+        pixel to the reference pixel.
+        """
+        sx, sy = self._scale(binning, shape)
+        x0, x1, y0, y1 = self._region(shape, region)
+
+        dx = (np.arange(x0, x1) + 0.5) * sx - 0.5 - self.ref_x
+        dy = (np.arange(y0, y1) + 0.5) * sy - 0.5 - self.ref_y
+
+        return dx, dy
+
+
+class ParabolicPhaseMap(PhaseMap):
+    """
+    Phase-map described by a parabola as a function of the distance to the
+    rings center: phi(r) = a * r ** 2 + b * r + c.
+
+    Parameters
+    ----------
+        header : astropy.io.fits.Header
+            A header containing the `PHMFIT_*` cards written by `phmfit`.
+
+        step : float
+            Radial step, in phase-map pixels, of the lookup table used to
+            evaluate the model.
+    """
+
+    def __init__(self, header, step=0.125):
+
+        PhaseMap.__init__(self, header)
+
+        self.a = header['PHMFIT_A']
+        self.b = header['PHMFIT_B']
+        self.c = header['PHMFIT_C']
+
+        self.step = step
+        self._table = np.zeros(1)
+
+    def __call__(self, shape, binning=None, region=None):
+
+        dx, dy = self._coordinates(shape, binning=binning, region=region)
+        r = np.sqrt(dx[np.newaxis, :] ** 2 + dy[:, np.newaxis] ** 2)
+
+        return self.radial_profile(r)
+
+    def radial_profile(self, r):
+        """
+        Evaluate the phase-map relative to its center using the cached radial
+        lookup table. The table grows whenever a larger radius is requested.
+
+        Parameters
+        ----------
+            r : numpy.ndarray
+                Distance to the reference pixel in phase-map pixels.
+        """
+        r_max = np.max(r) if np.size(r) else 0
+
+        if r_max > (self._table.size - 2) * self.step:
+            n = int(np.ceil(r_max / self.step)) + 2
+            rr = np.arange(max(n, 2 * self._table.size)) * self.step
+            self._table = self.a * rr ** 2 + self.b * rr
+
+        return np.interp(r / self.step, np.arange(self._table.size),
+                         self._table)
+
+
+class ImagePhaseMap(PhaseMap):
+    """
+    Phase-map stored as an image. In a different binning, it is linearly
+    interpolated at the center of each target pixel. If the binning of the
+    phase-map or of the target is unknown, it is inferred from the ratio
+    between their sizes.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The phase-map image.
+
+        header : astropy.io.fits.Header
+            The phase-map header.
+    """
+
+    def __init__(self, data, header):
+
+        PhaseMap.__init__(self, header)
+
+        if data.ndim != 2:
+            raise ValueError('Phase-map is not really an image.')
+
+        self.data = data
+
+    def __call__(self, shape, binning=None, region=None):
+
+        sx, sy = self._scale(binning, shape)
+        height, width = self.data.shape
+
+        if abs(shape[-1] * sx - width) >= max(sx, 1) or \
+                abs(shape[-2] * sy - height) >= max(sy, 1):
+            raise ValueError('Phase-map and image do not have matching '
+                             'width and height.')
+
+        if (sx, sy) == (1., 1.):
+            x0, x1, y0, y1 = self._region(shape, region)
+            phase_map = np.array(self.data[y0:y1, x0:x1], dtype=float)
+        else:
+            dx, dy = self._coordinates(shape, binning=binning, region=region)
+            y, x = np.meshgrid(dy + self.ref_y, dx + self.ref_x,
+                               indexing='ij')
+            phase_map = ndimage.map_coordinates(
+                np.asarray(self.data, dtype=float), [y, x], order=1,
+                mode='nearest')
+
+        try:
+            phase_map -= self.data[int(self.ref_y), int(self.ref_x)]
+        except IndexError:
+            _log.warning("Reference pixel out of field.")
+            _log.warning("Skipping reference pixel map subtraction.")
+
+        return phase_map
+
+    def _scale(self, binning, shape=None):
+
+        if shape is None or (binning is not None and
+                             self.binning is not None):
+            return PhaseMap._scale(self, binning)
+
+        height, width = self.data.shape
+
+        return (_size_ratio(width, shape[-1]),
+                _size_ratio(height, shape[-2]))
+
+
+def _size_ratio(size, target_size):
+    """
+    Binning ratio between an image axis and the same axis of the target
+    image, assuming that binned axes drop the incomplete last pixel.
+    """
+    if size >= target_size:
+        ratio = size // target_size
+        if size // ratio == target_size:
+            return float(ratio)
+    else:
+        ratio = target_size // size
+        if target_size // ratio == size:
+            return 1. / ratio
+
+    raise ValueError('Phase-map and image do not have matching width and '
+                     'height.')
+
+
+def load_phase_map(filename):
+    """
+    Load a phase-map from a FITS file or from a text file containing only its
+    header. Whenever the `PHMFIT_*` cards are present, the parabolic model is
+    used and the image data, if any, is never read.
+
+    Parameters
+    ----------
+        filename : str
+            The phase-map filename.
+
+    Returns
+    -------
+        phase_map : PhaseMap
+    """
+    if os.path.splitext(filename)[1] in ['.txt', '.hdr']:
+        header = io.pyfits.Header.fromtextfile(filename)
+    else:
+        header = io.pyfits.getheader(filename)
+
+    if all(key in header for key in ['PHMFIT_A', 'PHMFIT_B', 'PHMFIT_C']):
+        return ParabolicPhaseMap(header)
+
+    if header.get('NAXIS', 0) == 0:
+        raise ValueError('{:s} has no data and no fitted phase-map '
+                         'parameters.'.format(filename))
+
+    return ImagePhaseMap(io.pyfits.getdata(filename, memmap=True), header)
@@ -10,19 +10,24 @@
 from __future__ import division, print_function
 
 import argparse
+import multiprocessing
 import os
 import sys
 import time
 
 import astropy.io.fits as pyfits
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 from scipy import signal
 
-from . import io
-from .tools import version
+from . import io, phmap
+from .tools import chunks, periodic, speccache, version, ztools
+from .tools.progress import Progress
 
 _log = io.get_logger(__name__)
+_worker = {}
+
+# Relative flux variation accepted after shifting the spectra
+FLUX_TOLERANCE = 1e-3
 
 
 def main():
@@ -34,18 +39,43 @@ def main():
         '-c', '--center', action='store_true',
         help="Try to center the strongest line in the cube."
     )
+    parser.add_argument(
+        '-C', '--cache', action='store_true',
+        help="Read the spectra from a spectral cache of the cube, built on "
+             "the first use (see samfp.tools.speccache)."
+    )
+    parser.add_argument(
+        '-k', '--chunk_size', type=int, default=65536,
+        help="Number of spectra inside each tile processed at once [65536]."
+    )
+    parser.add_argument(
+        '-m', '--method', type=str, default='fourier',
+        choices=['fourier', 'linear', 'cubic'],
+        help="Interpolation method used to shift the spectra [fourier]."
+    )
     parser.add_argument(
         '-n', '--npoints', type=int, default=10,
-        help="Number of points in the re-sampling for channel [10]."
+        help="Deprecated. Kept for compatibility and ignored."
     )
     parser.add_argument(
         '-o', '--output', metavar='output', type=str, default=None,
         help="Name of the output corrected cube"
     )
+    parser.add_argument(
+        '-p', '--pool_size', type=int, default=4,
+        help="Number of parallel processes [4]."
+    )
     parser.add_argument(
         '-q', '--quiet', action='store_true',
         help="Run it quietly."
     )
+    parser.add_argument(
+        '-R', '--roi', type=int, nargs=4, default=None,
+        metavar=('X_BEGIN', 'X_END', 'Y_BEGIN', 'Y_END'),
+        help="Correct only this region of interest, in pixels starting from "
+             "0 with the end column and row excluded. The output cube has "
+             "the size of the region."
+    )
     parser.add_argument(
         '-v', '--velocity', type=float, default=0.0,
         help="Systemic velocity to be applied to the emitted wavelength [km/s]."
@@ -56,7 +86,8 @@ def main():
     )
     parser.add_argument(
         'map_file', metavar='map_file', type=str,
-        help="Input phase-map image filename."
+        help="Input phase-map filename. It can be a phase-map image or the "
+             "header-only file written by phmfit."
     )
     parser.add_argument(
         'wavelength', type=float,
@@ -109,39 +140,41 @@ def main():
     # Reading input data ------------------------------------------------------
     _log.info("")
     _log.info("Reading cube to be corrected.")
-    data_cube = pyfits.open(cube_file)[0]
+    header = pyfits.getheader(cube_file)
     _log.info("Done.")
 
     _log.info("Reading phase-map to be applied.")
-    phase_map = pyfits.open(map_file)[0]
+    phase_map = phmap.load_phase_map(map_file)
     _log.info("Done.")
 
     # Checking data -----------------------------------------------------------
-    if data_cube.data[0].shape != phase_map.shape:
-        _log.error("Cube and map does not have matching width and height.")
-        _log.error("[!] Leaving now.\n")
-        sys.exit()
-
-    if data_cube.data.ndim != 3:
+    if header['NAXIS'] != 3:
         _log.error("[!] Cube file is not really a cube.")
         _log.error("[!] Leaving now.\n")
         sys.exit()
 
-    if phase_map.data.ndim != 2:
-        _log.error("[!] Map file is not really an image.")
+    m = header['NAXIS1']
+    n = header['NAXIS2']
+    binning = phmap.get_binning(header)
+
+    try:
+        phase_map((n, m), binning=binning, region=(0, 1, 0, 1))
+    except ValueError as error:
+        _log.error("[!] {}".format(error))
         _log.error("[!] Leaving now.\n")
         sys.exit()
 
-    m = data_cube.header['NAXIS1']
-    n = data_cube.header['NAXIS2']
-
-    ref_x = phase_map.header['PHMREFX']
-    ref_y = phase_map.header['PHMREFY']
     units = phase_map.header['PHMUNIT']
 
+    roi = chunks.region(n, m, args.roi)
+    height, width = roi[3] - roi[2], roi[1] - roi[0]
+    if args.roi is not None:
+        _log.info("Region of interest: x = [{:d}:{:d}], "
+                  "y = [{:d}:{:d}]".format(*roi))
+
     # TODO -- fix this
     try:
-        sample = float(data_cube.header['CDELT3'])
+        sample = float(header['CDELT3'])
     except KeyError:
         _log.error('"CDELT3" keyword was not found in the header.')
         sample = 1
@@ -160,112 +193,118 @@ def main():
 
     except KeyError:
         _log.info("Please, enter the free-spectral-range in %s units" % units)
-        f_s_r = io.input("    >")
+        f_s_r = float(io.input("    >"))
 
     f_s_r = round(f_s_r / abs(sample)) # From BCV to Channels
     _log.info("Free-Spectral-Range is %d channels" % f_s_r)
 
-    fsr = f_s_r * args.npoints  # From Channels to nPoints
-    fsr = int(round(fsr))
-    _log.info("Free-Spectral-Range is %d points" % fsr)
+    n_channels = header['NAXIS3']
+    if f_s_r > n_channels:
+        _log.warning("Free-Spectral-Range is larger than the cube depth.")
+        _log.warning("Using the cube depth as the spectral period.")
+    period = int(min(f_s_r, n_channels))
 
-    # Assure that the reference spectrum will not be moved ----------------
-    try:
-        phase_map.data = phase_map.data - phase_map.data[ref_y, ref_x]
-    except IndexError:
-        _log.warning("Reference pixel out of field.")
-        _log.warning("Skipping reference pixel map subtraction.")
-        pass
-    phase_map.data *= -1
+    if args.npoints != parser.get_default('npoints'):
+        _log.warning("--npoints is ignored. Spectra are shifted without "
+                     "re-sampling.")
+
+    # Preparing the output cube -----------------------------------------------
+    out_header = header.copy()
+
+    keys = ['PHMREFX', 'PHMREFY', 'PHMTYPE', 'PHMREFF', 'PHMWCAL', 'PHM_FSR',
+            'PHMUNIT', 'PHMSAMP', 'PHMFIT_A', 'PHMFIT_B', 'PHMFIT_C']
+    h = phase_map.header
 
-    # Converting phase-map values to channels ------------------------------
-    phase_map.data /= sample
+    for key in keys:
+        out_header.append(card=(key, h[key]))
 
-    # Converting phase-map from channels to number of points --------------
-    phase_map.data = phase_map.data * args.npoints
+    out_header.add_blank('', before='PHMREFX')
+    out_header.add_blank('--- PHM Xtractor ---', before='PHMREFX')
+
+    out_header.add_blank(value='', before='PHMFIT_A')
+    out_header.add_blank(value='--- PHM Fit ---', before='PHMFIT_A')
+    out_header.add_blank(value='f(x) = a * z ** 2 + b * z + c',
+                         before='PHMFIT_A')
+
+    # The wavelength calibration is only known after correcting the cube
+    out_header.set("CRPIX3", 1, after="PHMFIT_C")
+    out_header.set("CRVAL3", wavelength, after="CRPIX3")
+    out_header.set("C3_3", 1., after="CRVAL3")
+    out_header.set("CDELT3", 1., after="C3_3")
+
+    out_header.add_history(
+        'Phase-map corrected using {:s}'.format(map_file), after='PHMFIT_C')
+    out_header.add_blank(value='--- phmapply ---', after='PHMFIT_C')
+    out_header.add_blank(after='PHMFIT_C')
+
+    if args.roi is not None:
+        out_header = ztools.xy_crop_header(out_header, m, n, roi)
+
+    _log.info("Creating output file %s." % out_file)
+    chunks.create_cube(out_file, out_header, (period, height, width),
+                       overwrite=True)
 
     # Applying phase-map --------------------------------------------------
     _log.info("")
-    _log.info("Applying phase-map:")
-
-    n_channels = data_cube.header['NAXIS3']
-    z = np.arange(3 * n_channels) - n_channels
-    new_z = np.arange(0, z.size, 1.0 / args.npoints)
+    _log.info("Applying phase-map using {:d} processes:".format(
+        args.pool_size))
 
-    for i in range(m):
-        for j in range(n):
+    tiles = list(chunks.iter_tiles(height, width, args.chunk_size))
+    collapsed_cube = np.zeros(period)
 
-            # Extracting a spectrum
-            spec = data_cube.data[:, j, i]
-            spec = np.hstack((spec, spec, spec))
-            dz = phase_map.data[j, i]
+    out_hdul = pyfits.open(out_file, mode='update', memmap=True)
+    out_data = out_hdul[0].data
 
-            # Re-sample spectrum
-            spline = UnivariateSpline(z, spec, s=0.0)
-            new_spec = spline(new_z)
+    if args.cache:
+        _log.info("Using spectral cache: {:s}".format(
+            speccache.open_cube(cube_file, cache=True).filename))
 
-            # Cutting spectrum
-            new_z = new_z[0:fsr + 1]
-            new_spec = new_spec[0:fsr + 1]
+    init_args = (cube_file, phase_map, binning, period, sample, args.method,
+                 args.cache, roi)
+    pool = multiprocessing.Pool(
+        args.pool_size, initializer=_init_worker, initargs=init_args)
 
-            # Shifting spectrum
-            new_spec = np.roll(new_spec, int(dz))
+    progress = Progress(height * width, _log, name='Applying phase-map',
+                        unit='spectra')
+    max_variation = 0.
+    for (y0, y1, x0, x1), shifted, variation in \
+            pool.imap_unordered(_shift_tile, tiles):
 
-            # Under-sampling spectrum
-            spline = UnivariateSpline(new_z, new_spec, s=0.0)
-            spec = spline(z)
+        out_data[:, y0:y1, x0:x1] = shifted
+        collapsed_cube += shifted.sum(axis=(1, 2))
+        max_variation = max(max_variation, variation)
+        progress.update((y1 - y0) * (x1 - x0))
 
-            # Storing new spectrum
-            data_cube.data[:, j, i] = spec[n_channels:2 * n_channels]
+    pool.close()
+    pool.join()
+    progress.finish()
 
-            # Giving a feedback to the user
-            if not args.quiet:
-                temp = ((i + 1) * 100.00 / m)
-                sys.stdout.write('\r' + 42 * ' ' + '%2.2f%% ' % temp)
-                sys.stdout.flush()
+    _check_flux(max_variation, FLUX_TOLERANCE)
 
-    end_of_cube = min(int(round(f_s_r)), data_cube.data.shape[0])
-    data_cube.data = data_cube.data[0:end_of_cube, :, :]
-    _log.info(" Done.")
+    collapsed_cube /= height * width
 
     if args.center:
-        collapsed_cube = np.mean(data_cube.data, axis=(1, 2))
-
-        collapsed_cube = np.where(
+        collapsed = np.where(
             collapsed_cube > np.percentile(collapsed_cube, 75.),
             collapsed_cube,
             0.
         )
 
-        imax = np.argmax(collapsed_cube)
+        imax = np.argmax(collapsed)
 
         _log.info(' Maximum argument found at {:d}'.format(imax))
-        _log.info(' Cube center at {:d}'.format(collapsed_cube.size // 2))
+        _log.info(' Cube center at {:d}'.format(collapsed.size // 2))
         _log.info(' Displacemente to be applied: {:d}'.format(
-                imax - collapsed_cube.size // 2))
-
-        data_cube.data = np.roll(data_cube.data,
-                                 - (imax - collapsed_cube.size // 2), axis=0)
-
-    # Saving more information in the phase-corrected cube ---------------------
-    keys = ['PHMREFX', 'PHMREFY', 'PHMTYPE', 'PHMREFF', 'PHMWCAL', 'PHM_FSR',
-            'PHMUNIT', 'PHMSAMP', 'PHMFIT_A', 'PHMFIT_B', 'PHMFIT_C']
-    h = phase_map.header
+                imax - collapsed.size // 2))
 
-    for key in keys:
-        data_cube.header.append(card=(key, h[key]))
+        shift = - (imax - collapsed.size // 2)
+        for y0, y1, x0, x1 in tiles:
+            out_data[:, y0:y1, x0:x1] = np.roll(
+                out_data[:, y0:y1, x0:x1], shift, axis=0)
 
-    data_cube.header.add_blank('', before='PHMREFX')
-    data_cube.header.add_blank('--- PHM Xtractor ---', before='PHMREFX')
-
-    data_cube.header.add_blank(value='', before='PHMFIT_A')
-    data_cube.header.add_blank(value='--- PHM Fit ---', before='PHMFIT_A')
-    data_cube.header.add_blank(value='f(x) = a * z ** 2 + b * z + c',
-                               before='PHMFIT_A')
+        collapsed_cube = np.roll(collapsed_cube, shift)
 
     # Wavelength Calibration --------------------------------------------------
-    collapsed_cube = np.average(data_cube.data, axis=(1, 2))
-
     collapsed_cube = np.where(
         collapsed_cube > np.percentile(collapsed_cube, 75.),
         collapsed_cube,
@@ -277,33 +316,22 @@ def main():
 
     fp_order = 2. * (args.gap_size * 1e-6) / (wavelength * 1e-10)
     fsr_angstrom = (wavelength / fp_order) * (1 / (1 - 1 / fp_order ** 2))
-    delta_wavelength = data_cube.header["C3_3"] / data_cube.header["PHM_FSR"] * fsr_angstrom
+    delta_wavelength = header["C3_3"] / out_header["PHM_FSR"] * fsr_angstrom
 
     _log.info("Reference Channel: {:.2f}".format(imax))
     _log.info("Observed wavelength: {:.2f} A".format(wavelength))
     _log.info("Order: {:.2f}".format(fp_order))
     _log.info("FSR in angstrom: {:.2f}".format(fsr_angstrom))
-    _log.info("FSR in BCV: {:.2f}".format(data_cube.header["PHM_FSR"]))
+    _log.info("FSR in BCV: {:.2f}".format(out_header["PHM_FSR"]))
     _log.info("Wavelength per channel: {:5f} A".format(delta_wavelength))
 
-    data_cube.header.set("CRPIX3", imax, after="PHMFIT_C")
-    data_cube.header.set("CRVAL3", wavelength, after="CRPIX3")
-    data_cube.header.set("C3_3", delta_wavelength, after="CRVAL3")
-    data_cube.header.set("CDELT3", delta_wavelength, after="C3_3")
-
-    data_cube.header.add_history(
-        'Phase-map corrected using {:s}'.format(map_file), after='PHMFIT_C')
-    data_cube.header.add_blank(value='--- phmapply ---', after='PHMFIT_C')
-    data_cube.header.add_blank(after='PHMFIT_C')
+    out_hdul[0].header["CRPIX3"] = imax
+    out_hdul[0].header["C3_3"] = delta_wavelength
+    out_hdul[0].header["CDELT3"] = delta_wavelength
 
     # Saving corrected data-cube ----------------------------------------------
     _log.info("Writing output to file %s." % out_file)
-
-    try:
-        data_cube.writeto(out_file, overwrite=True)
-    except TypeError:
-        data_cube.writeto(out_file, clobber=True)
-
+    out_hdul.close()
     _log.info("Done.")
 
     end = time.time() - start
@@ -313,7 +341,180 @@ def main():
     _log.info(" All done!\n")
 
 
-def shift_spectrum(spec, dz, fsr=-1, sample=1.0, n_points=100):
+def _init_worker(cube_file, phase_map, binning, period, sample, method,
+                 cache=False, roi=None):
+    """
+    Memory-map the input cube, or its spectral cache, once per worker
+    process. Tiles are relative to the (x_start, x_end, y_start, y_end)
+    region of interest, if any.
+    """
+    global _worker
+
+    header = pyfits.getheader(cube_file)
+    shape = header['NAXIS2'], header['NAXIS1']
+
+    _worker = {
+        'data': speccache.open_cube(cube_file, cache=cache, roi=roi),
+        'shape': shape,
+        'roi': chunks.region(shape[0], shape[1], roi),
+        'phase_map': phase_map,
+        'binning': binning,
+        'period': period,
+        'sample': sample,
+        'method': method,
+    }
+
+
+def _shift_tile(tile):
+    """
+    Apply the phase-map to all the spectra inside a spatial tile.
+
+    Parameters
+    ----------
+        tile : tuple
+            (y_start, y_end, x_start, x_end)
+
+    Returns
+    -------
+        tile : tuple
+            The same input tile.
+
+        shifted : numpy.ndarray
+            The corrected spectra in a (period, y, x) float32 array.
+
+        variation : float
+            The largest relative flux variation of the tile (see
+            `flux_variation`). It is checked once by the parent process.
+    """
+    y0, y1, x0, x1 = tile
+    dx, _, dy, _ = _worker['roi']
+
+    data = _worker['data']
+    dz = _worker['phase_map'](_worker['shape'], binning=_worker['binning'],
+                              region=(x0 + dx, x1 + dx, y0 + dy, y1 + dy))
+
+    period = _worker['period']
+    sample = _worker['sample']
+
+    spectra = data[:period, y0:y1, x0:x1]
+    shifted = shift_spectra(spectra, dz, fsr=period * abs(sample),
+                            sample=sample, method=_worker['method'],
+                            check_flux=False)
+
+    return tile, shifted.astype(np.float32), flux_variation(spectra, shifted)
+
+
+def flux_variation(before, after):
+    """
+    Largest relative change of the flux of the spectra after shifting them.
+    Spectra with zero or invalid flux are ignored.
+
+    Parameters
+    ----------
+        before: np.ndarray
+            The spectra within one free-spectral-range before shifting, with
+            the spectral axis first.
+
+        after: np.ndarray
+            The same spectra after shifting.
+
+    Returns
+    -------
+        variation: float
+            The maximum relative variation or 0 if no flux can be compared.
+    """
+    flux_before = np.sum(before, axis=0)
+    flux_after = np.sum(after, axis=0)
+
+    valid = np.isfinite(flux_before) & np.isfinite(flux_after) & \
+        (flux_before != 0)
+    variation = np.divide(np.abs(flux_after - flux_before),
+                          np.abs(flux_before),
+                          out=np.zeros(np.shape(flux_before)), where=valid)
+
+    return float(np.max(variation)) if variation.size else 0.
+
+
+def _check_flux(variation, tolerance):
+    if variation > tolerance:
+        _log.warning("Flux changed by up to {:.2%} while shifting the "
+                     "spectra.".format(variation))
+
+
+def shift_spectra(data, dz, fsr=None, sample=1.0, method='fourier',
+                  check_flux=True, tolerance=FLUX_TOLERANCE):
+    """
+    Shift all the spectra in a data-cube (or in a 2D array) at once. Each
+    spectrum is moved by `-dz` considering that it is periodic over the
+    free-spectral-range, so a line displaced by `dz` goes back to the reference
+    position.
+
+    Parameters
+    ----------
+        data: np.ndarray
+            A (z, y, x) data-cube, a (z, n) array of spectra or a single
+            spectrum. The spectral axis is always the first one.
+
+        dz: float or np.ndarray
+            How big is the shifting in cube units. It can be a single value or
+            one value for each spectrum (e.g. a phase-map with shape (y, x)).
+
+        fsr: float or None
+            The free-spectra-range in cube units. If None, the number of
+            channels is used.
+
+        sample: float
+            The increment between each channel.
+
+        method: str
+            The interpolation method: 'fourier', 'linear' or 'cubic'.
+
+        check_flux: bool
+            Warn if the flux within one free-spectral-range changes by more
+            than `tolerance` (relative) after shifting.
+
+        tolerance: float
+            Relative flux variation accepted by the flux check.
+
+    Returns
+    -------
+        shifted: np.ndarray
+            The shifted spectra with the same shape as `data`. Channels beyond
+            one free-spectral-range are periodic copies of the first ones.
+    """
+    methods = {
+        'fourier': periodic.fourier_shift,
+        'linear': periodic.linear_shift,
+        'cubic': periodic.cubic_shift,
+    }
+
+    if method not in methods:
+        raise ValueError('Wrong shift method: {:s}. Use one of {}'.format(
+            method, sorted(methods.keys())))
+
+    data = np.asarray(data, dtype=float)
+    depth = data.shape[0]
+
+    period = depth if fsr is None else int(round(fsr / abs(sample)))
+    if period > depth:
+        _log.warning("Free-Spectral-Range is larger than the number of "
+                     "channels. Using the number of channels instead.")
+        period = depth
+
+    shift = - np.asarray(dz, dtype=float) / sample  # From cube units to channels
+    shifted = methods[method](data, shift, period=period)
+
+    if check_flux:
+        _check_flux(flux_variation(data[:period], shifted), tolerance)
+
+    if period < depth:
+        shifted = np.take(shifted, np.arange(depth) % period, axis=0)
+
+    return shifted
+
+
+def shift_spectrum(spec, dz, fsr=-1, sample=1.0, n_points=100,
+                   method='fourier'):
     """
     Parameters
     ----------
@@ -324,40 +525,22 @@ def shift_spectrum(spec, dz, fsr=-1, sample=1.0, n_points=100):
             How big is the shifting.
 
         fsr: float
-            The free-spectra-range in sample units.
+            The free-spectra-range in sample units. Non-positive values mean
+            that the whole spectrum is one free-spectral-range.
 
         sample: float
             The increment between each channel.
 
         n_points: int
-            Number of points that will be used for super-sampling.
-    """
-    dz_sign = -np.sign(dz)
-    dz = abs(dz) / sample  # From cube units to channels
-    dz_points = int(dz * n_points)  # From channels to new sample units
+            Not used anymore. Spectra are not super-sampled since they are
+            shifted using `shift_spectra`.
 
-    index = fsr / sample  # From cube units to channels
-    index *= n_points  # From channels to new sample units
-
-    if dz_points is 0:
+        method: str
+            The interpolation method used by `shift_spectra`.
+    """
+    if dz == 0:
         return spec
 
-    # Get the spectrum from cube
-    z = np.arange(spec.size)
-    spline = UnivariateSpline(z, spec, s=0.0)
-
-    # Re-sample spectrum
-    new_z = np.linspace(z[0], z[-1], z.size * n_points)
-    new_spec = spline(new_z)
-
-    # Cutting Spectrum
-    new_spec = new_spec[0:fsr]
-
-    # Shifting spectrum
-    new_spec = np.roll(new_spec, int(dz_sign * dz_points))
-
-    # Down-sampling
-    spline = UnivariateSpline(new_z, new_spec, s=0.0)
-    spec = spline(z)
+    fsr = None if fsr is None or fsr <= 0 else fsr
 
-    return spec
+    return shift_spectra(spec, dz, fsr=fsr, sample=sample, method=method)
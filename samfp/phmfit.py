@@ -17,6 +17,7 @@ import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
 
+from .phmap import ParabolicPhaseMap
 from .tools import io, version
 
 log = io.MyLogger(__name__)
@@ -33,6 +34,10 @@ def main():
     parser.add_argument(
         '-d', '--debug', action='store_true', help="Run program quietly.")
 
+    parser.add_argument(
+        '-f', '--full_maps', action='store_true',
+        help="Also write the fitted and the residual phase-maps as images.")
+
     parser.add_argument(
         '-i', '--interactions', default=5, type=int,
         help="Number of interactions in the process [5]")
@@ -59,7 +64,8 @@ def main():
 
     phmfit = PhaseMapFit()
     phmfit.run(args.filename, interactions=args.interactions,
-               n_points=args.npoints, show=args.show_plots)
+               n_points=args.npoints, show=args.show_plots,
+               full_maps=args.full_maps)
 
 
 class PhaseMapFit:
@@ -162,7 +168,17 @@ class PhaseMapFit:
         _log.info('Done.\n')
         return data, header
 
-    def run(self, filename, n_points=10, interactions=5, show=False):
+    def run(self, filename, n_points=10, interactions=5, show=False,
+            full_maps=False):
+        """
+        Fit a parabola to the observed phase-map.
+
+        The fitted phase-map is fully described by the `PHMFIT_*`, `PHMREFX`
+        and `PHMREFY` cards, so it is written as a header-only FITS file that
+        `phmapply` evaluates for any binning or cube shape. If `full_maps` is
+        True, the fitted and the residual phase-maps are also written as
+        images.
+        """
 
         log = self.log
 
@@ -326,13 +342,6 @@ class PhaseMapFit:
         log.info("Sampling in Z: %s" % h['phmsamp'])
         log.info(" ")
 
-        x = np.arange(n_cols)
-        y = np.arange(n_rows)
-        X, Y = np.meshgrid(x, y)
-        R = np.sqrt((X - ref_x) ** 2 + (Y - ref_y) ** 2)
-        Z = np.polyval(p, R)
-        Z = Z - Z[ref_y, ref_x]
-
         h.set('PHMTYPE', value='parabola fit')
 
         h.set('PHMFIT_A', value=p[0], after='PHMSAMP')
@@ -345,8 +354,16 @@ class PhaseMapFit:
 
         fname = h['PHMREFF']
         fname = os.path.splitext(fname)[0]
-        pyfits.writeto(fname + '--fit_phmap.fits', Z, h, overwrite=True)
-        pyfits.writeto(fname + '--res_phmap.fits', Z - d, h, overwrite=True)
+
+        if full_maps:
+            Z = ParabolicPhaseMap(h)(d.shape).astype(np.float32)
+            pyfits.writeto(fname + '--fit_phmap.fits', Z, h, overwrite=True)
+            pyfits.writeto(fname + '--res_phmap.fits',
+                           (Z - d).astype(np.float32), h,
+                           overwrite=True)
+        else:
+            pyfits.PrimaryHDU(header=h).writeto(
+                fname + '--fit_phmap.fits', overwrite=True)
 
         log.info(" All done.\n")
 
@@ -33,7 +33,8 @@ from matplotlib import gridspec
 from matplotlib import pyplot as plt
 from scipy import interpolate, signal
 
-from .tools import plots, version
+from .tools import chunks, plots, version, ztools
+from .tools.progress import Progress
 from samfp import io
 
 _log = io.logger.get_logger(__name__)
@@ -77,7 +78,8 @@ def main():
         show=args.show,
         verbose=not args.quiet,
         ref=args.ref,
-        output=args.output
+        output=args.output,
+        roi=args.roi
     )
     
     phase_map_extractor.run()
@@ -120,6 +122,12 @@ def _parse_arguments():
                         help="Run program quietly. true/[FALSE]")
     parser.add_argument('-r', '--ref', type=int, nargs=2, default=None,
                         help="Reference pixel for the correlation cube.")
+    parser.add_argument('-R', '--roi', type=int, nargs=4, default=None,
+                        metavar=('X_BEGIN', 'X_END', 'Y_BEGIN', 'Y_END'),
+                        help="Extract the phase-map only inside this region "
+                             "of interest, in pixels starting from 0 with the "
+                             "end column and row excluded. Pixel coordinates "
+                             "(e.g. --ref) are relative to the region.")
     parser.add_argument('-s', '--show', action='store_true',
                         help="Show plots used in the process. true/[FALSE]")
 
@@ -183,11 +191,14 @@ class PhaseMapExtractor:
 
         output : str
             String that contains the path to the output phase-map.
-    """
-    loading = [' ', '-', '\\', '|', '/']
 
+        roi : tuple or None
+            A (x_start, x_end, y_start, y_end) region of interest. Only this
+            part of the cube is read and the phase-map has its size, as if
+            the cube was cropped with `samfp.tools.ztools.XYCrop`.
+    """
     def __init__(self, filename, wavelength, correlation=False, output=None,
-                 ref=None, show=False, verbose=False):
+                 ref=None, show=False, verbose=False, roi=None):
 
         # Setting main configuration
         self.input_file = filename
@@ -210,8 +221,16 @@ class PhaseMapExtractor:
         self.phase_map = None
 
         # Reading raw data
-        self.data = io.pyfits.getdata(filename)
         self.header = io.pyfits.getheader(filename)
+        self.roi = roi
+
+        if roi is not None:
+            width, height = self.header['NAXIS1'], self.header['NAXIS2']
+            self.roi = chunks.region(height, width, roi)
+            self.header = ztools.xy_crop_header(self.header, width, height,
+                                                self.roi)
+
+        self.data = self.read_cube(filename)
 
         # Reading data-cube configuration
         self.width = self.header['NAXIS1']
@@ -252,9 +271,10 @@ class PhaseMapExtractor:
 
         self.ref_x, self.ref_y = self.ref[:]
 
+        x0, _, y0, _ = (0, 0, 0, 0) if self.roi is None else self.roi
         self.ref_s = self.get_reference_spectrum(
-            self.input_file, self.ref_x, self.ref_y, self.z, units=self.units,
-            show=False)
+            self.input_file, self.ref_x + x0, self.ref_y + y0, self.z,
+            units=self.units, show=False)
 
         # # Calculate the FWHM
         self.fwhm = self.get_fwhm(self.z, self.ref_s, show=self.show)
@@ -281,7 +301,10 @@ class PhaseMapExtractor:
         _log.info("")
         _log.info("Starting phase-map extraction.")
         _log.info("Reading data from %s file" % self.extract_from)
-        data = io.pyfits.getdata(self.extract_from)
+        if self.extract_from == self.input_file:
+            data = self.read_cube(self.extract_from)
+        else:
+            data = io.pyfits.getdata(self.extract_from)
 
         phase_map = np.argmax(data, axis=0).astype('float64')
         phase_map -= phase_map[self.ref_y, self.ref_x]
@@ -821,16 +844,22 @@ class PhaseMapExtractor:
 
         candidates = glob.glob("*.fits")
 
+        # The crop cards tell apart cubes of regions with the same size ---
+        keys = ['NAXIS1', 'NAXIS2', 'XC_XBEG', 'XC_XEND', 'XC_YBEG',
+                'XC_YEND']
+
         corr_cube = None
         for candidate in candidates:
-            if 'CORRFROM' in io.pyfits.getheader(candidate):
-                if io.pyfits.getheader(candidate)['CORRFROM'] == self.input_file:
+            h = io.pyfits.getheader(candidate)
+            if 'CORRFROM' in h and \
+                    all(h.get(key) == self.header.get(key) for key in keys):
+                if h['CORRFROM'] == self.input_file:
                     _log.info("Correlation cube to be used: %s" % candidate)
                     return candidate
 
         if corr_cube is None:
             _log.info("Correlation cube not found. Creating a new one.")
-            data = io.pyfits.getdata(self.input_file)
+            data = self.read_cube(self.input_file)
             corr_cube = np.empty_like(data)
 
             x = np.arange(self.width)
@@ -838,20 +867,21 @@ class PhaseMapExtractor:
             x, y = np.meshgrid(x, y)
             x, y = np.ravel(x), np.ravel(y)
 
+            progress = Progress(x.size, _log, name='Correlating',
+                                unit='spectra')
             for i in range(x.size):
                 s = data[:, y[i], x[i]]
                 s = s / s.max()  # Normalize
                 s = s - s.mean()  # Remove mean to avoid triangular shape
                 s = np.correlate(s, self.ref_s, mode='same')
                 corr_cube[:, y[i], x[i]] = s
+                progress.update()
 
-                temp = ((i + 1) * 100.00 / x.size)
-                sys.stdout.write('\r %2d%% ' % temp)
-                sys.stdout.write(self.loading[int(temp * 10 % 5)])
-                sys.stdout.flush()
-
-            _log.info("Done.")
-            corr_name = os.path.splitext(self.input_file)[0] + '--corrcube.fits'
+            progress.finish()
+            corr_name = os.path.splitext(self.input_file)[0] + '--corrcube'
+            if self.roi is not None:
+                corr_name += '--roi_{:d}_{:d}_{:d}_{:d}'.format(*self.roi)
+            corr_name += '.fits'
             _log.info("Saving correlation cube to %s" % corr_name)
 
             corr_hdr = self.header.copy()
@@ -865,6 +895,18 @@ class PhaseMapExtractor:
 
             return corr_name
 
+    def read_cube(self, filename):
+        """
+        Read a data-cube or, if a region of interest was given, only the
+        part of it inside the region.
+        """
+        if self.roi is None:
+            return io.pyfits.getdata(filename)
+
+        x0, x1, y0, y1 = self.roi
+        with io.pyfits.open(filename, memmap=True) as hdul:
+            return hdul[0].section[:, y0:y1, x0:x1]
+
     def save(self):
 
         # Getting the input information to work on in
@@ -893,6 +935,10 @@ class PhaseMapExtractor:
         h.set('PHMSAMP', value=self.current_sampling,
               comment="Sampling per channel", after='PHMUNIT')
 
+        if 'CCDSUM' in self.header:
+            h.set('CCDSUM', value=self.header['CCDSUM'],
+                  comment='Phase-map binning', after='PHMSAMP')
+
         self.phase_map = self.phase_map - self.phase_map[
             self.ref_y, self.ref_x]
 
@@ -0,0 +1,372 @@
+"""
+    Batch Fit
+
+    Non-linear least-squares fitting of many independent spectra at once. The
+    parameters of all the spectra are kept in a single (N x K) array and each
+    Levenberg-Marquardt iteration is performed with numpy operations over the
+    whole batch. Every spectrum has its own damping factor and convergence
+    flag, so spectra that already converged are not touched again.
+
+    When the instrumental profile is known, spectra can instead be matched
+    against a `TemplateBank` of unit-amplitude profiles with a single matrix
+    product per chunk of spectra.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+__all__ = ['gaussian', 'lorentzian', 'levenberg_marquardt', 'unit_airy',
+           'unit_gaussian', 'unit_lorentzian', 'TemplateBank']
+
+
+def gaussian(z, p):
+    """
+    Gaussian plus constant and its Jacobian.
+
+    Parameters
+    ----------
+        z : numpy.ndarray
+            The spectral axis with M elements.
+
+        p : numpy.ndarray
+            A (N x 4) array with amplitude, mean, stddev and constant.
+
+    Returns
+    -------
+        f : numpy.ndarray
+            A (N x M) array with the model evaluated for each spectrum.
+
+        jacobian : numpy.ndarray
+            A (N x M x 4) array with the model derivatives.
+    """
+    a, m, s, c = [p[:, i:i + 1] for i in range(4)]
+
+    u = (z - m) / s
+    e = np.exp(-0.5 * u ** 2)
+
+    f = a * e + c
+    jacobian = np.stack(
+        [e, a * e * u / s, a * e * u ** 2 / s, np.ones_like(e)], axis=-1)
+
+    return f, jacobian
+
+
+def lorentzian(z, p):
+    """
+    Lorentzian plus constant and its Jacobian. The model is the same as
+    `astropy.modeling.models.Lorentz1D`.
+
+    Parameters
+    ----------
+        z : numpy.ndarray
+            The spectral axis with M elements.
+
+        p : numpy.ndarray
+            A (N x 4) array with amplitude, center, FWHM and constant.
+
+    Returns
+    -------
+        f : numpy.ndarray
+            A (N x M) array with the model evaluated for each spectrum.
+
+        jacobian : numpy.ndarray
+            A (N x M x 4) array with the model derivatives.
+    """
+    a, x_0, fwhm, c = [p[:, i:i + 1] for i in range(4)]
+
+    g = fwhm / 2.
+    d = z - x_0
+    den = d ** 2 + g ** 2
+    profile = g ** 2 / den
+
+    f = a * profile + c
+    jacobian = np.stack(
+        [profile,
+         2 * a * g ** 2 * d / den ** 2,
+         a * g * d ** 2 / den ** 2,
+         np.ones_like(profile)], axis=-1)
+
+    return f, jacobian
+
+
+def _solve(a, b):
+    """Solve a batch of linear systems even if some of them are singular."""
+    try:
+        return np.linalg.solve(a, b[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('nkl,nl->nk', np.linalg.pinv(a), b)
+
+
+def levenberg_marquardt(model, z, data, p0, max_iter=100, ftol=1.5e-8,
+                        xtol=1.5e-8, damping=1e-3):
+    """
+    Fit a model to many spectra at once using the Levenberg-Marquardt
+    algorithm.
+
+    Parameters
+    ----------
+        model : callable
+            A function with the same signature as `gaussian`.
+
+        z : numpy.ndarray
+            The spectral axis with M elements.
+
+        data : numpy.ndarray
+            A (N x M) array with one spectrum per row.
+
+        p0 : numpy.ndarray
+            A (N x K) array with the initial guesses.
+
+        max_iter : int
+            Maximum number of iterations.
+
+        ftol : float
+            Relative reduction of the sum of squares considered as converged.
+
+        xtol : float
+            Relative step size considered as converged.
+
+        damping : float
+            Initial damping factor.
+
+    Returns
+    -------
+        p : numpy.ndarray
+            A (N x K) array with the fitted parameters. Spectra that did not
+            converge are filled with NaN.
+
+        converged : numpy.ndarray
+            A boolean array with N elements.
+
+        n_iter : numpy.ndarray
+            Number of iterations used for each spectrum.
+    """
+    data = np.asarray(data, dtype=float)
+    p = np.array(p0, dtype=float)
+    n, k = p.shape
+
+    f, jacobian = model(z, p)
+    residual = data - f
+    chi2 = np.sum(residual ** 2, axis=1)
+
+    damp = np.full(n, damping)
+    active = np.isfinite(chi2)
+    converged = np.zeros(n, dtype=bool)
+    n_iter = np.zeros(n, dtype=int)
+
+    diagonal = np.arange(k)
+
+    for _ in range(max_iter):
+
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+
+        j = jacobian[idx]
+        alpha = np.einsum('nmk,nml->nkl', j, j)
+        beta = np.einsum('nmk,nm->nk', j, residual[idx])
+
+        scale = alpha[:, diagonal, diagonal]
+        scale = np.maximum(scale, 1e-12 * scale.max(axis=1, keepdims=True))
+        alpha[:, diagonal, diagonal] += damp[idx, np.newaxis] * scale
+
+        with np.errstate(all='ignore'):
+            step = _solve(alpha, beta)
+            p_new = p[idx] + step
+            f_new, j_new = model(z, p_new)
+            residual_new = data[idx] - f_new
+            chi2_new = np.sum(residual_new ** 2, axis=1)
+
+        n_iter[idx] += 1
+
+        better = np.isfinite(chi2_new) & (chi2_new <= chi2[idx])
+        accepted = idx[better]
+
+        with np.errstate(all='ignore'):
+            reduction = (chi2[accepted] - chi2_new[better]) / chi2[accepted]
+            small_step = np.max(
+                np.abs(step[better]) / (np.abs(p[accepted]) + xtol), axis=1)
+
+        p[accepted] = p_new[better]
+        jacobian[accepted] = j_new[better]
+        residual[accepted] = residual_new[better]
+        chi2[accepted] = chi2_new[better]
+        damp[accepted] /= 10.
+        damp[idx[~better]] *= 10.
+
+        done = accepted[(reduction <= ftol) | (small_step <= xtol) |
+                        (chi2[accepted] == 0)]
+
+        # No step can reduce the sum of squares anymore
+        stuck = idx[damp[idx] > 1e10]
+
+        converged[done] = True
+        converged[stuck] = True
+        active[done] = False
+        active[stuck] = False
+
+    converged &= np.all(np.isfinite(p), axis=1)
+    p[~converged] = np.nan
+
+    return p, converged, n_iter
+
+
+def unit_gaussian(z, center, stddev):
+    """Gaussian with unit amplitude."""
+    return np.exp(-0.5 * ((z - center) / stddev) ** 2)
+
+
+def unit_lorentzian(z, center, fwhm):
+    """Lorentzian with unit amplitude."""
+    g = fwhm / 2.
+    return g ** 2 / ((z - center) ** 2 + g ** 2)
+
+
+def unit_airy(z, center, fwhm, fsr):
+    """
+    Airy function with unit amplitude. This is the Fabry-Perot transmission
+    profile, periodic over the free-spectral-range `fsr`.
+    """
+    f = 1. / np.sin(np.pi * fwhm / (2. * fsr)) ** 2
+    return 1. / (1. + f * np.sin(np.pi * (z - center) / fsr) ** 2)
+
+
+class TemplateBank:
+    """
+    A bank of unit-amplitude line profiles computed over a grid of centers and
+    widths. Each spectrum is modeled as `amplitude * template + continuum`.
+    Both have closed-form solutions for every template, so the best template
+    of many spectra is found with a single matrix product. The best template
+    is then refined by parabolic interpolation of the goodness of fit over
+    its neighbours in the grid.
+
+    Parameters
+    ----------
+        z : numpy.ndarray
+            The spectral axis with M elements.
+
+        profile : callable
+            A function like `unit_gaussian` with the (z, center, width)
+            signature.
+
+        centers : numpy.ndarray
+            Template centers. They must be equally spaced.
+
+        widths : numpy.ndarray
+            Template widths. They must be equally spaced in logarithm.
+
+        period : float or None
+            If the profile is periodic (e.g. Airy), its period. The centers
+            are then considered periodic too.
+    """
+
+    def __init__(self, z, profile, centers, widths, period=None):
+
+        self.z = np.asarray(z, dtype=float)
+        self.profile = profile
+        self.centers = np.asarray(centers, dtype=float)
+        self.widths = np.asarray(widths, dtype=float)
+        self.period = period
+
+        c, w = np.meshgrid(self.centers, self.widths, indexing='ij')
+        templates = profile(self.z[:, np.newaxis, np.newaxis], c, w)
+        templates = templates.reshape((self.z.size, -1))
+
+        # Removing the mean makes the amplitude independent of the continuum
+        self.templates = templates - templates.mean(axis=0)
+        self.norm = np.sum(self.templates ** 2, axis=0)
+
+    @property
+    def shape(self):
+        return self.centers.size, self.widths.size
+
+    def scores(self, data):
+        """
+        Return the reduction of the sum of squares achieved by each template
+        with a positive amplitude.
+
+        Parameters
+        ----------
+            data : numpy.ndarray
+                A (N x M) array with one spectrum per row.
+
+        Returns
+        -------
+            scores : numpy.ndarray
+                A (N x centers x widths) array.
+        """
+        projection = np.dot(data, self.templates)
+        scores = np.where(projection > 0, projection ** 2 / self.norm, 0)
+
+        return scores.reshape((data.shape[0],) + self.shape)
+
+    def fit(self, data):
+        """
+        Parameters
+        ----------
+            data : numpy.ndarray
+                A (N x M) array with one spectrum per row.
+
+        Returns
+        -------
+            p : numpy.ndarray
+                A (N x 4) array with amplitude, center, width and continuum.
+                Spectra without any positive match are filled with NaN.
+        """
+        data = np.asarray(data, dtype=float)
+        n = data.shape[0]
+        nc, nw = self.shape
+
+        scores = self.scores(data)
+
+        best = np.argmax(scores.reshape((n, -1)), axis=1)
+        ic, iw = np.unravel_index(best, self.shape)
+        rows = np.arange(n)
+
+        # Refine the center ---
+        if self.period is None:
+            left, right = np.clip(ic - 1, 0, nc - 1), np.clip(ic + 1, 0, nc - 1)
+        else:
+            left, right = (ic - 1) % nc, (ic + 1) % nc
+
+        offset = self._vertex(scores[rows, left, iw], scores[rows, ic, iw],
+                              scores[rows, right, iw])
+        offset[(left == ic) | (right == ic)] = 0
+
+        step = self.centers[1] - self.centers[0] if nc > 1 else 0
+        center = self.centers[ic] + offset * step
+        if self.period is not None:
+            center = self.centers[0] + np.mod(center - self.centers[0],
+                                              self.period)
+
+        # Refine the width ---
+        down, up = np.clip(iw - 1, 0, nw - 1), np.clip(iw + 1, 0, nw - 1)
+        offset = self._vertex(scores[rows, ic, down], scores[rows, ic, iw],
+                              scores[rows, ic, up])
+        offset[(down == iw) | (up == iw)] = 0
+
+        log_step = np.log(self.widths[1] / self.widths[0]) if nw > 1 else 0
+        width = self.widths[iw] * np.exp(offset * log_step)
+
+        # Closed-form amplitude and continuum for the refined template ---
+        t = self.profile(self.z, center[:, np.newaxis], width[:, np.newaxis])
+        t_mean = t.mean(axis=1)
+        t = t - t_mean[:, np.newaxis]
+
+        with np.errstate(all='ignore'):
+            amplitude = np.sum(data * t, axis=1) / np.sum(t ** 2, axis=1)
+        continuum = data.mean(axis=1) - amplitude * t_mean
+
+        p = np.column_stack([amplitude, center, width, continuum])
+        p[~(scores[rows, ic, iw] > 0)] = np.nan
+
+        return p
+
+    @staticmethod
+    def _vertex(left, center, right):
+        """Position of the vertex of a parabola through three points."""
+        with np.errstate(all='ignore'):
+            offset = 0.5 * (left - right) / (left - 2 * center + right)
+
+        offset[~np.isfinite(offset)] = 0
+        return np.clip(offset, -0.5, 0.5)
@@ -0,0 +1,131 @@
+"""
+    Chunks
+
+    Helpers to process data-cubes in spatial tiles without loading the whole
+    cube into memory.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from astropy.io import fits
+
+__all__ = ['create_cube', 'iter_tiles', 'region']
+
+
+def iter_tiles(height, width, size):
+    """
+    Split an image into tiles containing about `size` pixels. Tiles are bands
+    of whole rows whenever a row has less than `size` pixels so the data is
+    read in contiguous blocks.
+
+    Parameters
+    ----------
+        height : int
+            The image height.
+
+        width : int
+            The image width.
+
+        size : int
+            Maximum number of pixels inside each tile.
+
+    Yields
+    ------
+        tile : tuple
+            (y_start, y_end, x_start, x_end) using Python's slicing convention.
+    """
+    size = max(1, int(size))
+
+    rows = max(1, size // width)
+    cols = min(width, size)
+
+    for y0 in range(0, height, rows):
+        for x0 in range(0, width, cols):
+            yield y0, min(y0 + rows, height), x0, min(x0 + cols, width)
+
+
+def region(height, width, roi=None):
+    """
+    Check a region of interest of an image and replace its missing or
+    negative limits, like a Python slice does.
+
+    Parameters
+    ----------
+        height : int
+            The image height.
+
+        width : int
+            The image width.
+
+        roi : tuple or None
+            (x_start, x_end, y_start, y_end) using Python's slicing
+            convention. Any limit can be None. The whole image is used if
+            None.
+
+    Returns
+    -------
+        roi : tuple
+            (x_start, x_end, y_start, y_end) within the image.
+    """
+    if roi is None:
+        return 0, width, 0, height
+
+    x0, x1, y0, y1 = roi
+    x0, x1, _ = slice(x0, x1).indices(width)
+    y0, y1, _ = slice(y0, y1).indices(height)
+
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('Empty region of interest: {}'.format(tuple(roi)))
+
+    return x0, x1, y0, y1
+
+
+def create_cube(filename, header, shape, dtype=np.float32, overwrite=False):
+    """
+    Create a FITS file filled with zeros without allocating its data in
+    memory. The file can then be opened with `mode='update'` and
+    `memmap=True` and filled tile by tile.
+
+    Parameters
+    ----------
+        filename : str
+            The output filename.
+
+        header : astropy.io.fits.Header
+            The header to be used. Its BITPIX and NAXIS cards are replaced.
+
+        shape : tuple
+            The data shape (depth, height, width).
+
+        dtype : numpy.dtype
+            The output data type.
+
+        overwrite : bool
+            Overwrite an existing file?
+
+    Returns
+    -------
+        header : astropy.io.fits.Header
+            The header written to the file.
+    """
+    header = header.copy()
+    for key in ['BZERO', 'BSCALE']:
+        header.remove(key, ignore_missing=True)
+
+    dummy = np.zeros((1,) * len(shape), dtype=dtype)
+    header = fits.PrimaryHDU(data=dummy, header=header).header
+
+    for i, n in enumerate(shape[::-1]):
+        header['NAXIS{:d}'.format(i + 1)] = n
+
+    header.tofile(filename, overwrite=overwrite)
+
+    n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    n_bytes = int(np.ceil(n_bytes / 2880.)) * 2880
+
+    with open(filename, 'rb+') as fobj:
+        fobj.seek(len(header.tostring()) + n_bytes - 1)
+        fobj.write(b'\0')
+
+    return header
@@ -0,0 +1,225 @@
+"""
+    Periodic Spectra
+
+    Fabry-Perot spectra are periodic over the free-spectral-range. The methods
+    here operate on whole chunks of spectra at once. The spectral axis is
+    always the first one, as in the data-cubes, so a chunk can be a single
+    spectrum, a (z, n) array or a (z, y, x) sub-cube.
+
+    Periodic spectra are also easy to measure in the Fourier domain: the
+    phase of the first harmonic gives the line center modulo the period and
+    the decay of the harmonics gives the line width (see `fourier_moments`).
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from scipy import interpolate
+
+__all__ = ['cubic_oversample', 'cubic_shift', 'fourier_moments',
+           'fourier_oversample', 'fourier_shift', 'linear_shift']
+
+
+def fourier_shift(data, shift, period=None):
+    """
+    Shift periodic spectra by a fraction of a channel using the Fourier shift
+    theorem.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra to be shifted with the spectral axis first.
+
+        shift : float or numpy.ndarray
+            Shift in channels, one for each spectrum. Positive values move the
+            spectra towards higher channels, like `numpy.roll`.
+
+        period : int or None
+            The period of the spectra in channels (e.g. the free-spectral-range).
+            Only the first `period` channels are used. Defaults to the number of
+            channels.
+
+    Returns
+    -------
+        shifted : numpy.ndarray
+            The shifted spectra with `period` channels.
+    """
+    data = np.asarray(data)
+    n = data.shape[0] if period is None else int(period)
+
+    if n > data.shape[0]:
+        raise ValueError('Period ({:d}) is larger than the number of channels '
+                         '({:d}).'.format(n, data.shape[0]))
+
+    spectra = np.fft.rfft(data[:n], axis=0)
+    k = np.fft.rfftfreq(n).reshape((-1,) + (1,) * (data.ndim - 1))
+    s = np.asarray(shift, dtype=float)[np.newaxis]
+
+    phase = np.exp(-2j * np.pi * k * s)
+
+    # Keep the Nyquist component real
+    if n % 2 == 0:
+        phase[-1] = np.cos(np.pi * s[0])
+
+    return np.fft.irfft(spectra * phase, n=n, axis=0)
+
+
+def _sample_positions(data, shift, period):
+    """
+    Return the spectra over one period and, for every output channel, the
+    integer and fractional positions in the input spectra that it samples.
+    """
+    data = np.asarray(data)
+    n = data.shape[0] if period is None else int(period)
+
+    if n > data.shape[0]:
+        raise ValueError('Period ({:d}) is larger than the number of channels '
+                         '({:d}).'.format(n, data.shape[0]))
+
+    data = data[:n]
+    z = np.arange(n).reshape((-1,) + (1,) * (data.ndim - 1))
+    position = z - np.asarray(shift, dtype=float)[np.newaxis]
+
+    index = np.floor(position)
+    fraction = np.broadcast_to(position - index, data.shape)
+    index = np.broadcast_to(index.astype(int) % n, data.shape)
+
+    return data, index, fraction
+
+
+def linear_shift(data, shift, period=None):
+    """
+    Shift periodic spectra using linear interpolation. The parameters and
+    returned values are the same as in `fourier_shift`.
+    """
+    data, i0, t = _sample_positions(data, shift, period)
+    i1 = (i0 + 1) % data.shape[0]
+
+    return (1 - t) * np.take_along_axis(data, i0, axis=0) + \
+        t * np.take_along_axis(data, i1, axis=0)
+
+
+def cubic_shift(data, shift, period=None):
+    """
+    Shift periodic spectra using periodic cubic-splines. The parameters and
+    returned values are the same as in `fourier_shift`.
+    """
+    data, i0, t = _sample_positions(data, shift, period)
+
+    z = np.arange(data.shape[0] + 1)
+    spline = interpolate.CubicSpline(
+        z, np.concatenate((data, data[:1]), axis=0), axis=0,
+        bc_type='periodic')
+
+    shifted = np.zeros(data.shape)
+    for c in spline.c:
+        shifted = shifted * t + np.take_along_axis(c, i0, axis=0)
+
+    return shifted
+
+
+def fourier_oversample(data, factor):
+    """
+    Oversample periodic spectra by zero-padding their Fourier transform. The
+    new samples are placed at every 1/`factor` channel starting at the first
+    one and are divided by `factor`, so the total flux is conserved.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra to be oversampled with the spectral axis first.
+
+        factor : int
+            The oversample factor.
+
+    Returns
+    -------
+        oversampled : numpy.ndarray
+            The oversampled spectra with `factor` times more channels.
+    """
+    data = np.asarray(data)
+    n = data.shape[0]
+
+    spectra = np.fft.rfft(data, axis=0)
+
+    # The Nyquist component is split between positive and negative
+    # frequencies once it is not the Nyquist frequency anymore
+    if n % 2 == 0 and factor > 1:
+        spectra[-1] *= 0.5
+
+    # irfft normalizes by the new size, which already divides by `factor`
+    return np.fft.irfft(spectra, n=factor * n, axis=0)
+
+
+def cubic_oversample(data, factor):
+    """
+    Oversample periodic spectra using periodic cubic-splines. The parameters
+    and returned values are the same as in `fourier_oversample`.
+    """
+    data = np.asarray(data)
+    n = data.shape[0]
+
+    z = np.arange(n + 1)
+    spline = interpolate.CubicSpline(
+        z, np.concatenate((data, data[:1]), axis=0), axis=0,
+        bc_type='periodic')
+
+    return spline(np.arange(factor * n) / factor) / factor
+
+
+def fourier_moments(data, period=None):
+    """
+    Measure a single emission line in periodic spectra from their first two
+    Fourier harmonics. The line is modeled as an Airy function plus a
+    constant, whose Fourier coefficients decay as `R ** k`, with `R` related
+    to its finesse. The ratio of the second to the first harmonic gives `R`
+    and, with it, the FWHM. The phase of the first harmonic gives the center,
+    its amplitude gives the peak and the zero-th harmonic gives the
+    continuum. Spectra where the harmonics do not decay (e.g. flat or noisy
+    spectra) are filled with NaN.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra with the spectral axis first.
+
+        period : int or None
+            The period of the spectra in channels (e.g. the free-spectral-range).
+            Only the first `period` channels are used. Defaults to the number of
+            channels.
+
+    Returns
+    -------
+        results : numpy.ndarray
+            A (4 x ...) array with the peak, center, FWHM and continuum. The
+            center, within [0, period), and the FWHM are given in channels.
+    """
+    data = np.asarray(data, dtype=float)
+    n = data.shape[0] if period is None else int(period)
+
+    if n > data.shape[0]:
+        raise ValueError('Period ({:d}) is larger than the number of channels '
+                         '({:d}).'.format(n, data.shape[0]))
+
+    harmonics = np.fft.rfft(data[:n], axis=0)[:3] / n
+    if harmonics.shape[0] < 3:
+        raise ValueError('At least 4 channels are needed to measure the lines '
+                         '({:d} found).'.format(n))
+
+    f1 = np.abs(harmonics[1])
+
+    with np.errstate(all='ignore'):
+        r = np.abs(harmonics[2]) / f1
+
+        # Airy function with unit peak: (1 - R) / (1 + R) * (1 + 2 sum R^k)
+        peak = f1 * (1 + r) / (r * (1 - r))
+        continuum = harmonics[0].real - f1 / r
+
+        center = np.mod(-np.angle(harmonics[1]) * n / (2 * np.pi), n)
+        coefficient = 4 * r / (1 - r) ** 2
+        fwhm = 2 * n / np.pi * np.arcsin(1. / np.sqrt(coefficient))
+
+    results = np.array([peak, center, fwhm, continuum])
+    results[:, ~((r > 0) & (r < 1))] = np.nan
+
+    return results
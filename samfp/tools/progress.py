@@ -0,0 +1,104 @@
+"""
+    Progress
+
+    Progress and throughput reports for long-running operations. A `Progress`
+    is fed with the number of items (spectra, pixels, ...) of each completed
+    chunk of work and reports done/total, items per second and the estimated
+    time left through a logger. Reports are written at most once every
+    `interval` seconds, so updating it costs one clock reading.
+"""
+from __future__ import division, print_function
+
+import datetime
+import logging
+import time
+
+__all__ = ['Progress']
+
+
+class Progress:
+    """
+    Parameters
+    ----------
+        total : int
+            Total number of items.
+
+        log : logging.Logger
+            The logger used for the reports.
+
+        name : str
+            What is being done, e.g. 'Fitting'.
+
+        unit : str
+            The name of the items, e.g. 'spectra'.
+
+        interval : float
+            Minimum time between reports in seconds.
+
+        level : int
+            The logging level of the reports.
+    """
+
+    def __init__(self, total, log, name='Progress', unit='items',
+                 interval=5., level=logging.INFO):
+
+        self.total = int(total)
+        self.log = log
+        self.name = name
+        self.unit = unit
+        self.interval = interval
+        self.level = level
+
+        self.done = 0
+        self.start = time.time()
+        self._last = self.start
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """Items per second."""
+        return self.done / max(self.elapsed, 1e-9)
+
+    @property
+    def eta(self):
+        """Estimated time left in seconds."""
+        rate = self.rate
+        if rate == 0:
+            return float('inf')
+        return max(self.total - self.done, 0) / rate
+
+    def update(self, n=1):
+        """
+        Add `n` completed items and report if `interval` seconds have passed
+        since the last report.
+        """
+        self.done += n
+
+        now = time.time()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def report(self):
+
+        eta = self.eta
+        eta = '--:--:--' if eta == float('inf') else \
+            str(datetime.timedelta(seconds=int(round(eta))))
+
+        self.log.log(
+            self.level, ' {:s}: {:d}/{:d} {:s} ({:.0f}%) - {:.0f} {:s}/s - '
+            'ETA {:s}'.format(self.name, self.done, self.total, self.unit,
+                              100. * self.done / max(self.total, 1),
+                              self.rate, self.unit, eta))
+
+    def finish(self):
+        """
+        Report the total time and the average throughput.
+        """
+        self.log.log(
+            self.level, ' {:s}: {:d} {:s} in {:.1f} s ({:.0f} {:s}/s).'.format(
+                self.name, self.done, self.unit, self.elapsed, self.rate,
+                self.unit))
@@ -0,0 +1,148 @@
+"""
+    Signal-to-Noise
+
+    Vectorised signal-to-noise estimates of emission lines in data-cubes. The
+    signal is the peak above the median of each spectrum and the noise is the
+    median absolute deviation along the spectral axis scaled to a standard
+    deviation, so it is robust to the emission line itself.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from astropy.io import fits
+
+from . import chunks
+
+__all__ = ['differential_noise', 'signal_and_noise', 'signal_to_noise',
+           'snr_map']
+
+# Converts the median absolute deviation into a standard deviation
+MAD_TO_STD = 1.4826
+
+
+def signal_and_noise(data):
+    """
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra with the spectral axis first (e.g. a (Z x Y x X) cube).
+
+    Returns
+    -------
+        peak : numpy.ndarray
+            The peak above the median of each spectrum.
+
+        noise : numpy.ndarray
+            The robust noise of each spectrum.
+    """
+    data = np.asarray(data, dtype=float)
+
+    median = _median(data)
+    peak = np.max(data, axis=0) - median
+    noise = MAD_TO_STD * _median(np.abs(data - median))
+
+    return peak, noise
+
+
+def _median(data):
+    """
+    Same as `numpy.median` along the first axis, but without its overhead,
+    which dominates the many small calls made by the Voronoi binning.
+    """
+    n = data.shape[0]
+    half = n // 2
+
+    if n % 2:
+        median = np.partition(data, half, axis=0)[half]
+    else:
+        part = np.partition(data, [half - 1, half], axis=0)
+        median = 0.5 * (part[half - 1] + part[half])
+
+    return np.where(np.isnan(data).any(axis=0), np.nan, median)
+
+
+def differential_noise(data):
+    """
+    Noise of each spectrum from the median absolute value of the second
+    differences between adjacent channels, like DER_SNR (Stoehr et al. 2008)
+    without its two-channel step, since the channels of a scan are
+    independent exposures. Lines spanning several channels barely change the
+    second differences, so this is closer to the channel-to-channel noise
+    than the median absolute deviation of bright spectra.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra with the spectral axis first and at least 3 channels.
+
+    Returns
+    -------
+        noise : numpy.ndarray
+            The noise of each spectrum.
+    """
+    data = np.asarray(data, dtype=float)
+
+    second = 2 * data[1:-1] - data[:-2] - data[2:]
+
+    return MAD_TO_STD / np.sqrt(6.) * np.median(np.abs(second), axis=0)
+
+
+def signal_to_noise(data):
+    """
+    Parameters
+    ----------
+        data : numpy.ndarray
+            Spectra with the spectral axis first (e.g. a (Z x Y x X) cube).
+
+    Returns
+    -------
+        snr : numpy.ndarray
+            The peak over the robust noise of each spectrum. Flat spectra
+            have zero signal-to-noise.
+    """
+    return _ratio(*signal_and_noise(data))
+
+
+def _ratio(signal, noise):
+    with np.errstate(all='ignore'):
+        return np.where(noise > 0, signal / noise,
+                        np.where(signal > 0, np.inf, 0))
+
+
+def snr_map(filename, chunk_size=65536, split=False):
+    """
+    Signal-to-noise of every spectrum of a data-cube. The cube is read in
+    tiles, so it never needs to fit in memory.
+
+    Parameters
+    ----------
+        filename : str
+            The data-cube filename.
+
+        chunk_size : int
+            Maximum number of spectra read at once.
+
+        split : bool
+            Return the signal and the noise images instead of their ratio?
+
+    Returns
+    -------
+        snr : numpy.ndarray
+            A (Y x X) image or, if `split` is True, a (signal, noise) tuple.
+    """
+    data = fits.getdata(filename, memmap=True)
+    depth, height, width = data.shape
+
+    signal = np.empty((height, width))
+    noise = np.empty((height, width))
+    for y0, y1, x0, x1 in chunks.iter_tiles(height, width, chunk_size):
+        signal[y0:y1, x0:x1], noise[y0:y1, x0:x1] = \
+            signal_and_noise(data[:, y0:y1, x0:x1])
+
+    del data
+
+    if split:
+        return signal, noise
+
+    return _ratio(signal, noise)
@@ -0,0 +1,203 @@
+"""
+    Spectral Cache
+
+    FITS data-cubes are stored as (z, y, x), so each spectrum is strided
+    across the whole file and reading spectra from memory-mapped cubes larger
+    than the RAM thrashes the page cache. A spectral cache is a `.npy` copy
+    of the cube stored as (y, x, z), where each spectrum is contiguous. It is
+    saved next to the cube as a hidden sidecar file whose name contains a key
+    of the cube, so a modified cube never uses an old cache.
+
+    `open_cube` returns either the memory-mapped FITS data or a
+    `SpectralCube`, which is indexed the same way, so the code reading the
+    spectra does not need to know which one it got.
+"""
+from __future__ import division, print_function
+
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from astropy.io import fits
+
+from . import chunks
+
+__all__ = ['build_cache', 'cache_filename', 'cube_key', 'open_cube',
+           'SpectralCube']
+
+
+def cube_key(filename):
+    """
+    Return a key that changes whenever the cube changes. It hashes the
+    primary header, the file size and its modification time, so it does not
+    need to read the data.
+    """
+    header = fits.getheader(filename)
+    stat = os.stat(filename)
+
+    h = hashlib.sha1(header.tostring().encode())
+    h.update('{:d} {:d}'.format(stat.st_size, stat.st_mtime_ns).encode())
+
+    return h.hexdigest()[:16]
+
+
+def cache_filename(filename):
+    """
+    Return the name of the spectral cache of a cube.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.{:s}.{:s}.yxz.npy'.format(
+        name, cube_key(filename)))
+
+
+def build_cache(filename, chunk_size=65536):
+    """
+    Create the spectral cache of a cube with a blocked transpose: bands of
+    rows are read from the FITS file, transposed in memory and written to
+    the cache. Old caches of the same cube are removed.
+
+    Parameters
+    ----------
+        filename : str
+            The data-cube filename.
+
+        chunk_size : int
+            Maximum number of spectra transposed at once.
+
+    Returns
+    -------
+        cache : str
+            The cache filename.
+    """
+    cache = cache_filename(filename)
+
+    data = fits.getdata(filename, memmap=True)
+    depth, height, width = data.shape
+
+    temp = cache + '.temp.npy'
+    out = np.lib.format.open_memmap(
+        temp, mode='w+', dtype=data.dtype.newbyteorder('='),
+        shape=(height, width, depth))
+
+    for y0, y1, x0, x1 in chunks.iter_tiles(height, width, chunk_size):
+        out[y0:y1, x0:x1] = np.transpose(data[:, y0:y1, x0:x1], (1, 2, 0))
+
+    out.flush()
+    del out, data
+
+    # Only complete caches get the final name ---
+    os.replace(temp, cache)
+
+    directory, name = os.path.split(os.path.abspath(filename))
+    for old in glob.glob(os.path.join(directory, '.{:s}.*.yxz.npy'.format(
+            glob.escape(name)))):
+        if old != cache:
+            os.remove(old)
+
+    return cache
+
+
+def open_cube(filename, cache=False, roi=None):
+    """
+    Open a data-cube for reading.
+
+    Parameters
+    ----------
+        filename : str
+            The data-cube filename.
+
+        cache : bool
+            Use the spectral cache of the cube, building it if needed?
+
+        roi : tuple or None
+            A (x_start, x_end, y_start, y_end) region of interest (see
+            `chunks.region`). The cube is indexed relative to it and nothing
+            outside it is ever read.
+
+    Returns
+    -------
+        data : numpy.memmap or SpectralCube
+            The (Z x Y x X) memory-mapped data of the cube or, if `cache` is
+            True, its spectral cache.
+    """
+    if not cache:
+        data = fits.getdata(filename, memmap=True)
+        if roi is None:
+            return data
+
+        x0, x1, y0, y1 = chunks.region(data.shape[1], data.shape[2], roi)
+        return data[:, y0:y1, x0:x1]
+
+    name = cache_filename(filename)
+    if not os.path.exists(name):
+        name = build_cache(filename)
+
+    return SpectralCube(name, roi=roi)
+
+
+class SpectralCube:
+    """
+    A read-only spectral cache indexed as the original (z, y, x) cube. Only
+    integers and slices are supported. Spectra are read contiguously from
+    the (y, x, z) file and the spectral axis is moved back to the front.
+
+    Parameters
+    ----------
+        filename : str
+            The cache filename (see `build_cache`).
+
+        roi : tuple or None
+            A (x_start, x_end, y_start, y_end) region of interest. The cube
+            is indexed relative to it.
+    """
+
+    def __init__(self, filename, roi=None):
+        self.filename = filename
+        self._data = np.load(filename, mmap_mode='r')
+
+        if roi is not None:
+            height, width = self._data.shape[:2]
+            x0, x1, y0, y1 = chunks.region(height, width, roi)
+            self._data = self._data[y0:y1, x0:x1]
+
+    @property
+    def shape(self):
+        height, width, depth = self._data.shape
+        return depth, height, width
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if Ellipsis in key or len(key) > 3:
+            raise IndexError('Only up to three integers or slices are '
+                             'supported.')
+
+        z, y, x = key + (slice(None),) * (3 - len(key))
+        for k in (z, y, x):
+            if not isinstance(k, (slice, int, np.integer)):
+                raise IndexError('Only integers and slices are supported.')
+
+        block = self._data[y, x, z]
+
+        if isinstance(z, slice):
+            block = np.moveaxis(block, -1, 0)
+
+        return block
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
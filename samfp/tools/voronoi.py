@@ -0,0 +1,228 @@
+"""
+    Voronoi Binning
+
+    Adaptive spatial binning of images to a target signal-to-noise, following
+    the bin-accretion and Voronoi tessellation steps of Cappellari & Copin
+    (2003, MNRAS 342, 345). Pixels that already reach the target are kept as
+    single-pixel bins, so bright regions keep the full resolution.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from scipy import spatial
+
+__all__ = ['accrete', 'voronoi_bins']
+
+_neighbours = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+
+def accrete(signal, noise, target_snr, mask=None, max_roundness=0.3,
+            spectra=None, sn_func=None):
+    """
+    Grow bins of connected pixels until they reach the target
+    signal-to-noise. Each bin starts from the faint pixel with the highest
+    signal-to-noise that is still free and accretes, among its free
+    neighbours, the closest one to its centroid that keeps the bin round and
+    moves its signal-to-noise closer to the target. Neighbours failing these
+    tests are skipped, not accreted, so a single noisy pixel does not stop
+    the bin. A bin stops growing when none of its neighbours passes. As in
+    Cappellari & Copin (2003), a bin that stops with at least 80% of the
+    target signal-to-noise is kept and the pixels of the others are left
+    unbinned.
+
+    Parameters
+    ----------
+        signal : numpy.ndarray
+            A (Y x X) image with the signal of each pixel.
+
+        noise : numpy.ndarray
+            A (Y x X) image with the noise of each pixel. The noise of a bin
+            is the quadratic sum of the noise of its pixels.
+
+        target_snr : float
+            The signal-to-noise that each bin should reach.
+
+        mask : numpy.ndarray or None
+            A (Y x X) boolean image with the pixels that can be binned.
+
+        max_roundness : float
+            Maximum relative excess of the bin radius over the radius of a
+            disk with the same area.
+
+        spectra : numpy.ndarray or None
+            A (Y x X x Z) array with an additive quantity of each pixel,
+            e.g. its spectrum. A running sum is kept for each bin, so every
+            candidate only adds its own spectrum.
+
+        sn_func : callable or None
+            A function returning the signal-to-noise of N candidate bins
+            from the (N x Z) sums of the `spectra` of their pixels. Both
+            must be given together. By
+            default the signal of the pixels is added linearly and their
+            noise in quadrature, which is only right when the signal is
+            additive. `signal` and `noise` are still used to sort the pixels
+            and to find the bright ones.
+
+    Returns
+    -------
+        labels : numpy.ndarray
+            A (Y x X) integer image with the bin of each pixel. Pixels that
+            could not be binned are labelled -1.
+    """
+    signal = np.asarray(signal, dtype=float)
+    noise = np.asarray(noise, dtype=float)
+    height, width = signal.shape
+
+    if (spectra is None) != (sn_func is None):
+        raise ValueError('spectra and sn_func must be given together.')
+
+    if spectra is None:
+        spectra = np.stack([signal, noise ** 2], axis=-1)
+
+        def sn_func(totals):
+            return totals[:, 0] / np.sqrt(totals[:, 1])
+
+    valid = np.isfinite(signal) & np.isfinite(noise) & (noise > 0)
+    if mask is not None:
+        valid &= np.asarray(mask, dtype=bool)
+
+    with np.errstate(all='ignore'):
+        snr = np.where(valid, signal / noise, -np.inf)
+
+    labels = np.full((height, width), -1, dtype=int)
+
+    # Bright pixels are bins by themselves ---
+    bright = valid & (snr >= target_snr)
+    n_bins = int(bright.sum())
+    labels[bright] = np.arange(n_bins)
+
+    free = valid & ~bright
+    order = np.argsort(-snr, axis=None)
+    order = order[free.ravel()[order]]
+
+    # Coordinates of the members of the current bin ---
+    members = np.empty((order.size, 2), dtype=int)
+
+    for seed in order:
+
+        y, x = divmod(int(seed), width)
+        if not free[y, x]:
+            continue
+
+        free[y, x] = False
+        members[0] = y, x
+        k = 1
+        msum = members[0].copy()
+        total = np.array(spectra[y, x], dtype=float)
+        bin_snr = sn_func(total[np.newaxis])[0]
+        frontier = set()
+
+        while True:
+
+            yy, xx = members[k - 1]
+            for dy, dx in _neighbours:
+                j, i = yy + dy, xx + dx
+                if 0 <= j < height and 0 <= i < width and free[j, i]:
+                    frontier.add((j, i))
+
+            frontier = set(p for p in frontier if free[p])
+            if not frontier:
+                break
+
+            # Closest candidates first. The first one that keeps the bin
+            # round and brings it closer to the target is accreted. All the
+            # candidates are tested at once ---
+            candidates = np.array(list(frontier))
+            distance = np.sum((candidates - msum / k) ** 2, axis=1)
+            candidates = candidates[np.argsort(distance, kind='stable')]
+
+            centers = (msum + candidates) / (k + 1)
+            r2_max = np.maximum(
+                np.max(np.sum((members[:k, np.newaxis] - centers) ** 2,
+                              axis=2), axis=0),
+                np.sum((candidates - centers) ** 2, axis=1))
+            roundness = np.sqrt(r2_max) / np.sqrt((k + 1) / np.pi) - 1.
+            candidates = candidates[roundness <= max_roundness]
+            if candidates.size == 0:
+                break
+
+            new_totals = total + spectra[candidates[:, 0], candidates[:, 1]]
+            new_snr = np.asarray(sn_func(new_totals), dtype=float)
+            closer = np.abs(new_snr - target_snr) <= abs(bin_snr - target_snr)
+            if not closer.any():
+                break
+
+            c = np.argmax(closer)
+            j, i = candidates[c]
+            members[k] = j, i
+            msum += members[k]
+            frontier.discard((j, i))
+            free[j, i] = False
+            k += 1
+            total = new_totals[c]
+            bin_snr = new_snr[c]
+
+        success = bin_snr >= 0.8 * target_snr
+
+        if success:
+            yy, xx = members[:k].T
+            labels[yy, xx] = n_bins
+            n_bins += 1
+
+    return labels
+
+
+def voronoi_bins(signal, noise, target_snr, mask=None, max_roundness=0.3,
+                 spectra=None, sn_func=None):
+    """
+    Adaptive binning to a target signal-to-noise. The bins found by
+    `accrete` are used as generators of a Voronoi tessellation that also
+    covers the pixels where the accretion failed. Single-pixel bins are kept
+    as they are.
+
+    Parameters
+    ----------
+        Same as `accrete`.
+
+    Returns
+    -------
+        labels : numpy.ndarray
+            A (Y x X) integer image with the bin of each pixel. Bins are
+            numbered from 0 and pixels outside the mask are labelled -1.
+    """
+    labels = accrete(signal, noise, target_snr, mask=mask,
+                     max_roundness=max_roundness, spectra=spectra,
+                     sn_func=sn_func)
+
+    valid = np.isfinite(signal) & np.isfinite(noise) & (noise > 0)
+    if mask is not None:
+        valid &= np.asarray(mask, dtype=bool)
+
+    counts = np.bincount(labels[labels >= 0], minlength=1)
+    single = (labels >= 0) & (counts[np.maximum(labels, 0)] == 1)
+    faint = valid & ~single
+
+    grouped = faint & (labels >= 0)
+    if grouped.any():
+
+        # Centroids of the accreted bins ---
+        y, x = np.nonzero(grouped)
+        ids, inverse = np.unique(labels[grouped], return_inverse=True)
+        n = np.bincount(inverse)
+        generators = np.column_stack([np.bincount(inverse, y) / n,
+                                      np.bincount(inverse, x) / n])
+
+        # Every faint pixel goes to the closest generator ---
+        y, x = np.nonzero(faint)
+        _, nearest = spatial.cKDTree(generators).query(np.column_stack([y, x]))
+        labels[y, x] = ids[nearest]
+
+    else:
+        labels[faint] = -1
+
+    # Number the bins from 0 ---
+    good = labels >= 0
+    labels[good] = np.unique(labels[good], return_inverse=True)[1]
+
+    return labels
@@ -1,18 +1,21 @@
-import itertools
-import logging
-import numpy as np
+import functools
 import multiprocessing
+import numpy as np
 import threading
 import sys
 
 from astropy.io import fits
-from scipy import interpolate
+from scipy import interpolate, sparse
 
-from . import io, version
+from . import chunks, io, periodic, speccache, version
+from .progress import Progress
 
 log = io.MyLogger(__name__)
 
-__all__ = ['ZCut', 'ZOversample', 'ZRepeat', 'OverSampler']
+__all__ = ['XYBin', 'XYCrop', 'ZCut', 'ZOversample', 'ZPipeline', 'ZRepeat',
+           'OverSampler', 'get_oversampler', 'linear_oversample_operator',
+           'run_batch', 'xy_bin', 'xy_crop', 'xy_crop_header', 'z_cut',
+           'z_oversample', 'z_repeat']
 
 
 # noinspection PyUnusedLocal,PyUnusedLocal
@@ -20,6 +23,284 @@ def signal_handler(s, frame):
     sys.exit()
 
 
+def z_cut(data, header, n_begin=None, n_end=None):
+    """
+    Keep only the channels of a cube between `n_begin` (inclusive) and
+    `n_end` (exclusive). Same as `ZCut`, but in memory.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The (Z x Y x X) cube.
+
+        header : astropy.io.fits.Header
+            The cube header. It is not modified.
+
+        n_begin, n_end : int or None
+            The first (inclusive) and last (exclusive) channels. Negative
+            values count the channels backwards.
+
+    Returns
+    -------
+        data : numpy.ndarray
+            The cut cube (a view of the input data).
+
+        header : astropy.io.fits.Header
+            The updated header.
+    """
+    depth = data.shape[0]
+
+    n_begin = 0 if n_begin is None else n_begin
+    n_end = depth if n_end is None else n_end
+
+    data = data[n_begin:n_end]
+    header = _cut_header(header.copy(), depth, data.shape[0], n_begin, n_end)
+
+    return data, header
+
+
+def z_oversample(data, header, oversample_factor, kind='linear',
+                 chunk_size=65536, log=None):
+    """
+    Oversample a cube in the spectral direction considering its spectra
+    periodic. Same as `ZOversample`, but in memory.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The (Z x Y x X) cube. It can be memory-mapped, since it is read
+            in spatial chunks.
+
+        header : astropy.io.fits.Header
+            The cube header. It is not modified.
+
+        oversample_factor : int
+            The oversample factor.
+
+        kind : str
+            'linear', 'fourier' or 'cubic' (see `get_oversampler`).
+
+        chunk_size : int
+            Maximum number of spectra oversampled at once.
+
+        log : logging.Logger or None
+            Report the progress to this logger.
+
+    Returns
+    -------
+        data : numpy.ndarray
+            The oversampled cube.
+
+        header : astropy.io.fits.Header
+            The updated header.
+    """
+    depth, height, width = data.shape
+    new_depth = oversample_factor * depth
+
+    oversample = get_oversampler(kind, depth, oversample_factor)
+
+    results = np.empty((new_depth, height, width))
+    progress = None if log is None else Progress(
+        width * height, log, name='Oversampling', unit='spectra')
+
+    for y0, y1, x0, x1 in chunks.iter_tiles(height, width, chunk_size):
+
+        block = np.asarray(data[:, y0:y1, x0:x1], dtype=float)
+        block = oversample(block.reshape((depth, -1)))
+
+        results[:, y0:y1, x0:x1] = \
+            block.reshape((new_depth, y1 - y0, x1 - x0))
+
+        if progress is not None:
+            progress.update((y1 - y0) * (x1 - x0))
+
+    if progress is not None:
+        progress.finish()
+
+    header = _oversample_header(header.copy(), depth, oversample_factor)
+
+    return results, header
+
+
+def z_repeat(data, header, n_before=0, n_after=0):
+    """
+    Add `n_before` and `n_after` copies of a cube to its beginning and to
+    its end. Same as `ZRepeat`, but in memory.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The (Z x Y x X) cube.
+
+        header : astropy.io.fits.Header
+            The cube header. It is not modified.
+
+        n_before, n_after : int
+            Number of copies.
+
+    Returns
+    -------
+        data : numpy.ndarray
+            The repeated cube.
+
+        header : astropy.io.fits.Header
+            The updated header.
+    """
+    depth = data.shape[0]
+
+    data = np.tile(data, (n_before + 1 + n_after, 1, 1))
+    header = _repeat_header(header.copy(), depth, n_before, n_after)
+
+    return data, header
+
+
+def xy_crop(data, header, roi):
+    """
+    Keep only a spatial region of interest of a cube. Same as `XYCrop`, but
+    in memory.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The (Z x Y x X) cube.
+
+        header : astropy.io.fits.Header
+            The cube header. It is not modified.
+
+        roi : tuple
+            The (x_start, x_end, y_start, y_end) region using Python's slicing
+            convention (see `chunks.region`).
+
+    Returns
+    -------
+        data : numpy.ndarray
+            The cropped cube (a view of the input data).
+
+        header : astropy.io.fits.Header
+            The updated header.
+    """
+    depth, height, width = data.shape
+    x0, x1, y0, y1 = chunks.region(height, width, roi)
+
+    data = data[:, y0:y1, x0:x1]
+    header = xy_crop_header(header.copy(), width, height, (x0, x1, y0, y1))
+
+    return data, header
+
+
+def xy_bin(data, header, binning, mode='sum'):
+    """
+    Bin a cube, or an image like a phase-map, in blocks of pixels. Same as
+    `XYBin`, but in memory. Columns and rows that do not fill a whole block
+    are left out.
+
+    Parameters
+    ----------
+        data : numpy.ndarray
+            The (Z x Y x X) cube or (Y x X) image.
+
+        header : astropy.io.fits.Header
+            The header. It is not modified.
+
+        binning : int or tuple
+            The block size or its (x, y) size.
+
+        mode : str
+            'sum' or 'mean' of the pixels inside each block.
+
+    Returns
+    -------
+        data : numpy.ndarray
+            The binned cube or image.
+
+        header : astropy.io.fits.Header
+            The updated header.
+    """
+    height, width = data.shape[-2:]
+    bx, by = _check_binning(binning)
+
+    data = _bin_blocks(data, bx, by, mode)
+    header = _bin_header(header.copy(), width, height, bx, by, mode)
+
+    return data, header
+
+
+def run_batch(inputs, outputs, operations, n=4, overwrite=False):
+    """
+    Apply a sequence of operations to many cubes at once using a pool of
+    processes. Each cube is read, goes through all the operations in memory
+    and is written to its output file.
+
+        >>> run_batch(['a.fits', 'b.fits'], ['a_ov.fits', 'b_ov.fits'],
+        ...           [(z_repeat, {'n_before': 1, 'n_after': 1}),
+        ...            (z_oversample, {'oversample_factor': 4}),
+        ...            (z_cut, {'n_begin': 40, 'n_end': -40})])
+
+    Parameters
+    ----------
+        inputs : list
+            The input cube filenames.
+
+        outputs : list
+            The output cube filenames.
+
+        operations : list
+            A list of (function, kwargs) pairs. Each function takes and
+            returns a (data, header) pair, like `z_cut`, `z_oversample` and
+            `z_repeat`. They must be importable by the processes, so
+            lambdas cannot be used.
+
+        n : int
+            The number of simultaneous processes.
+
+        overwrite : bool
+            Overwrite existing output files?
+
+    Returns
+    -------
+        outputs : list
+            The output files that were written.
+    """
+    if len(inputs) != len(outputs):
+        raise ValueError('Expected one output for each input. Found {:d} '
+                         'inputs and {:d} outputs.'.format(len(inputs),
+                                                           len(outputs)))
+
+    tasks = [(i, o, operations, overwrite) for i, o in zip(inputs, outputs)]
+    progress = Progress(len(tasks), log, name='Batch', unit='cubes')
+
+    written = []
+    pool = multiprocessing.Pool(n)
+    try:
+        for output in pool.imap_unordered(_run_operations, tasks):
+            written.append(output)
+            progress.update()
+    except KeyboardInterrupt:
+        log.info('\n\nYou pressed Ctrl+C!')
+        log.info('Leaving now. Bye!\n')
+        pool.terminate()
+    finally:
+        pool.close()
+        pool.join()
+
+    progress.finish()
+
+    return written
+
+
+def _run_operations(task):
+
+    _input, _output, operations, overwrite = task
+
+    data, header = fits.getdata(_input, header=True)
+    for function, kwargs in operations:
+        data, header = function(data, header, **kwargs)
+
+    fits.writeto(_output, data, header, overwrite=overwrite)
+
+    return _output
+
+
 class ZCut(threading.Thread):
     """
     Extract a part of the data-cube in the spectral direction and keeping the
@@ -60,57 +341,158 @@ class ZCut(threading.Thread):
         log.info("Starting program.")
         log.info("")
 
-        data = fits.getdata(self._input)
-        header = fits.getheader(self._input)
+        hdul = fits.open(self._input, memmap=True)
+        header = hdul[0].header
 
+        self._original_depth = header['NAXIS3']
         self.n_begin = 0 if self.n_begin is None else self.n_begin
-        self.n_end = header['NAXIS3'] if self.n_end is None else self.n_end
+        self.n_end = self._original_depth if self.n_end is None else self.n_end
 
-        self._original_depth = data.shape[0]
+        # Only the channels that are kept are read from the disk ---
+        data = hdul[0].section[self.n_begin:self.n_end]
+        self._depth = data.shape[0]
 
-        data = data[self.n_begin:self.n_end]
-        header['CRPIX3'] -= self.n_begin
+        header = _cut_header(header.copy(), self._original_depth, self._depth,
+                             self.n_begin, self.n_end)
+        hdul.close()
 
-        self._depth = data.shape[0]
+        fits.writeto(self._output, data, header)
+        log.info('Done.')
+        log.info('')
 
-        header.set(
-            'ZC_ORSIZ',
-            value=self._original_depth,
-            comment='Cube depth before trim.'
-        )
 
-        header.set(
-            'ZC_AFSIZ',
-            value=self._depth,
-            comment='Cube depth after trim.',
-            after='ZC_ORSIZ'
-        )
+class XYCrop(threading.Thread):
+    """
+    Extract a spatial region of interest of the data-cube keeping all its
+    channels. Only the region is read from the disk and the header is updated
+    to keep the spatial calibration and the phase-map reference pixel.
 
-        header.set(
-            'ZC_BEGIN',
-            value=self.n_begin,
-            comment='# channels removed from beginning.',
-            after='ZC_AFSIZ'
-        )
+    Parameters
+    ----------
+        _input : str
+            The input cube filename.
 
-        header.set(
-            'ZC_END',
-            value=self.n_end,
-            comment='# channels removed from end.',
-            after='ZC_BEGIN'
-        )
+        _output : str
+            The output cube filename.
+
+        roi : tuple
+            The (x_start, x_end, y_start, y_end) region using Python's slicing
+            convention.
+    """
+    def __init__(self, _input, _output, roi):
+
+        threading.Thread.__init__(self)
+
+        self._input = _input
+        self._output = _output
+        self.roi = roi
+
+    def run(self):
+
+        log.info("")
+        log.info("SAM-FP Tools: fp_crop")
+        log.info("by Bruno Quint (bquint@ctio.noao.edu)")
+        log.info("version {:s}".format(version.__str__))
+        log.info("Starting program.")
+        log.info("")
+
+        hdul = fits.open(self._input, memmap=True)
+        header = hdul[0].header
+
+        width, height = header['NAXIS1'], header['NAXIS2']
+        x0, x1, y0, y1 = chunks.region(height, width, self.roi)
 
-        header.add_blank('--- Cube Z Cut ---', before='ZC_ORSIZ')
-        header.add_blank('', after='ZC_END')
+        data = hdul[0].section[:, y0:y1, x0:x1]
+        header = xy_crop_header(header.copy(), width, height,
+                                (x0, x1, y0, y1))
+        hdul.close()
+
+        log.info("Region: x = [{:d}:{:d}], y = [{:d}:{:d}]".format(
+            x0, x1, y0, y1))
 
         fits.writeto(self._output, data, header)
         log.info('Done.')
         log.info('')
 
 
+class XYBin(threading.Thread):
+    """
+    Bin a data-cube in blocks of pixels keeping all its channels. The cube
+    is read and binned one channel at a time, so it never needs to fit in
+    memory. The header is updated to keep the spatial calibration, the
+    `CCDSUM` binning and the phase-map reference pixel and fit carried by
+    phase-corrected cubes.
+
+    Parameters
+    ----------
+        _input : str
+            The input cube filename.
+
+        _output : str
+            The output cube filename.
+
+        binning : int or tuple
+            The block size or its (x, y) size.
+
+        mode : str
+            'sum' or 'mean' of the pixels inside each block.
+    """
+    def __init__(self, _input, _output, binning, mode='sum'):
+
+        threading.Thread.__init__(self)
+
+        self._input = _input
+        self._output = _output
+        self.binning = _check_binning(binning)
+        self.mode = mode
+
+        if mode not in ['sum', 'mean']:
+            raise ValueError('Unknown binning mode: {}'.format(mode))
+
+    def run(self):
+
+        log.info("")
+        log.info("SAM-FP Tools: fp_bin")
+        log.info("by Bruno Quint (bquint@ctio.noao.edu)")
+        log.info("version {:s}".format(version.__str__))
+        log.info("Starting program.")
+        log.info("")
+
+        bx, by = self.binning
+
+        data = fits.getdata(self._input, memmap=True)
+        header = fits.getheader(self._input)
+        depth, height, width = data.shape
+
+        header = _bin_header(header, width, height, bx, by, self.mode)
+        dtype = np.result_type(data.dtype.newbyteorder('='), np.float32)
+
+        chunks.create_cube(self._output, header,
+                           (depth, height // by, width // bx), dtype=dtype)
+
+        hdul = fits.open(self._output, mode='update', memmap=True)
+        out_data = hdul[0].data
+
+        progress = Progress(depth, log, name='Binning', unit='channels')
+        for k in range(depth):
+            out_data[k] = _bin_blocks(data[k], bx, by, self.mode)
+            progress.update()
+
+        hdul.close()
+        del data
+
+        progress.finish()
+        log.info('Done.')
+        log.info('')
+
+
 class ZOversample(threading.Thread):
     """
-    Oversample a data-cube in the spectral direction using linear fitting.
+    Oversample a data-cube in the spectral direction. The spectra are
+    considered periodic and are oversampled in whole spatial chunks at once.
+    Linear interpolation is a fixed linear operator on Z (see
+    `linear_oversample_operator`), so it is built once and applied to each
+    chunk with a single sparse matrix product.
 
     Parameters
     ----------
@@ -127,10 +509,16 @@ class ZOversample(threading.Thread):
     Optional Arguments
     ------------------
         kind : str
-            The oversample algorithm. The only option available now is linear interpolation but this is here to allow
-            future implementation of other options.
+            The oversample algorithm: 'linear' interpolation, 'fourier'
+            (zero-padded Fourier transform, see
+            `samfp.tools.periodic.fourier_oversample`) or periodic 'cubic'
+            splines. All of them conserve the flux.
+
+        chunk_size : int
+            Maximum number of spectra oversampled at once.
     """
-    def __init__(self, _input, _output, oversample_factor, kind='linear'):
+    def __init__(self, _input, _output, oversample_factor, kind='linear',
+                 chunk_size=65536):
 
         threading.Thread.__init__(self)
 
@@ -138,6 +526,7 @@ class ZOversample(threading.Thread):
         self.output = _output
         self.oversample_factor = oversample_factor
         self.kind = kind
+        self.chunk_size = chunk_size
 
         self._depth = None
         self._original_depth = None
@@ -151,7 +540,7 @@ class ZOversample(threading.Thread):
         log.info("Starting program.")
         log.info("")
 
-        data = fits.getdata(self.input)
+        data = fits.getdata(self.input, memmap=True)
         header = fits.getheader(self.input)
 
         depth, height, width = data.shape
@@ -160,40 +549,15 @@ class ZOversample(threading.Thread):
 
         new_depth = self.oversample_factor * depth
         log.info("Cube depth after oversample: {:d}".format(new_depth))
-        del data
 
         self._original_depth = depth
         self._depth = new_depth
 
-        x = np.arange(header['NAXIS1'], dtype=int)
-        y = np.arange(header['NAXIS2'], dtype=int)
-
-        # Keep the terminal alive
-        loading = multiprocessing.Process(target=stand_by, name="stand_by")
-        loading.start()
-
-        # Create a pool for subprocesses
-        p = multiprocessing.Pool(4)
-        results = None
-        fitter = OverSampler(self.input, self.oversample_factor, kind=self.kind)
-
-        try:
-            results = p.map_async(fitter, itertools.product(x, y)).get(99999999)
-        except KeyboardInterrupt:
-            print('\n\nYou pressed Ctrl+C!')
-            print('Leaving now. Bye!\n')
-            pass
-
-        # Closing processes
-        p.close()
-        p.join()
-        loading.terminate()
-
-        header = self.fix_header(header)
+        results, header = z_oversample(
+            data, header, self.oversample_factor, kind=self.kind,
+            chunk_size=self.chunk_size, log=log)
+        del data
 
-        results = np.array(results)
-        results = results.reshape((width, height, new_depth))
-        results = np.transpose(results, axes=[2, 1, 0])
         self.results = results
 
         fits.writeto(self.output, results, header)
@@ -201,51 +565,9 @@ class ZOversample(threading.Thread):
         log.info('')
 
     def fix_header(self, header):
+        return _oversample_header(header, self._original_depth,
+                                  self.oversample_factor)
 
-        o = self.oversample_factor
-        x = (np.arange(self._original_depth) - header['CRPIX3'] + 1) \
-            * header['CDELT3'] + header['CRVAL3']
-
-        new_x = np.linspace(x[0], x[-1] + (o - 1) / o, o * x.size)
-        delta_x = np.mean(new_x[1:] - new_x[:-1])
-
-        keys = ['PHMSAMP', 'C3_3', 'CDELT3']
-        for key in keys:
-            try:
-                header.set(
-                    key,
-                    value = delta_x,
-                    after='CRVAL3'
-                )
-            except KeyError:
-                pass
-
-        header['CRPIX3'] = np.argmin(np.abs(new_x - header['CRVAL3'])) + 1
-
-        header.set(
-            'ZO_OVFAC',
-            value=self.oversample_factor,
-            comment='Oversample factor.'
-        )
-
-        header.set(
-            'ZO_ORSIZ',
-            value=self._original_depth,
-            comment='Cube depth before oversample',
-            after='ZO_OVFAC'
-        )
-
-        header.set(
-            'ZO_AFSIZ',
-            value=self._depth,
-            comment='Cube depth after oversample.',
-            after='ZO_ORSIZ'
-        )
-
-        header.add_blank('--- Cube Z Oversample ---', before='ZO_OVFAC')
-        header.add_blank('', after='ZO_AFSIZ')
-
-        return header
 
 class ZRepeat(threading.Thread):
     """
@@ -278,51 +600,8 @@ class ZRepeat(threading.Thread):
 
         self.get_data_shape()
 
-        self.header['CRPIX3'] += self.n_before * self._original_depth
-
-        self.header.set(
-            'ZR_ORSIZ',
-            value=self._original_depth,
-            comment='Original cube depth before repeating Z.'
-        )
-
-        self.header.set(
-            'ZR_AFSIZ',
-            value=self._depth,
-            comment='Cube depth after repeating Z.',
-            after='ZR_ORSIZ'
-        )
-
-        self.header.set(
-            'ZR_COPBE',
-            value=self.n_before,
-            comment='# copies of the cube at its beginning.',
-            after='ZR_AFSIZ'
-        )
-
-        self.header.set(
-            'ZR_CHBEF',
-            value=self._original_depth * self.n_before,
-            comment='# channels added at the beginning of the cube.',
-            after='ZR_COPBE'
-        )
-
-        self.header.set(
-            'ZR_COPEN',
-            value=self.n_after,
-            comment='# copies of the cube at its end.',
-            after='ZR_CHBEF'
-        )
-
-        self.header.set(
-            'ZR_CHEND',
-            value=self._original_depth * self.n_after,
-            comment='# channels added to the end of the cube.',
-            after='ZR_COPEN'
-        )
-
-        self.header.add_blank('--- Cube Repeat ---', before='ZR_ORSIZ')
-        self.header.add_blank('', after='ZR_CHEND')
+        _repeat_header(self.header, self._original_depth, self.n_before,
+                       self.n_after)
 
     def print_initial_info(self):
         log.info("")
@@ -356,20 +635,7 @@ class ZRepeat(threading.Thread):
         self._width = w
 
     def repeat_data(self):
-
-        i = 0
-        temp_before = self.data
-        while i < self.n_before:
-            temp_before = np.vstack((self.data, temp_before))
-            i += 1
-
-        i = 0
-        temp_after = temp_before
-        while i < self.n_after:
-            temp_after = np.vstack((temp_after, self.data))
-            i += 1
-
-        self.data = temp_after
+        self.data = np.tile(self.data, (self.n_before + 1 + self.n_after, 1, 1))
 
     def write(self):
         fits.writeto(self.output, self.data, self.header)
@@ -377,9 +643,200 @@ class ZRepeat(threading.Thread):
         log.info('')
 
 
+class ZPipeline:
+    """
+    Repeat, oversample and cut a data-cube in the spectral direction in a
+    single pass. Repeat and cut are kept as a lazy view: an array with the
+    channel of the original cube (or of its oversampled version) behind
+    each output channel. Since a repeated cube is periodic, oversampling it
+    is the same as oversampling the original cube and repeating the result,
+    so only the original channels are oversampled, and only the output
+    channels that survive the cut are ever computed. The header gets the same
+    cards written by `ZRepeat`, `ZOversample` and `ZCut`.
+
+        >>> pipeline = ZPipeline('cube.fits')
+        >>> pipeline.repeat(n_before=1, n_after=1).oversample(4)
+        >>> pipeline.cut(n_begin=12, n_end=-12).write('new_cube.fits')
+
+    Parameters
+    ----------
+        _input : str
+            The input cube filename.
+
+        chunk_size : int
+            Maximum number of spectra processed at once.
+    """
+    def __init__(self, _input, chunk_size=65536):
+
+        self.input = _input
+        self.chunk_size = chunk_size
+        self.header = fits.getheader(_input)
+
+        self._original_depth = self.header['NAXIS3']
+        self._index = np.arange(self._original_depth)
+
+        self.oversample_factor = None
+        self.kind = None
+
+    @property
+    def depth(self):
+        return self._index.size
+
+    def repeat(self, n_before=0, n_after=0):
+        """
+        Add `n_before` and `n_after` copies of the cube to its beginning and
+        to its end (see `ZRepeat`).
+        """
+        depth = self.depth
+        self._index = np.tile(self._index, n_before + 1 + n_after)
+        _repeat_header(self.header, depth, n_before, n_after)
+
+        return self
+
+    def oversample(self, oversample_factor, kind='linear'):
+        """
+        Oversample the cube (see `ZOversample`). It can only be done once
+        and before any cut, since it considers the spectra periodic.
+        """
+        period = self._original_depth
+        if self.oversample_factor is not None or not np.array_equal(
+                self._index, np.arange(self.depth) % period):
+            raise ValueError('The cube can only be oversampled once and '
+                             'before being cut.')
+
+        depth = self.depth
+        self._index = np.arange(oversample_factor * depth) % \
+            (oversample_factor * period)
+        self.oversample_factor = oversample_factor
+        self.kind = kind
+
+        _oversample_header(self.header, depth, oversample_factor)
+
+        return self
+
+    def cut(self, n_begin=None, n_end=None):
+        """
+        Keep only the channels between `n_begin` (inclusive) and `n_end`
+        (exclusive) (see `ZCut`).
+        """
+        depth = self.depth
+
+        n_begin = 0 if n_begin is None else n_begin
+        n_end = depth if n_end is None else n_end
+
+        self._index = self._index[n_begin:n_end]
+        _cut_header(self.header, depth, self.depth, n_begin, n_end)
+
+        return self
+
+    def write(self, _output, overwrite=False):
+        """
+        Compute the output cube tile by tile and write it to `_output`.
+        """
+        data = fits.getdata(self.input, memmap=True)
+        depth, height, width = data.shape
+
+        index = self._index
+        if self.oversample_factor is None:
+            dtype = data.dtype.newbyteorder('=')
+            transform = None
+        elif self.kind == 'linear':
+            dtype = np.float64
+            operator = linear_oversample_operator(depth, self.oversample_factor)
+            transform = operator[index].dot
+            index = None
+        else:
+            dtype = np.float64
+            transform = get_oversampler(self.kind, depth,
+                                        self.oversample_factor)
+
+        chunks.create_cube(_output, self.header, (self.depth, height, width),
+                           dtype=dtype, overwrite=overwrite)
+
+        hdul = fits.open(_output, mode='update', memmap=True)
+        out_data = hdul[0].data
+
+        progress = Progress(width * height, log, name='Processing',
+                            unit='spectra')
+
+        for y0, y1, x0, x1 in chunks.iter_tiles(height, width,
+                                                self.chunk_size):
+
+            block = np.asarray(data[:, y0:y1, x0:x1])
+            block = block.reshape((depth, -1))
+
+            if transform is not None:
+                block = transform(block.astype(float))
+            if index is not None:
+                block = block[index]
+
+            out_data[:, y0:y1, x0:x1] = \
+                block.reshape((self.depth, y1 - y0, x1 - x0))
+            progress.update((y1 - y0) * (x1 - x0))
+
+        hdul.close()
+        del data
+
+        progress.finish()
+
+
+def get_oversampler(kind, depth, oversample_factor):
+    """
+    Return a function that oversamples a (depth x N) array of periodic
+    spectra using `kind` ('linear', 'fourier' or 'cubic').
+    """
+    if kind == 'linear':
+        return linear_oversample_operator(depth, oversample_factor).dot
+    elif kind == 'fourier':
+        return functools.partial(periodic.fourier_oversample,
+                                 factor=oversample_factor)
+    elif kind == 'cubic':
+        return functools.partial(periodic.cubic_oversample,
+                                 factor=oversample_factor)
+
+    raise ValueError('Unknown oversample kind: {}'.format(kind))
+
+
+def linear_oversample_operator(depth, oversample_factor):
+    """
+    Return the sparse matrix that oversamples periodic spectra with `depth`
+    channels by `oversample_factor` using linear interpolation. Multiplying
+    it by a (depth x N) array of spectra gives the same result as
+    `OverSampler.linear_interpolation` applied to each spectrum.
+
+    Parameters
+    ----------
+        depth : int
+            Number of channels of the input spectra.
+
+        oversample_factor : int
+            The oversample factor.
+
+    Returns
+    -------
+        operator : scipy.sparse.csr_matrix
+            A (oversample_factor * depth x depth) matrix with two non-zero
+            elements per row.
+    """
+    o = oversample_factor
+    new_x = np.linspace(0, depth - 1 + (o - 1) / o, o * depth)
+
+    i0 = np.floor(new_x).astype(int)
+    t = new_x - i0
+
+    # The flux of each channel is spread over its new samples ---
+    rows = np.arange(new_x.size)
+    weights = np.concatenate(((1 - t) / o, t / o))
+    columns = np.concatenate((i0 % depth, (i0 + 1) % depth))
+
+    return sparse.csr_matrix((weights, (np.concatenate((rows, rows)), columns)),
+                             shape=(new_x.size, depth))
+
+
 class OverSampler:
 
-    def __init__(self, filename, oversample_factor, kind='linear'):
+    def __init__(self, filename, oversample_factor, kind='linear',
+                 cache=False):
         """
         Parameter
         ---------
@@ -397,12 +854,15 @@ class OverSampler:
         ------------------
             kind : str
 
+            cache : bool
+                Read the spectra from the spectral cache of the cube (see
+                `samfp.tools.speccache`)?
         """
         self._filename = filename
         self.oversample_factor = oversample_factor
 
         # Load the data
-        self.data = fits.getdata(self._filename, memmap=True)
+        self.data = speccache.open_cube(self._filename, cache=cache)
 
         # Load the relevant values from the header
         h = fits.getheader(self._filename)
@@ -459,24 +919,315 @@ class OverSampler:
         return new_y
 
 
-def stand_by(level=logging.NOTSET):
+def _repeat_header(header, depth, n_before, n_after):
+    """
+    Update the header of a cube with `depth` channels repeated `n_before`
+    times at its beginning and `n_after` times at its end.
     """
-    A silly method that keeps the terminal alive so the user knows that
-    this programs is still running. :-)
+    header['CRPIX3'] += n_before * depth
+
+    header.set(
+        'ZR_ORSIZ',
+        value=depth,
+        comment='Original cube depth before repeating Z.'
+    )
+
+    header.set(
+        'ZR_AFSIZ',
+        value=depth * (n_before + 1 + n_after),
+        comment='Cube depth after repeating Z.',
+        after='ZR_ORSIZ'
+    )
+
+    header.set(
+        'ZR_COPBE',
+        value=n_before,
+        comment='# copies of the cube at its beginning.',
+        after='ZR_AFSIZ'
+    )
+
+    header.set(
+        'ZR_CHBEF',
+        value=depth * n_before,
+        comment='# channels added at the beginning of the cube.',
+        after='ZR_COPBE'
+    )
+
+    header.set(
+        'ZR_COPEN',
+        value=n_after,
+        comment='# copies of the cube at its end.',
+        after='ZR_CHBEF'
+    )
+
+    header.set(
+        'ZR_CHEND',
+        value=depth * n_after,
+        comment='# channels added to the end of the cube.',
+        after='ZR_COPEN'
+    )
+
+    header.add_blank('--- Cube Repeat ---', before='ZR_ORSIZ')
+    header.add_blank('', after='ZR_CHEND')
+
+    return header
+
+
+def _oversample_header(header, depth, oversample_factor):
     """
-    from time import sleep
+    Update the header of a cube with `depth` channels oversampled by
+    `oversample_factor`.
+    """
+    o = oversample_factor
+    x = (np.arange(depth) - header['CRPIX3'] + 1) \
+        * header['CDELT3'] + header['CRVAL3']
 
-    output = ['/', '-', '\\', '|']
-    i = 0
+    new_x = np.linspace(x[0], x[-1] + (o - 1) / o, o * x.size)
+    delta_x = np.mean(new_x[1:] - new_x[:-1])
 
-    if level in [logging.NOTSET, logging.WARN, logging.ERROR]:
-        return
+    keys = ['PHMSAMP', 'C3_3', 'CDELT3']
+    for key in keys:
+        try:
+            header.set(
+                key,
+                value = delta_x,
+                after='CRVAL3'
+            )
+        except KeyError:
+            pass
+
+    header['CRPIX3'] = np.argmin(np.abs(new_x - header['CRVAL3'])) + 1
+
+    header.set(
+        'ZO_OVFAC',
+        value=oversample_factor,
+        comment='Oversample factor.'
+    )
+
+    header.set(
+        'ZO_ORSIZ',
+        value=depth,
+        comment='Cube depth before oversample',
+        after='ZO_OVFAC'
+    )
 
-    while True:
-        sys.stdout.write("\r [{:s}]".format(output[i]))
-        sys.stdout.flush()
-        sleep(0.5)
-        i += 1
-        i %= 4
+    header.set(
+        'ZO_AFSIZ',
+        value=o * depth,
+        comment='Cube depth after oversample.',
+        after='ZO_ORSIZ'
+    )
 
-    return
+    header.add_blank('--- Cube Z Oversample ---', before='ZO_OVFAC')
+    header.add_blank('', after='ZO_AFSIZ')
+
+    return header
+
+
+def _cut_header(header, depth, new_depth, n_begin, n_end):
+    """
+    Update the header of a cube with `depth` channels cut to `new_depth`
+    channels between `n_begin` and `n_end`.
+    """
+    header['CRPIX3'] -= n_begin
+
+    header.set(
+        'ZC_ORSIZ',
+        value=depth,
+        comment='Cube depth before trim.'
+    )
+
+    header.set(
+        'ZC_AFSIZ',
+        value=new_depth,
+        comment='Cube depth after trim.',
+        after='ZC_ORSIZ'
+    )
+
+    header.set(
+        'ZC_BEGIN',
+        value=n_begin,
+        comment='# channels removed from beginning.',
+        after='ZC_AFSIZ'
+    )
+
+    header.set(
+        'ZC_END',
+        value=n_end,
+        comment='# channels removed from end.',
+        after='ZC_BEGIN'
+    )
+
+    header.add_blank('--- Cube Z Cut ---', before='ZC_ORSIZ')
+    header.add_blank('', after='ZC_END')
+
+    return header
+
+
+def xy_crop_header(header, width, height, roi):
+    """
+    Update the header of a `width` x `height` cube (or image) cropped to the
+    (x_start, x_end, y_start, y_end) region of interest. The reference pixels
+    of the WCS and of the phase-map are moved with the region.
+    """
+    x0, x1, y0, y1 = chunks.region(height, width, roi)
+
+    for key, value in [('NAXIS1', x1 - x0), ('NAXIS2', y1 - y0)]:
+        if key in header:
+            header[key] = value
+
+    for key, offset in [('CRPIX1', x0), ('CRPIX2', y0), ('PHMREFX', x0),
+                        ('PHMREFY', y0)]:
+        if key in header:
+            header[key] -= offset
+
+    header.set(
+        'XC_ORWID',
+        value=width,
+        comment='Cube width before crop.'
+    )
+
+    header.set(
+        'XC_ORHEI',
+        value=height,
+        comment='Cube height before crop.',
+        after='XC_ORWID'
+    )
+
+    header.set(
+        'XC_XBEG',
+        value=x0,
+        comment='First column kept (inclusive).',
+        after='XC_ORHEI'
+    )
+
+    header.set(
+        'XC_XEND',
+        value=x1,
+        comment='Last column kept (exclusive).',
+        after='XC_XBEG'
+    )
+
+    header.set(
+        'XC_YBEG',
+        value=y0,
+        comment='First row kept (inclusive).',
+        after='XC_XEND'
+    )
+
+    header.set(
+        'XC_YEND',
+        value=y1,
+        comment='Last row kept (exclusive).',
+        after='XC_YBEG'
+    )
+
+    header.add_blank('--- Cube XY Crop ---', before='XC_ORWID')
+    header.add_blank('', after='XC_YEND')
+
+    return header
+
+
+def _check_binning(binning):
+    """
+    Return the (x, y) binning from a single block size or a pair of them.
+    """
+    bx, by = (binning, binning) if np.isscalar(binning) else binning
+    bx, by = int(bx), int(by)
+
+    if bx < 1 or by < 1:
+        raise ValueError('Binning must be positive: {}'.format(binning))
+
+    return bx, by
+
+
+def _bin_blocks(data, bx, by, mode):
+    """
+    Sum or average the (by x bx) blocks of pixels over the last two axes of
+    `data` with a single reshape.
+    """
+    if mode not in ['sum', 'mean']:
+        raise ValueError('Unknown binning mode: {}'.format(mode))
+
+    height, width = data.shape[-2:]
+    ny, nx = height // by, width // bx
+    if nx == 0 or ny == 0:
+        raise ValueError('Binning {:d} x {:d} is larger than the '
+                         'image.'.format(bx, by))
+
+    block = np.asarray(data[..., :ny * by, :nx * bx])
+    block = block.reshape(block.shape[:-2] + (ny, by, nx, bx))
+
+    return getattr(block, mode)(axis=(-3, -1))
+
+
+def _bin_header(header, width, height, bx, by, mode):
+    """
+    Update the header of a `width` x `height` cube (or image) binned in
+    blocks of `bx` x `by` pixels.
+    """
+    for key, value in [('NAXIS1', width // bx), ('NAXIS2', height // by)]:
+        if key in header:
+            header[key] = value
+
+    # Pixel centers are kept in place ---
+    for axis, b in [(1, bx), (2, by)]:
+
+        key = 'CRPIX{:d}'.format(axis)
+        if key in header:
+            header[key] = (header[key] - 0.5) / b + 0.5
+
+        key = 'CDELT{:d}'.format(axis)
+        if key in header:
+            header[key] *= b
+
+        for i in [1, 2]:
+            key = 'CD{:d}_{:d}'.format(i, axis)
+            if key in header:
+                header[key] *= b
+
+    try:
+        ccd_x, ccd_y = [int(b) for b in str(header['CCDSUM']).split()]
+    except (KeyError, ValueError):
+        ccd_x, ccd_y = 1, 1
+
+    header['CCDSUM'] = '{:d} {:d}'.format(ccd_x * bx, ccd_y * by)
+
+    # The phase-map carried by the cube is measured in its pixels ---
+    for key, b in [('PHMREFX', bx), ('PHMREFY', by)]:
+        if key in header:
+            header[key] = (header[key] + 0.5) / b - 0.5
+
+    if 'PHMFIT_A' in header and 'PHMFIT_B' in header:
+        if bx == by:
+            header['PHMFIT_A'] *= bx ** 2
+            header['PHMFIT_B'] *= bx
+        else:
+            log.warning('The phase-map fit cannot be binned by {:d} x {:d} '
+                        'pixels. PHMFIT_A and PHMFIT_B are kept.'.format(
+                            bx, by))
+
+    header.set(
+        'XB_BINX',
+        value=bx,
+        comment='Binning in X.'
+    )
+
+    header.set(
+        'XB_BINY',
+        value=by,
+        comment='Binning in Y.',
+        after='XB_BINX'
+    )
+
+    header.set(
+        'XB_MODE',
+        value=mode,
+        comment='Sum or mean of the binned pixels.',
+        after='XB_BINY'
+    )
+
+    header.add_blank('--- Cube XY Bin ---', before='XB_BINX')
+    header.add_blank('', after='XB_MODE')
+
+    return header
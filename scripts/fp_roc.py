@@ -31,8 +31,9 @@ parser.add_argument(
     '-k',
     type=str,
     default='linear',
-    choices=['linear'],
-    help="Oversample factor."
+    choices=['linear', 'fourier', 'cubic'],
+    help="Oversample algorithm: linear interpolation, zero-padded Fourier "
+         "transform or periodic cubic-splines."
 )
 
 parser.add_argument(
@@ -78,37 +79,11 @@ if os.path.exists(args.output_cube):
     print(" Delete it before running this.\n Leaving now.")
     sys.exit(1)
 
-fp_repeat = ztools.ZRepeat(
-    args.input_cube,
-    '.fp_repeat.temp.fits',
-    n_after=args.n_end_repeat,
-    n_before=args.n_begin_repeat
-)
-
-fp_repeat.start()
-fp_repeat.join()
-
-fp_repeat = ztools.ZOversample(
-    '.fp_repeat.temp.fits',
-    '.fp_oversample.temp.fits',
-    args.oversample_factor,
-    kind=args.kind
-)
-
-fp_repeat.start()
-fp_repeat.join()
-
-fp_cut = ztools.ZCut(
-    '.fp_oversample.temp.fits',
-    args.output_cube,
-    n_begin=args.n_begin_cut,
-    n_end=args.n_end_cut
-)
-
-fp_cut.start()
-fp_cut.join()
-
-os.remove('.fp_repeat.temp.fits')
-os.remove('.fp_oversample.temp.fits')
+# Repeat, oversample and cut in a single pass
+pipeline = ztools.ZPipeline(args.input_cube)
+pipeline.repeat(n_before=args.n_begin_repeat, n_after=args.n_end_repeat)
+pipeline.oversample(args.oversample_factor, kind=args.kind)
+pipeline.cut(n_begin=args.n_begin_cut, n_end=args.n_end_cut)
+pipeline.write(args.output_cube)
 
-print('Finished all.\n\n\n')
\ No newline at end of file
+print('Finished all.\n\n\n')
@@ -79,6 +79,8 @@ setup(
         'scripts/combine_flat',
         'scripts/combine_zero',
         'scripts/fp_2dmaps',
+        'scripts/fp_bin',
+        'scripts/fp_crop',
         'scripts/fp_cut',
         'scripts/fp_repeat',
         'scripts/fp_oversample',
@@ -0,0 +1,99 @@
+import numpy as np
+
+from samfp.tools import batchfit
+
+
+def _spectra(model, p, noise=0.1):
+
+    np.random.seed(0)
+    z = np.arange(40.)
+    f, _ = model(z, p)
+
+    return z, f + np.random.normal(0, noise, f.shape)
+
+
+def test_batch_gaussian():
+
+    p = np.array([[50., 18., 2.5, 10.], [80., 22.5, 3., 5.], [30., 20., 2., 0.]])
+    z, data = _spectra(batchfit.gaussian, p)
+
+    p0 = np.array([[40., 20., 2., 8.]] * 3)
+    fitted, converged, n_iter = batchfit.levenberg_marquardt(
+        batchfit.gaussian, z, data, p0)
+
+    assert np.all(converged)
+    assert np.all(n_iter > 0)
+    assert np.allclose(fitted, p, rtol=0.05, atol=0.1)
+
+
+def test_batch_lorentzian():
+
+    p = np.array([[50., 18., 5., 10.], [80., 22.5, 4., 5.]])
+    z, data = _spectra(batchfit.lorentzian, p)
+
+    p0 = np.array([[40., 20., 5., 8.]] * 2)
+    fitted, converged, _ = batchfit.levenberg_marquardt(
+        batchfit.lorentzian, z, data, p0)
+
+    assert np.all(converged)
+
+    fitted[:, 2] = np.abs(fitted[:, 2])
+    assert np.allclose(fitted, p, rtol=0.05, atol=0.1)
+
+
+def test_batch_jacobian():
+
+    z = np.arange(40.)
+    p = np.array([[50., 18.3, 2.5, 10.]])
+
+    for model in [batchfit.gaussian, batchfit.lorentzian]:
+        f, jacobian = model(z, p)
+        for k in range(4):
+            dp = np.zeros_like(p)
+            dp[0, k] = 1e-6
+            numeric = (model(z, p + dp)[0] - model(z, p - dp)[0]) / 2e-6
+            assert np.allclose(jacobian[..., k], numeric, atol=1e-5)
+
+
+def test_batch_failure_is_nan():
+
+    z = np.arange(40.)
+    data = np.full((2, 40), np.nan)
+    p0 = np.array([[40., 20., 2., 8.]] * 2)
+
+    fitted, converged, _ = batchfit.levenberg_marquardt(
+        batchfit.gaussian, z, data, p0)
+
+    assert not np.any(converged)
+    assert np.all(np.isnan(fitted))
+
+
+def test_template_bank_gaussian():
+
+    p = np.array([[50., 18.3, 2.5, 10.], [80., 22.7, 3.4, 5.]])
+    z, data = _spectra(batchfit.gaussian, p)
+
+    bank = batchfit.TemplateBank(z, batchfit.unit_gaussian,
+                                 np.arange(0, 40, 0.25),
+                                 np.geomspace(0.5, 10, 24))
+    fitted = bank.fit(data)
+
+    assert np.allclose(fitted, p, rtol=0.02, atol=0.05)
+
+
+def test_template_bank_airy_is_periodic():
+
+    import functools
+
+    airy = functools.partial(batchfit.unit_airy, fsr=40.)
+    z = np.arange(40.)
+    data = 10 + 50 * airy(z, np.array([[0.3], [25.6]]),
+                          np.array([[3.], [4.5]]))
+
+    bank = batchfit.TemplateBank(z, airy, np.arange(0, 40, 0.25),
+                                 np.geomspace(0.5, 10, 24), period=40.)
+    fitted = bank.fit(data)
+
+    assert np.allclose(fitted[:, 1], [0.3, 25.6], atol=0.02)
+    assert np.allclose(fitted[:, 2], [3., 4.5], rtol=0.01)
+    assert np.allclose(fitted[:, [0, 3]], [[50., 10.]] * 2, rtol=0.01)
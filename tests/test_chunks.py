@@ -0,0 +1,53 @@
+import numpy as np
+import os
+
+from astropy.io import fits
+from samfp.tools import chunks
+
+
+def test_iter_tiles_cover_image():
+
+    coverage = np.zeros((13, 7), dtype=int)
+    for y0, y1, x0, x1 in chunks.iter_tiles(13, 7, 20):
+        coverage[y0:y1, x0:x1] += 1
+
+    assert np.all(coverage == 1)
+
+    coverage[:] = 0
+    for y0, y1, x0, x1 in chunks.iter_tiles(13, 7, 3):
+        assert y1 - y0 == 1
+        coverage[y0:y1, x0:x1] += 1
+
+    assert np.all(coverage == 1)
+
+
+def test_create_cube():
+
+    h = fits.Header()
+    h['CRPIX3'] = 1
+
+    chunks.create_cube('.temp_cube.fits', h, (4, 5, 6), overwrite=True)
+
+    with fits.open('.temp_cube.fits', mode='update', memmap=True) as hdul:
+        assert hdul[0].data.shape == (4, 5, 6)
+        hdul[0].data[:, 1:3] = 1.
+
+    data = fits.getdata('.temp_cube.fits')
+    header = fits.getheader('.temp_cube.fits')
+    os.remove('.temp_cube.fits')
+
+    assert header['CRPIX3'] == 1
+    assert data.sum() == 4 * 2 * 6
+
+
+def test_region():
+
+    assert chunks.region(13, 7) == (0, 7, 0, 13)
+    assert chunks.region(13, 7, (2, None, -5, -1)) == (2, 7, 8, 12)
+
+    try:
+        chunks.region(13, 7, (5, 2, 0, 13))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Empty regions should raise a ValueError.')
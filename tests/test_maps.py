@@ -0,0 +1,394 @@
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from samfp import maps, phmap
+from samfp.tools import batchfit, snr, speccache
+
+log = logging.getLogger('test_maps')
+
+
+def _cube_header(depth=36):
+
+    h = fits.Header()
+    h['NAXIS3'] = depth
+    h['CRPIX3'] = -1
+    h['CRVAL3'] = 0.
+    h['CDELT3'] = 1.
+
+    return h
+
+
+def _phase_map():
+
+    h = fits.Header()
+    h['PHMREFX'] = 12
+    h['PHMREFY'] = 10
+    h['PHMFIT_A'] = 2e-2
+    h['PHMFIT_B'] = 0.
+    h['PHMFIT_C'] = 0.
+    h['PHM_FSR'] = 36.
+
+    return phmap.ParabolicPhaseMap(h)
+
+
+def test_correct_phase_map():
+
+    phase_map = _phase_map()
+    dz = phase_map((20, 24))
+
+    observed = np.mod(15. + dz, 36.)
+    corrected = maps.correct_phase_map(observed, _cube_header(), phase_map)
+
+    assert np.allclose(corrected, 15.)
+
+
+def test_correct_phase_map_scaled_fsr():
+
+    phase_map = _phase_map()
+    dz = phase_map((20, 24)) * 0.5
+
+    observed = np.mod(7. + dz, 18.)
+    corrected = maps.correct_phase_map(observed, _cube_header(), phase_map,
+                                       fsr=18.)
+
+    assert np.allclose(corrected, 7.)
+
+
+def _write_cube(filename, shape=(30, 6, 8)):
+
+    np.random.seed(0)
+    z = np.arange(shape[0]).reshape((-1, 1, 1))
+    center = 12 + np.random.uniform(-3, 3, shape[1:])
+    data = 10 + 100 * np.exp(-0.5 * ((z - center) / 2.) ** 2) + \
+        np.random.normal(0, 0.5, shape)
+
+    h = fits.Header()
+    h['CRPIX3'] = 1
+    h['CRVAL3'] = 0.
+    h['CDELT3'] = 1.
+
+    fits.writeto(filename, data.astype(np.float32), h, overwrite=True)
+
+
+def _write_data(filename, data):
+
+    h = fits.Header()
+    h['CRPIX3'] = 1
+    h['CRVAL3'] = 0.
+    h['CDELT3'] = 1.
+
+    fits.writeto(filename, data.astype(np.float32), h, overwrite=True)
+
+
+@pytest.fixture
+def cube():
+
+    _write_cube('.temp_maps.fits')
+    yield '.temp_maps.fits'
+    os.remove('.temp_maps.fits')
+
+
+def test_fit_tile_matches_single_pixel_fit(cube):
+
+    fitter = maps.DirectMeasure(cube)
+    results = fitter.fit_tile((1, 4, 2, 7))
+
+    for j in range(1, 4):
+        for i in range(2, 7):
+            assert np.allclose(results[:, j - 1, i - 2],
+                               np.hstack(fitter((i, j))))
+
+
+@pytest.mark.parametrize('reference, other, index, tolerance', [
+    (maps.DirectMeasure, maps.DirectMoments, slice(None), {'rtol': 1e-5}),
+    (maps.FitGaussian, maps.BatchFitGaussian, slice(None), {'rtol': 1e-5}),
+    (maps.BatchFitGaussian, maps.TemplateFitGaussian, 1, {'atol': 0.05}),
+    (maps.BatchFitGaussian, maps.TemplateFitGaussian, 2, {'rtol': 0.05}),
+])
+def test_fit_tile_matches_reference(cube, reference, other, index,
+                                    tolerance):
+
+    expected = reference(cube).fit_tile((0, 6, 0, 8))
+    results = other(cube).fit_tile((0, 6, 0, 8))
+
+    assert results.shape == expected.shape
+    assert np.allclose(results[index], expected[index], **tolerance)
+
+
+@pytest.mark.parametrize('fitter', [maps.DirectMoments, maps.DirectMeasure])
+def test_mask_skips_pixels(cube, fitter):
+
+    mask = np.zeros((6, 8), dtype=bool)
+    mask[2:4, 1:6] = True
+
+    full = maps.DirectMoments(cube).fit_tile((0, 6, 0, 8))
+    masked = fitter(cube).fit_tile((0, 6, 0, 8), mask=mask)
+
+    assert np.all(np.isnan(masked[:, ~mask]))
+    assert np.allclose(masked[:, mask], full[:, mask], rtol=1e-5)
+
+
+def test_binned_extraction(cube):
+
+    bins = np.arange(48).reshape((6, 8)) // 2
+    bins[0] = -1
+
+    results = maps.perform_2dmap_extraction(
+        cube, log, algorithm='direct-vec', bins=bins)
+
+    fitter = maps.DirectMoments(cube)
+    spectra = fitter.read_binned_spectra(bins)
+    expected = fitter.fit_spectra(spectra)
+
+    assert np.all(np.isnan(results[:, 0]))
+    assert np.allclose(results[:, 3, 2], expected[bins[3, 2]])
+    assert np.allclose(results[:, 3, 2], results[:, 3, 3])
+
+
+def _write_rotating_cube(filename, shape=(40, 8, 12)):
+
+    np.random.seed(1)
+    z = np.arange(shape[0]).reshape((-1, 1, 1))
+    y, x = np.mgrid[:shape[1], :shape[2]]
+    center = 20 + 10 * np.tanh((x - shape[2] // 2) / 3.)
+    data = 5 + 60 * np.exp(-0.5 * ((z - center) / 1.5) ** 2) + \
+        np.random.normal(0, 0.5, shape)
+
+    h = fits.Header()
+    h['CRPIX3'] = 1
+    h['CRVAL3'] = 0.
+    h['CDELT3'] = 1.
+    fits.writeto(filename, data.astype(np.float32), h, overwrite=True)
+
+    return center
+
+
+def test_warm_start_uses_fewer_iterations():
+
+    center = _write_rotating_cube('.temp_maps.fits')
+
+    fitter = maps.BatchFitGaussian('.temp_maps.fits')
+    cold, cold_iter = fitter.fit_tile_warm((0, 8, 0, 12), warm_start=False)
+    warm, warm_iter = fitter.fit_tile_warm((0, 8, 0, 12))
+
+    os.remove('.temp_maps.fits')
+
+    # Cold starts may end in local minima far from the line. The maps Z
+    # axis starts at -2 for CRPIX3 = 1 ---
+    assert np.allclose(warm[1], center - 2, atol=0.05)
+    assert not np.allclose(cold[1], center - 2, atol=0.05)
+    assert warm_iter.sum() < cold_iter.sum()
+
+
+def test_pyramid_extraction():
+
+    center = _write_rotating_cube('.temp_maps.fits', shape=(40, 16, 24))
+
+    results, n_iter = maps.perform_2dmap_extraction(
+        '.temp_maps.fits', log, algorithm='gaussian-lm', pyramid=[4, 2],
+        return_n_iter=True)
+
+    _, cold_iter = maps.perform_2dmap_extraction(
+        '.temp_maps.fits', log, algorithm='gaussian-lm', return_n_iter=True)
+
+    os.remove('.temp_maps.fits')
+
+    assert np.allclose(results[1], center - 2, atol=0.05)
+    assert n_iter.sum() < cold_iter.sum()
+
+
+def test_checkpoint_resume(cube):
+
+    full = maps.perform_2dmap_extraction(
+        cube, log, algorithm='gaussian-lm', chunk_size=8,
+        checkpoint='.temp_ckpt.fits')
+
+    # Pretend the extraction stopped after the first three rows ---
+    with fits.open('.temp_ckpt.fits', mode='update') as hdul:
+        hdul[0].data[5, 3:] = 0
+        hdul[0].data[:4, 3:] = -1
+
+    partial, done = maps.load_checkpoint('.temp_ckpt.fits')
+    assert done[:3].all() and not done[3:].any()
+    assert np.all(np.isnan(partial[:, 3:]))
+
+    resumed = maps.perform_2dmap_extraction(
+        cube, log, algorithm='gaussian-lm', chunk_size=8,
+        checkpoint='.temp_ckpt.fits')
+
+    assert np.allclose(resumed, full, equal_nan=True)
+    assert maps.load_checkpoint('.temp_ckpt.fits')[1].all()
+
+    with pytest.raises(IOError):
+        maps.perform_2dmap_extraction(
+            cube, log, algorithm='lorentzian-lm', chunk_size=8,
+            checkpoint='.temp_ckpt.fits')
+
+    os.remove('.temp_ckpt.fits')
+
+
+def test_checkpoint_refuses_changed_cube(cube):
+
+    maps.perform_2dmap_extraction(
+        cube, log, algorithm='gaussian-lm', chunk_size=8,
+        checkpoint='.temp_ckpt.fits')
+
+    # Same shape and header, different data ---
+    data = fits.getdata(cube)
+    fits.writeto(cube, data[::-1], fits.getheader(cube), overwrite=True)
+
+    try:
+        with pytest.raises(IOError):
+            maps.perform_2dmap_extraction(
+                cube, log, algorithm='gaussian-lm', chunk_size=8,
+                checkpoint='.temp_ckpt.fits')
+    finally:
+        os.remove('.temp_ckpt.fits')
+
+
+def test_fourier_extraction_near_edges():
+
+    np.random.seed(2)
+    z = np.arange(40).reshape((-1, 1, 1))
+    center = np.linspace(0.5, 39.5, 12) * np.ones((8, 1))
+    data = 5 + 60 * batchfit.unit_airy(z, center, 3., 40.) + \
+        np.random.normal(0, 0.5, (40, 8, 12))
+
+    _write_data('.temp_maps.fits', data)
+
+    results = maps.perform_2dmap_extraction(
+        '.temp_maps.fits', log, n=1, algorithm='fourier')
+    direct = maps.perform_2dmap_extraction(
+        '.temp_maps.fits', log, n=1, algorithm='direct-vec')
+
+    os.remove('.temp_maps.fits')
+
+    # The maps Z axis starts at -2 for CRPIX3 = 1 ---
+    error = np.mod(results[1] - (center - 2) + 20, 40) - 20
+    assert np.all(np.abs(error) < 0.25)
+    assert np.allclose(np.median(results[0]), 60, rtol=0.05)
+    assert np.allclose(np.median(results[2]), 3, rtol=0.05)
+
+    # The barycenter is pulled towards the middle of the cube ---
+    assert np.abs(direct[1] - (center - 2))[:, 0].min() > 1
+
+
+@pytest.mark.parametrize('compress', [None, 'GZIP_2'])
+def test_write_results(cube, compress):
+
+    np.random.seed(3)
+    results = np.random.normal(6563., 1., (4, 6, 8))
+    results[:, 0, 0] = np.nan
+    errors = np.abs(results) * 1e-3
+    mask = np.ones((6, 8), dtype=bool)
+    mask[0] = False
+
+    output = maps.write_results(
+        results, cube, None, 'gaussian-lm', wavelength=6563., errors=errors,
+        mask=mask, compress=compress)
+
+    with fits.open(output) as hdul:
+        names = [hdu.name for hdu in hdul]
+        center = hdul['GAUSSIAN_CENTER']
+        peak = hdul['GAUSSIAN_PEAK']
+
+        assert output == '.temp_maps.Gmaps.fits'
+        assert 'GAUSSIAN_STDDEV_ERR' in names
+        assert center.header['BITPIX'] == -32
+        assert center.header['UNITS'] == 'km/s'
+        assert 'M1_MEAN' in center.header
+        assert 'M1_MEAN' not in peak.header
+        assert np.array_equal(hdul['MASK'].data, mask)
+        assert np.allclose(peak.data, results[0], equal_nan=True)
+
+    os.remove(output)
+
+
+def test_uncertainty_maps():
+
+    np.random.seed(4)
+    z = np.arange(40).reshape((-1, 1, 1))
+    data = 5 + 30 * np.exp(-0.5 * ((z - 17.3) / 3.) ** 2) + \
+        np.random.normal(0, 1., (40, 20, 20))
+
+    _write_data('.temp_maps.fits', data)
+
+    results = maps.perform_2dmap_extraction(
+        '.temp_maps.fits', log, n=1, algorithm='gaussian-lm')
+    errors = maps.uncertainty_maps(
+        '.temp_maps.fits', log, algorithm='gaussian-lm', n_realisations=30,
+        seed=0)
+
+    os.remove('.temp_maps.fits')
+
+    # All the pixels have the same line, so the errors should match the
+    # scatter of the maps ---
+    scatter = np.std(results.reshape((4, -1)), axis=1)
+    ratio = np.median(errors.reshape((4, -1)), axis=1) / scatter
+
+    assert errors.shape == results.shape
+    assert np.all((ratio > 0.7) & (ratio < 1.5))
+
+
+@pytest.mark.parametrize('algorithm, options, region', [
+    ('gaussian-lm', {'cache': True}, (0, 8, 0, 6)),
+    ('direct-vec', {'roi': (2, 7, 1, 5)}, (2, 7, 1, 5)),
+])
+def test_extraction_matches_full_cube(cube, algorithm, options, region):
+
+    expected = maps.perform_2dmap_extraction(
+        cube, log, n=1, algorithm=algorithm)
+    results = maps.perform_2dmap_extraction(
+        cube, log, n=1, algorithm=algorithm, **options)
+
+    if options.get('cache'):
+        os.remove(speccache.cache_filename(cube))
+
+    x0, x1, y0, y1 = region
+    assert results.shape == (4, y1 - y0, x1 - x0)
+    assert np.allclose(results, expected[:, y0:y1, x0:x1], equal_nan=True)
+
+
+def test_write_results_region_of_interest(cube):
+
+    results = np.random.normal(6563., 1., (4, 4, 5))
+    output = maps.write_results(results, cube, '.temp_maps.roi.fits',
+                                'direct-vec', roi=(2, 7, 1, 5))
+    header = fits.getheader(output, 1)
+
+    os.remove(output)
+
+    assert header['NAXIS1'] == 5 and header['NAXIS2'] == 4
+    assert header['XC_XBEG'] == 2 and header['XC_YBEG'] == 1
+
+
+def test_build_bins_summed_snr():
+
+    np.random.seed(3)
+    z = np.arange(36).reshape((-1, 1, 1))
+    data = 10 + 2 * np.exp(-0.5 * ((z - 18) / 2.) ** 2) + \
+        np.random.normal(0, 1., (36, 16, 16))
+    fits.writeto('.temp_maps.fits', data.astype(np.float32), overwrite=True)
+
+    bins = maps.build_bins('.temp_maps.fits', 10.)
+
+    os.remove('.temp_maps.fits')
+
+    bin_snr = [snr.signal_to_noise(data[:, bins == b].sum(axis=1))
+               for b in range(bins.max() + 1)]
+
+    assert bins.max() > 0
+    assert 0.8 * 10. <= np.median(bin_snr) <= 1.5 * 10.
+
+
+def test_build_bins_without_accepted_bins(cube):
+
+    # The test cube lines are far from such a signal-to-noise ---
+    bins = maps.build_bins(cube, 1e6)
+
+    assert np.all(bins >= 0)
+    assert np.unique(bins).size == bins.size
@@ -0,0 +1,60 @@
+import numpy as np
+
+from samfp.tools import periodic
+
+
+def test_fourier_shift_integer():
+
+    data = np.random.rand(12, 3, 4)
+    shift = np.random.randint(-5, 5, (3, 4))
+
+    shifted = periodic.fourier_shift(data, shift)
+
+    for j in range(3):
+        for i in range(4):
+            expected = np.roll(data[:, j, i], shift[j, i])
+            assert np.allclose(shifted[:, j, i], expected)
+
+
+def test_fourier_shift_period_and_flux():
+
+    data = np.random.rand(15, 10)
+    shift = np.linspace(-3, 3, 10)
+
+    shifted = periodic.fourier_shift(data, shift, period=12)
+
+    assert shifted.shape == (12, 10)
+    assert np.allclose(shifted.sum(axis=0), data[:12].sum(axis=0))
+
+
+def test_fourier_moments_airy():
+
+    from samfp.tools import batchfit
+
+    z = np.arange(40.).reshape((-1, 1))
+    center = np.array([0.3, 10.7, 39.5])
+    data = 2 + 3 * batchfit.unit_airy(z, center, 4., 32.)
+
+    peak, x_0, fwhm, cont = periodic.fourier_moments(data, period=32)
+
+    assert np.allclose(peak, 3, atol=1e-3)
+    assert np.allclose(x_0, center % 32, atol=1e-3)
+    assert np.allclose(fwhm, 4, atol=1e-3)
+    assert np.allclose(cont, 2, atol=1e-3)
+    assert np.all(np.isnan(periodic.fourier_moments(np.ones((10, 2)))))
+
+
+def test_oversample_keeps_samples_and_flux():
+
+    for n in [12, 13]:
+
+        data = np.random.rand(n, 4)
+
+        for oversample in [periodic.fourier_oversample,
+                           periodic.cubic_oversample]:
+
+            result = oversample(data, 3)
+
+            assert result.shape == (3 * n, 4)
+            assert np.allclose(3 * result[::3], data)
+            assert np.allclose(result.sum(axis=0), data.sum(axis=0))
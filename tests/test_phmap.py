@@ -0,0 +1,115 @@
+import numpy as np
+import os
+
+from astropy.io import fits
+from samfp import phmap
+
+
+def _fit_header():
+
+    h = fits.Header()
+    h['PHMREFX'] = 10
+    h['PHMREFY'] = 5
+    h['PHMFIT_A'] = 2e-3
+    h['PHMFIT_B'] = 1e-2
+    h['PHMFIT_C'] = 3.
+    h['PHMUNIT'] = 'bcv'
+
+    return h
+
+
+def test_parabolic_phase_map():
+
+    h = _fit_header()
+    phase_map = phmap.ParabolicPhaseMap(h)
+
+    x, y = np.meshgrid(np.arange(30), np.arange(20))
+    r = np.sqrt((x - 10) ** 2 + (y - 5) ** 2)
+    expected = h['PHMFIT_A'] * r ** 2 + h['PHMFIT_B'] * r
+
+    data = phase_map((20, 30))
+
+    assert data.shape == (20, 30)
+    assert data[5, 10] == 0
+    assert np.allclose(data, expected, atol=1e-4)
+
+    region = phase_map((7, 20, 30), region=(3, 12, 2, None))
+    assert np.allclose(region, data[2:, 3:12])
+
+
+def test_parabolic_phase_map_binning():
+
+    h = _fit_header()
+    h['CCDSUM'] = '2 2'
+    phase_map = phmap.ParabolicPhaseMap(h)
+
+    binned = phase_map((10, 15), binning=(4, 4))
+    unbinned = phase_map((40, 60), binning=(1, 1))
+
+    # The center of a 4x4 pixel is the average position of the 1x1 pixels
+    assert binned.shape == (10, 15)
+    assert abs(binned[3, 5] - phase_map.radial_profile(
+        np.hypot(5.5 * 2 - 0.5 - 10, 3.5 * 2 - 0.5 - 5))) < 1e-6
+    assert unbinned.shape == (40, 60)
+
+
+def test_load_phase_map_from_header_only_file():
+
+    h = _fit_header()
+    fits.PrimaryHDU(header=h).writeto('.temp_phmap.fits', overwrite=True)
+
+    phase_map = phmap.load_phase_map('.temp_phmap.fits')
+    os.remove('.temp_phmap.fits')
+
+    assert isinstance(phase_map, phmap.ParabolicPhaseMap)
+    assert phase_map((20, 30))[5, 10] == 0
+
+
+def test_image_phase_map():
+
+    h = _fit_header()
+    data = np.arange(20 * 30, dtype=float).reshape((20, 30))
+
+    phase_map = phmap.ImagePhaseMap(data, h)
+    assert np.allclose(phase_map((20, 30)), data - data[5, 10])
+
+    try:
+        phase_map((7, 15))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected ValueError for mismatched shapes.')
+
+
+def test_image_phase_map_binning():
+
+    h = _fit_header()
+    y, x = np.mgrid[:20, :30]
+    data = 2. * x + 3. * y
+
+    # Without CCDSUM, the binning comes from the size of the images ---
+    phase_map = phmap.ImagePhaseMap(data, h)
+    binned = phase_map((10, 15))
+
+    yb, xb = np.mgrid[:10, :15]
+    expected = 2. * (2 * xb + 0.5) + 3. * (2 * yb + 0.5) - data[5, 10]
+
+    assert binned.shape == (10, 15)
+    assert np.allclose(binned, expected)
+    assert np.allclose(phase_map((10, 15), region=(2, 5, 1, 4)),
+                       expected[1:4, 2:5])
+
+    h['CCDSUM'] = '1 1'
+    phase_map = phmap.ImagePhaseMap(data, h)
+    assert np.allclose(phase_map((10, 15), binning=(2, 2)), expected)
+
+
+def test_phase_map_binning_on_one_side():
+
+    h = _fit_header()
+    h['CCDSUM'] = '2 2'
+    phase_map = phmap.ParabolicPhaseMap(h)
+
+    assert not phase_map._warned
+    assert phase_map((20, 30), binning=None).shape == (20, 30)
+    assert phase_map._warned
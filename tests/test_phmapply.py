@@ -0,0 +1,53 @@
+import numpy as np
+
+from samfp import phmapply
+
+
+def _gaussian_cube(centers, depth=40):
+
+    z = np.arange(depth).reshape((-1,) + (1,) * np.ndim(centers))
+    return 10 + 100 * np.exp(-0.5 * ((z - centers) / 2.) ** 2)
+
+
+def test_shift_spectra_methods():
+
+    dz = np.array([[0., 1.5, -2.25], [3., -0.5, 4.75]])
+    cube = _gaussian_cube(20 + dz)
+
+    for method in ['fourier', 'linear', 'cubic']:
+        shifted = phmapply.shift_spectra(cube, dz, fsr=40, method=method)
+        assert shifted.shape == cube.shape
+        assert np.all(np.argmax(shifted, axis=0) == 20)
+
+
+def test_shift_spectra_periodic_copies():
+
+    spectra = _gaussian_cube(np.array([10., 12.]), depth=45)
+
+    shifted = phmapply.shift_spectra(spectra, [0.5, 2.], fsr=20., sample=0.5)
+
+    assert shifted.shape == spectra.shape
+    assert np.allclose(shifted[40:], shifted[:5])
+    assert np.allclose(shifted[:40].sum(axis=0), spectra[:40].sum(axis=0))
+
+
+def test_shift_spectrum():
+
+    spec = _gaussian_cube(20.)
+
+    assert phmapply.shift_spectrum(spec, 0) is spec
+    assert np.argmax(phmapply.shift_spectrum(spec, 3)) == 17
+
+
+def test_flux_variation():
+
+    spectra = _gaussian_cube(np.array([10., 12., 14.]))
+    spectra[:, 1] = 0.
+    shifted = spectra.copy()
+    shifted[:, 2] *= 1.01
+
+    with np.errstate(all='raise'):
+        variation = phmapply.flux_variation(spectra, shifted)
+
+    assert np.isclose(variation, 0.01)
+    assert phmapply.flux_variation(spectra[:, 1], shifted[:, 1]) == 0.
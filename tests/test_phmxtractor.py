@@ -0,0 +1,27 @@
+import numpy as np
+
+from astropy.io import fits
+from samfp import phmxtractor
+
+
+def test_use_correlation_roi(tmpdir, monkeypatch):
+
+    monkeypatch.chdir(tmpdir)
+
+    np.random.seed(0)
+    data = np.random.random((10, 8, 8)).astype(np.float32)
+    fits.writeto('cube.fits', data)
+
+    names = []
+    for roi in [(0, 4, 0, 4), (4, 8, 4, 8), None, (0, 4, 0, 4)]:
+        extractor = phmxtractor.PhaseMapExtractor(
+            'cube.fits', 6563., correlation=True, roi=roi)
+        extractor.ref_s = np.ones(10)
+        names.append(extractor.use_correlation())
+
+    # Regions of the same size do not share or overwrite their cubes ---
+    assert len(set(names[:3])) == 3
+    assert names[3] == names[0]
+    assert fits.getdata(names[0]).shape == (10, 4, 4)
+    assert fits.getdata(names[2]).shape == (10, 8, 8)
+    assert not np.allclose(fits.getdata(names[0]), fits.getdata(names[1]))
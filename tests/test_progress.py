@@ -0,0 +1,50 @@
+import logging
+
+from samfp.tools.progress import Progress
+
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_progress_reports():
+
+    log = logging.getLogger('test_progress')
+    log.setLevel(logging.INFO)
+    handler = _ListHandler()
+    log.addHandler(handler)
+
+    progress = Progress(10, log, name='Fitting', unit='spectra', interval=0)
+    progress.update(4)
+    progress.update(6)
+    progress.finish()
+
+    log.removeHandler(handler)
+
+    assert len(handler.messages) == 3
+    assert 'Fitting: 4/10 spectra (40%)' in handler.messages[0]
+    assert 'ETA' in handler.messages[0]
+    assert 'Fitting: 10 spectra in' in handler.messages[2]
+    assert progress.eta == 0
+
+
+def test_progress_interval():
+
+    log = logging.getLogger('test_progress_interval')
+    handler = _ListHandler()
+    log.addHandler(handler)
+
+    progress = Progress(100, log, interval=3600.)
+    for _ in range(100):
+        progress.update()
+
+    log.removeHandler(handler)
+
+    assert progress.done == 100
+    assert handler.messages == []
@@ -0,0 +1,30 @@
+import numpy as np
+
+from samfp.tools import snr
+
+
+def test_signal_to_noise():
+
+    np.random.seed(0)
+    z = np.arange(60).reshape((-1, 1))
+    noise = np.random.normal(0, 1., (60, 3))
+    data = 10 + np.array([0, 5, 50]) * np.exp(-0.5 * ((z - 30) / 2.) ** 2)
+
+    s = snr.signal_to_noise(data + noise)
+
+    assert s[0] < 4
+    assert 3 < s[1] < 9
+    assert 30 < s[2] < 70
+    assert np.all(snr.signal_to_noise(np.ones((10, 2))) == 0)
+
+
+def test_differential_noise():
+
+    np.random.seed(1)
+    z = np.arange(60).reshape((-1, 1))
+    data = 10 + 50 * np.exp(-0.5 * ((z - 30) / 4.) ** 2) + \
+        np.random.normal(0, 2., (60, 200))
+
+    noise = snr.differential_noise(data)
+
+    assert 1.7 < np.median(noise) < 2.3
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from astropy.io import fits
+
+from samfp.tools import speccache
+
+
+def test_spectral_cube_indexing():
+
+    data = np.random.rand(7, 5, 6).astype(np.float32)
+    fits.writeto('.temp_cache.fits', data, overwrite=True)
+
+    cube = speccache.open_cube('.temp_cache.fits', cache=True)
+    cache = cube.filename
+
+    assert cube.shape == data.shape
+    assert os.path.basename(cache).startswith('..temp_cache.fits.')
+
+    for key in [(slice(None), 2, 3), (slice(1, 5), slice(0, 3), slice(2, 6)),
+                (3,), (3, slice(1, 4), 2)]:
+        assert np.array_equal(cube[key], data[key])
+
+    # A modified cube gets a new cache ---
+    fits.writeto('.temp_cache.fits', 2 * data, overwrite=True)
+    cube = speccache.open_cube('.temp_cache.fits', cache=True)
+
+    assert cube.filename != cache
+    assert not os.path.exists(cache)
+    assert np.array_equal(cube[:, 1, 1], 2 * data[:, 1, 1])
+
+    os.remove(cube.filename)
+    os.remove('.temp_cache.fits')
+
+
+def test_open_cube_region_of_interest():
+
+    data = np.random.rand(7, 5, 6).astype(np.float32)
+    fits.writeto('.temp_cache.fits', data, overwrite=True)
+
+    roi = (1, 5, 2, 4)
+    expected = data[:, 2:4, 1:5]
+
+    for cache in [False, True]:
+        cube = speccache.open_cube('.temp_cache.fits', cache=cache, roi=roi)
+        assert cube.shape == expected.shape
+        assert np.array_equal(cube[:, 1, 2], expected[:, 1, 2])
+        assert np.array_equal(cube[2:5, :, 1:3], expected[2:5, :, 1:3])
+
+    os.remove(cube.filename)
+    os.remove('.temp_cache.fits')
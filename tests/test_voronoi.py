@@ -0,0 +1,70 @@
+import numpy as np
+
+from samfp.tools import voronoi
+
+
+def test_voronoi_bins():
+
+    y, x = np.mgrid[:60, :60]
+    signal = 40 * np.exp(-((x - 30) ** 2 + (y - 30) ** 2) / (2 * 10 ** 2))
+    noise = np.ones_like(signal)
+
+    labels = voronoi.voronoi_bins(signal, noise, 10.)
+
+    assert np.all(labels >= 0)
+    assert np.array_equal(np.unique(labels), np.arange(labels.max() + 1))
+
+    # Bright pixels keep their own bins ---
+    counts = np.bincount(labels.ravel())
+    assert np.all(counts[labels[signal >= 10]] == 1)
+
+    s = np.bincount(labels.ravel(), signal.ravel())
+    n = np.sqrt(np.bincount(labels.ravel(), noise.ravel() ** 2))
+    assert np.median(s / n) >= 10
+
+
+def test_voronoi_bins_mask():
+
+    signal = np.ones((10, 10))
+    noise = np.ones((10, 10))
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[:5] = True
+
+    labels = voronoi.voronoi_bins(signal, noise, 3., mask=mask)
+
+    assert np.all(labels[~mask] == -1)
+    assert np.all(labels[mask] >= 0)
+    assert labels.max() + 1 < mask.sum()
+
+
+def test_voronoi_bins_uniform_noise():
+
+    rng = np.random.default_rng(0)
+    snr_pix, target = 3., 20.
+
+    signal = snr_pix + rng.normal(0, 1., (120, 120))
+    noise = np.ones_like(signal)
+
+    labels = voronoi.voronoi_bins(signal, noise, target)
+
+    s = np.bincount(labels.ravel(), signal.ravel())
+    n = np.sqrt(np.bincount(labels.ravel(), noise.ravel() ** 2))
+    assert 0.8 * target <= np.median(s / n) <= 1.5 * target
+
+    expected = signal.size * snr_pix ** 2 / target ** 2
+    assert 0.7 * expected <= labels.max() + 1 <= 1.3 * expected
+
+
+def test_voronoi_bins_sn_func():
+
+    signal = np.ones((12, 12))
+    noise = np.ones((12, 12))
+
+    # S/N that grows linearly with the number of pixels ---
+    labels = voronoi.voronoi_bins(signal, noise, 4.,
+                                  spectra=np.ones((12, 12, 1)),
+                                  sn_func=lambda totals: totals[:, 0])
+
+    counts = np.bincount(labels.ravel())
+    assert np.all(labels >= 0)
+    assert np.median(counts) == 4
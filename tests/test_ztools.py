@@ -63,6 +63,24 @@ def test_z_oversample():
     os.remove('dummy.fits')
 
 
+def test_z_oversample_kinds():
+
+    data = fits.getdata('tests/test_data/test_ztools.fits')
+
+    for kind in ['fourier', 'cubic']:
+
+        oversample = ztools.ZOversample(
+            'tests/test_data/test_ztools.fits', 'dummy.fits', 4, kind=kind)
+        oversample.start()
+        oversample.join()
+
+        assert oversample.results.shape[0] == 4 * data.shape[0]
+        assert np.allclose(oversample.results.sum(axis=0), data.sum(axis=0),
+                           rtol=1e-5)
+
+        os.remove('dummy.fits')
+
+
 def test_z_repeat_after():
 
     data = np.array([10, 20, 15])
@@ -196,3 +214,165 @@ def test_z_roc():
     os.remove(repeated_data_filename)
     os.remove(oversampled_data_filename)
     os.remove(final_filename)
+
+
+def test_linear_oversample_operator():
+
+    data = np.random.rand(13, 5)
+
+    sampler = ztools.OverSampler('tests/test_data/test_ztools.fits', 3)
+    operator = ztools.linear_oversample_operator(13, 3)
+
+    expected = np.column_stack(
+        [sampler.linear_interpolation(s) for s in data.T])
+
+    assert operator.shape == (39, 13)
+    assert np.allclose(operator.dot(data), expected, rtol=1e-12, atol=0)
+
+
+def test_z_pipeline_matches_threads():
+
+    filename = 'tests/test_data/test_ztools.fits'
+
+    repeat = ztools.ZRepeat(filename, '.zrep_temp.fits', n_before=1,
+                            n_after=1)
+    repeat.start()
+    repeat.join()
+
+    oversample = ztools.ZOversample('.zrep_temp.fits', '.zosample_temp.fits',
+                                    3, kind='cubic')
+    oversample.start()
+    oversample.join()
+
+    cut = ztools.ZCut('.zosample_temp.fits', '.zcut_temp.fits', n_begin=20,
+                      n_end=-20)
+    cut.start()
+    cut.join()
+
+    pipeline = ztools.ZPipeline(filename)
+    pipeline.repeat(n_before=1, n_after=1).oversample(3, kind='cubic')
+    pipeline.cut(n_begin=20, n_end=-20).write('.zpipe_temp.fits')
+
+    expected, expected_header = fits.getdata('.zcut_temp.fits', header=True)
+    data, header = fits.getdata('.zpipe_temp.fits', header=True)
+
+    for f in ['.zrep_temp.fits', '.zosample_temp.fits', '.zcut_temp.fits',
+              '.zpipe_temp.fits']:
+        os.remove(f)
+
+    assert np.allclose(data, expected)
+    assert list(header.items()) == list(expected_header.items())
+
+
+def test_z_functions():
+
+    data, header = fits.getdata('tests/test_data/test_ztools.fits',
+                                header=True)
+    crpix = header['CRPIX3']
+
+    repeated, h = ztools.z_repeat(data, header, n_before=2, n_after=1)
+    assert np.array_equal(repeated, np.concatenate([data] * 4))
+    assert h['CRPIX3'] == crpix + 2 * data.shape[0]
+    assert header['CRPIX3'] == crpix
+
+    oversampled, h = ztools.z_oversample(repeated, h, 3)
+    assert oversampled.shape[0] == 3 * repeated.shape[0]
+    assert h['ZO_OVFAC'] == 3
+
+    cut, h = ztools.z_cut(oversampled, h, 5, -5)
+    assert np.array_equal(cut, oversampled[5:-5])
+    assert h['ZC_AFSIZ'] == cut.shape[0]
+
+
+def test_run_batch():
+
+    filename = 'tests/test_data/test_ztools.fits'
+    outputs = ['.zbatch_0.fits', '.zbatch_1.fits']
+    operations = [(ztools.z_repeat, {'n_after': 1}),
+                  (ztools.z_oversample, {'oversample_factor': 2})]
+
+    written = ztools.run_batch([filename, filename], outputs, operations, n=2)
+
+    expected, _ = ztools.z_repeat(*fits.getdata(filename, header=True),
+                                  n_after=1)
+    expected, _ = ztools.z_oversample(expected, _, 2)
+
+    for f in outputs:
+        assert np.allclose(fits.getdata(f), expected)
+        os.remove(f)
+
+    assert sorted(written) == outputs
+
+
+def test_xy_crop():
+
+    data = np.random.rand(5, 9, 11).astype(np.float32)
+
+    h = fits.Header()
+    h['CRPIX1'] = 6.
+    h['CRPIX2'] = 5.
+    h['PHMREFX'] = 4
+    h['PHMREFY'] = 3
+    fits.writeto('.xycrop_input.fits', data, h, overwrite=True)
+
+    roi = (2, -3, 1, 7)
+    xycrop = ztools.XYCrop('.xycrop_input.fits', '.xycrop_temp.fits', roi)
+    xycrop.start()
+    xycrop.join()
+
+    cropped, header = fits.getdata('.xycrop_temp.fits', header=True)
+    os.remove('.xycrop_input.fits')
+    os.remove('.xycrop_temp.fits')
+
+    assert np.array_equal(cropped, data[:, 1:7, 2:-3])
+    assert header['CRPIX1'] == 4. and header['CRPIX2'] == 4.
+    assert header['PHMREFX'] == 2 and header['PHMREFY'] == 2
+    assert header['XC_XEND'] == 8
+
+    in_memory, h2 = ztools.xy_crop(data, h, roi)
+    assert np.array_equal(in_memory, cropped)
+    assert h2['CRPIX1'] == 4. and h['CRPIX1'] == 6.
+
+
+def test_xy_bin():
+
+    from samfp import phmap
+
+    data = np.random.rand(4, 9, 13).astype(np.float32)
+
+    h = fits.Header()
+    h['CRPIX1'] = 7.
+    h['CDELT1'] = 0.5
+    h['CRPIX2'] = 1.
+    h['CDELT2'] = 0.5
+    h['PHMREFX'] = 6
+    h['PHMREFY'] = 4
+    h['PHMFIT_A'] = 0.01
+    h['PHMFIT_B'] = 0.1
+    h['PHMFIT_C'] = 0.
+    fits.writeto('.xybin_input.fits', data, h, overwrite=True)
+
+    xybin = ztools.XYBin('.xybin_input.fits', '.xybin_temp.fits', 2)
+    xybin.start()
+    xybin.join()
+
+    binned, header = fits.getdata('.xybin_temp.fits', header=True)
+    os.remove('.xybin_input.fits')
+    os.remove('.xybin_temp.fits')
+
+    expected = data[:, :8, :12].reshape((4, 4, 2, 6, 2)).sum(axis=(2, 4))
+    assert np.allclose(binned, expected)
+
+    # The same sky and phase-map positions ---
+    assert header['CRPIX1'] == 3.75 and header['CRPIX2'] == 0.75
+    assert header['CDELT1'] == 1. and header['CCDSUM'] == '2 2'
+
+    full = phmap.ParabolicPhaseMap(h)((9, 13), binning=(1, 1))
+    small = phmap.ParabolicPhaseMap(header)((4, 6), binning=(2, 2))
+    assert np.allclose(small, full[:8, :12].reshape(4, 2, 6, 2).mean(
+        axis=(1, 3)), atol=0.02)
+
+    averaged, h2 = ztools.xy_bin(data, h, (3, 2), mode='mean')
+    assert np.allclose(averaged, data[:, :8, :12].reshape(
+        (4, 4, 2, 4, 3)).mean(axis=(2, 4)))
+    assert h2['CCDSUM'] == '3 2' and h['CRPIX1'] == 7.